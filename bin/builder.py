@@ -1,6 +1,8 @@
 #!/usr/bin/python
 
 import os
+import re
+import sys
 
 input_dirs = ['source/']
 
@@ -10,6 +12,12 @@ OUTPUT_FILE = build_dir + 'makefile.generated'
 JOB = "\n\t"
 TARGET = "\n"
 
+DOC_EXTENSIONS = ('rst', 'txt')
+MAX_LATEX_PASSES = 5
+
+INCLUDE_RE = re.compile(r'^\s*\.\. (include|literalinclude)::\s*(\S+)', re.M)
+IMAGE_RE = re.compile(r'^\s*\.\. (image|figure)::\s*(\S+)', re.M)
+
 ######################################################################
 
 def generate_file_tree(input_dir):
@@ -73,6 +81,83 @@ def build_shortcut_targets(target, shortcut):
 
     return output
 
+def generate_doc_tree(input_dir):
+    targets = []
+
+    for dirname, dirnames, filenames in os.walk(input_dir):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.rsplit('.',1)[-1] not in DOC_EXTENSIONS:
+                continue
+
+            source = os.path.join(dirname, filename)
+            relative = os.path.relpath(source, input_dir)
+            target = os.path.join(build_dir, relative).rsplit('.',1)[0]
+            shortcut = filename.rsplit('.',1)[0]
+
+            targets.append((source, target, shortcut))
+
+    return targets
+
+def scan_dependencies(source):
+    # Files pulled in by include directives, and images, that exist.
+    with open(source) as f:
+        text = f.read()
+
+    def resolve(regex):
+        paths = []
+        for directive, path in regex.findall(text):
+            path = os.path.normpath(os.path.join(os.path.dirname(source), path))
+            if os.path.isfile(path) and path not in paths:
+                paths.append(path)
+        return paths
+
+    return resolve(INCLUDE_RE), resolve(IMAGE_RE)
+
+def generate_doc_converters(input_dir, output_dir):
+    tex_converter = (JOB + "@mkdir -p $(@D)" +
+                     JOB + "@$(LATEXCMD) $< >$@" +
+                     JOB + "@echo [rst2latex]: created '$@'")
+    html_converter = (JOB + "@mkdir -p $(@D)" +
+                      JOB + "@$(HTMLCMD) $< >$@" +
+                      JOB + "@echo [rst2html]: created '$@'")
+
+    converters = ""
+    for ext in DOC_EXTENSIONS:
+        converters += (TARGET + output_dir + "%.tex" + ":" + input_dir + "%." + ext + tex_converter +
+                       TARGET + output_dir + "%.html" + ":" + input_dir + "%." + ext + html_converter)
+
+    return converters
+
+def generate_doc_builders(output_dir):
+    # Rerun pdflatex only until the .aux file stops changing. The .aux is
+    # written next to the PDF, so both are in the target's directory.
+    pdfcmd = "$(PDFCMD) -output-directory '$(@D)' '$<'"
+    aux = "$(basename $@).aux"
+    check_aux = ("test -f '" + aux + "' || { echo \"[pdflatex]: no '" + aux + "' written, " +
+                 "see '$@.log'\"; exit 1; }")
+    pdf_builder = (TARGET + output_dir + "%.pdf" + ":" + output_dir + "%.tex" +
+                   JOB + "@" + pdfcmd + " >|$@.log && " + check_aux +
+                   JOB + "@echo [pdflatex]: \(1\) built '$@'" +
+                   JOB + "@for pass in " + " ".join(str(n) for n in range(2, MAX_LATEX_PASSES + 1)) + "; do " +
+                   "cp '" + aux + "' '" + aux + ".prev'; " +
+                   pdfcmd + " >>$@.log || exit 1; " + check_aux + "; " +
+                   "echo \"[pdflatex]: ($$pass) built '$@'\"; " +
+                   "if cmp -s '" + aux + "' '" + aux + ".prev'; then break; fi; " +
+                   "done; rm -f '" + aux + ".prev'" +
+                   JOB + "@echo [PDF]: see '$@.log' for a full report of the pdf build process.")
+
+    return pdf_builder
+
+def build_doc_targets(source, target, includes, images):
+    deps = " ".join([source] + includes)
+    output = (target + ".tex" + ":" + deps +
+              TARGET + target + ".html" + ":" + deps)
+    if images:
+        output += TARGET + target + ".pdf" + ":" + " ".join(images)
+
+    return output
+
 ######################################################################
 
 class GeneratedMakefile(object):
@@ -92,11 +177,48 @@ class GeneratedMakefile(object):
                 self.targets.append(build_html_targets(src, trg))
                 self.targets.append(build_shortcut_targets(trg, shc))
 
-makefile = GeneratedMakefile()
+class DocsMakefile(object):
+    """Documents only, with include and image dependencies.
+
+    Targets mirror the source tree, so that every target is distinct and the
+    makefile is safe for "make -j". Shortcuts are only made for file names
+    that are unique, and "docs" builds everything.
+    """
+    def __init__(self):
+
+        self.converters = []
+        self.targets = []
+
+        self.builder = generate_doc_builders(build_dir)
+
+        for dir in input_dirs:
+            self.converters.append(generate_doc_converters(dir, build_dir))
+
+        docs = []
+        for dir in input_dirs:
+            docs.extend(generate_doc_tree(dir))
+
+        shortcuts = [shc for (src, trg, shc) in docs]
+        outputs = []
+        for (src, trg, shc) in docs:
+            includes, images = scan_dependencies(src)
+            self.targets.append(build_doc_targets(src, trg, includes, images))
+            if shortcuts.count(shc) == 1:
+                self.targets.append(build_shortcut_targets(trg, shc))
+            outputs.extend([trg + ".html", trg + ".pdf"])
+
+        self.targets.append(".PHONY: docs " + " ".join(
+            shc for shc in shortcuts if shortcuts.count(shc) == 1))
+        self.targets.append("docs:" + " ".join(outputs))
 
 ########################################################################
 
 def main():
+    if '--docs' in sys.argv[1:]:
+        makefile = DocsMakefile()
+    else:
+        makefile = GeneratedMakefile()
+
     output = open(OUTPUT_FILE, "w")
 
     for line in makefile.converters:
@@ -0,0 +1,141 @@
+#!/usr/bin/python
+"""Render the spec documents to HTML in-process, with a doctree cache.
+
+Renders every .rst/.txt document found by builder.generate_doc_tree to the
+same build/ paths as "builder.py --docs", but imports docutils once per
+worker process instead of starting rst2html once per document.
+
+Parsed doctrees are pickled in build/.doctrees/, keyed by the SHA-256 of the
+document and the files it includes, and a manifest records the key each HTML
+file was last written from. A document whose key matches its manifest entry
+and whose HTML exists is skipped; otherwise a cached doctree for its key is
+written out without parsing the document again.
+"""
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import pickle
+import tempfile
+
+from builder import build_dir, input_dirs, generate_doc_tree, scan_dependencies
+
+CACHE_DIR = os.path.join(build_dir, '.doctrees')
+MANIFEST = os.path.join(CACHE_DIR, 'manifest.json')
+
+######################################################################
+
+def source_key(source):
+    digest = hashlib.sha256()
+    includes, images = scan_dependencies(source)
+    for path in [source] + includes:
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+
+    return digest.hexdigest()
+
+def parse(source):
+    from docutils.core import publish_doctree
+
+    with open(source, 'rb') as f:
+        return publish_doctree(f.read(), source_path=source)
+
+def write_doctree(path, doctree):
+    # The reporter and transformer hold streams and can't be pickled;
+    # publish_from_doctree makes new ones.
+    doctree.reporter = None
+    doctree.transformer = None
+    doctree.settings.warning_stream = None
+
+    fd, tmp = tempfile.mkstemp(dir=CACHE_DIR)
+    with os.fdopen(fd, 'wb') as f:
+        pickle.dump(doctree, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+def read_doctree(path):
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError):
+        return None
+
+def render(job):
+    """Write one document's HTML; return (html, what was done, key)."""
+    from docutils.core import publish_from_doctree
+
+    source, target, last_key, force = job
+    html = target + '.html'
+    key = source_key(source)
+    cached = os.path.join(CACHE_DIR, key + '.pickle')
+
+    if key == last_key and os.path.exists(html) and not force:
+        return html, 'unchanged', key
+
+    doctree = None if force else read_doctree(cached)
+    action = 'from cache'
+    if doctree is None:
+        doctree = parse(source)
+        write_doctree(cached, doctree)
+        action = 'rendered'
+
+    output = publish_from_doctree(doctree, writer_name='html')
+    dirname = os.path.dirname(html)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    with open(html, 'wb') as f:
+        f.write(output)
+
+    return html, action, key
+
+def load_manifest():
+    try:
+        with open(MANIFEST) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+######################################################################
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[0])
+    parser.add_argument('documents', nargs='*',
+                        help='only render these source files')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='worker processes (default: one per CPU)')
+    parser.add_argument('--force', action='store_true',
+                        help='parse and render every document again')
+    args = parser.parse_args()
+
+    docs = []
+    for dir in input_dirs:
+        docs.extend(generate_doc_tree(dir))
+
+    if args.documents:
+        wanted = set(os.path.normpath(d) for d in args.documents)
+        docs = [d for d in docs if os.path.normpath(d[0]) in wanted]
+
+    if not os.path.isdir(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+
+    manifest = load_manifest()
+    jobs = [(src, trg, manifest.get(trg + '.html'), args.force)
+            for (src, trg, shc) in docs]
+    counts = {}
+    with multiprocessing.Pool(args.jobs) as pool:
+        for html, action, key in pool.imap_unordered(render, jobs):
+            manifest[html] = key
+            counts[action] = counts.get(action, 0) + 1
+            if action != 'unchanged':
+                print("[rst2html]: created '%s' (%s)" % (html, action))
+
+    with open(MANIFEST, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+    print('[rst2html]: %s' % ', '.join(
+        '%d %s' % (n, action) for action, n in sorted(counts.items())))
+
+if __name__ == "__main__":
+    main()
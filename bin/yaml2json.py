@@ -0,0 +1,275 @@
+#!/usr/bin/python
+"""Convert the spec tests' YAML files to JSON, like js-yaml does.
+
+Converts every .yml file under the given directories to a .json file next to
+it, with the same bytes js-yaml writes: JSON.stringify(doc, null, 2) plus a
+newline, YAML 1.2 booleans, JavaScript number formatting and key order, and
+js-yaml's handling of "<<" merge keys.
+
+All files are converted in one process pool. A manifest of content hashes
+records each YAML file and the JSON written for it, so files whose YAML and
+JSON are both unchanged since the last run are skipped.
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import re
+
+import yaml
+
+MANIFEST = '.yaml2json-manifest.json'
+
+######################################################################
+
+def construct_mapping(loader, node):
+    # js-yaml merges "<<" keys where they appear: merged keys only fill in
+    # keys not set yet, and later keys overwrite values in place.
+    mapping = {}
+    yield mapping
+
+    for key_node, value_node in node.value:
+        if key_node.tag == 'tag:yaml.org,2002:merge':
+            if isinstance(value_node, yaml.SequenceNode):
+                sources = value_node.value
+            else:
+                sources = [value_node]
+
+            for source_node in sources:
+                source = loader.construct_object(source_node, deep=True)
+                for key, value in source.items():
+                    mapping.setdefault(key, value)
+        else:
+            key = loader.construct_object(key_node, deep=True)
+            mapping[key] = loader.construct_object(value_node, deep=True)
+
+def js_yaml_loader(base):
+    """Subclass a SafeLoader with js-yaml's default schema where they differ."""
+    class Loader(base):
+        pass
+
+    # YAML 1.1 also reads yes/no/on/off as booleans; js-yaml doesn't.
+    Loader.yaml_implicit_resolvers = {
+        first: [(tag, regexp) for tag, regexp in resolvers
+                if tag != 'tag:yaml.org,2002:bool']
+        for first, resolvers in base.yaml_implicit_resolvers.items()}
+
+    Loader.add_implicit_resolver(
+        'tag:yaml.org,2002:bool',
+        re.compile(r'^(?:true|True|TRUE|false|False|FALSE)$'),
+        list('tTfF'))
+
+    # YAML 1.1 floats need a "." and a signed exponent, js-yaml's don't.
+    Loader.add_implicit_resolver(
+        'tag:yaml.org,2002:float',
+        re.compile(r'^[-+]?(?:0|[1-9][0-9_]*)(?:\.[0-9_]*)?[eE][-+]?[0-9]+$'),
+        list('-+0123456789'))
+
+    Loader.add_constructor('tag:yaml.org,2002:map', construct_mapping)
+    return Loader
+
+class PyLoader(js_yaml_loader(yaml.SafeLoader)):
+    """Also lets an anchor be redefined, which PyYAML's C composer refuses."""
+    def compose_node(self, parent, index):
+        event = self.peek_event()
+        if not isinstance(event, yaml.AliasEvent) and event.anchor:
+            # Later aliases refer to the newest node with this anchor.
+            self.anchors.pop(event.anchor, None)
+
+        return super(PyLoader, self).compose_node(parent, index)
+
+if hasattr(yaml, 'CSafeLoader'):
+    Loader = js_yaml_loader(yaml.CSafeLoader)
+else:
+    Loader = PyLoader
+
+######################################################################
+
+def js_number(n):
+    # Number.prototype.toString(). Python's repr() and JavaScript both
+    # print the shortest digits that round-trip, but lay them out differently.
+    if isinstance(n, int) and abs(n) <= 2 ** 53:
+        return str(n)
+
+    n = float(n)
+    if math.isnan(n) or math.isinf(n):
+        return 'null'
+    if n == 0:
+        return '0'
+
+    mantissa, _, exp = repr(abs(n)).partition('e')
+    whole, _, frac = mantissa.partition('.')
+    digits = (whole + frac).lstrip('0').rstrip('0')
+    # n is 0.<digits> * 10 ** point.
+    if whole != '0':
+        point = len(whole)
+    else:
+        point = len(frac.lstrip('0')) - len(frac)
+    point += int(exp or 0)
+
+    sign = '-' if n < 0 else ''
+    if len(digits) <= point <= 21:
+        return sign + digits + '0' * (point - len(digits))
+    if 0 < point <= 21:
+        return sign + digits[:point] + '.' + digits[point:]
+    if -6 < point <= 0:
+        return sign + '0.' + '0' * -point + digits
+
+    mantissa = digits[0] + ('.' + digits[1:] if len(digits) > 1 else '')
+    return '%s%se%s%d' % (sign, mantissa, '+' if point > 1 else '-',
+                          abs(point - 1))
+
+def is_array_index(key):
+    return (key.isdigit() and (key == '0' or key[0] != '0')
+            and int(key) < 2 ** 32 - 1)
+
+def js_keys(obj):
+    # JavaScript objects list integer-like keys first, in numeric order.
+    keys = [js_key(k) for k in obj]
+    indexes = sorted((k for k in keys if is_array_index(k)), key=int)
+    return indexes + [k for k in keys if not is_array_index(k)]
+
+def js_key(key):
+    if key is None:
+        return 'null'
+    if isinstance(key, bool):
+        return 'true' if key else 'false'
+    if isinstance(key, (int, float)):
+        return js_number(key)
+    return str(key)
+
+def stringify(obj, indent=''):
+    """JSON.stringify(obj, null, 2)."""
+    if obj is None:
+        return 'null'
+    if obj is True:
+        return 'true'
+    if obj is False:
+        return 'false'
+    if isinstance(obj, (int, float)):
+        return js_number(obj)
+    if isinstance(obj, str):
+        return json.dumps(obj, ensure_ascii=False)
+    if isinstance(obj, bytes):
+        # js-yaml loads !!binary as a Buffer.
+        return stringify({'type': 'Buffer', 'data': list(obj)}, indent)
+    if hasattr(obj, 'isoformat'):
+        return stringify(js_date(obj), indent)
+
+    inner = indent + '  '
+    if isinstance(obj, (list, tuple)):
+        if not obj:
+            return '[]'
+        items = [inner + stringify(v, inner) for v in obj]
+        return '[\n' + ',\n'.join(items) + '\n' + indent + ']'
+
+    values = {js_key(k): v for k, v in obj.items()}
+    if not values:
+        return '{}'
+    items = [inner + json.dumps(k, ensure_ascii=False) + ': ' +
+             stringify(values[k], inner) for k in js_keys(obj)]
+    return '{\n' + ',\n'.join(items) + '\n' + indent + '}'
+
+def js_date(value):
+    # Date.prototype.toJSON(): UTC with milliseconds.
+    import datetime
+    if not isinstance(value, datetime.datetime):
+        value = datetime.datetime(value.year, value.month, value.day)
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return value.strftime('%Y-%m-%dT%H:%M:%S.') + '%03dZ' % (
+        value.microsecond // 1000)
+
+######################################################################
+
+def load_yaml(text):
+    """Parse YAML text the way js-yaml does."""
+    try:
+        return yaml.load(text, Loader=Loader)
+    except yaml.composer.ComposerError:
+        if Loader is PyLoader:
+            raise
+        return yaml.load(text, Loader=PyLoader)
+
+def yaml_to_json(text):
+    return stringify(load_yaml(text)) + '\n'
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def convert(source):
+    """Write source's JSON file; return (source, yml hash, json hash)."""
+    data = read(source)
+    output = yaml_to_json(data.decode('utf-8')).encode('utf-8')
+    target = source[:-len('.yml')] + '.json'
+    if not os.path.exists(target) or read(target) != output:
+        tmp = target + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(output)
+        os.replace(tmp, target)
+        print('[yaml2json]: created %s' % target)
+
+    return source, sha256(data), sha256(output)
+
+def find_yaml_files(dirs):
+    sources = []
+    for input_dir in dirs:
+        for dirname, dirnames, filenames in os.walk(input_dir):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if filename.lower().endswith('.yml'):
+                    sources.append(os.path.join(dirname, filename))
+
+    return sources
+
+def is_current(source, manifest):
+    entry = manifest.get(source)
+    target = source[:-len('.yml')] + '.json'
+    return (entry is not None and os.path.exists(target) and
+            entry == [sha256(read(source)), sha256(read(target))])
+
+def load_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('dirs', nargs='*', default=['.'],
+                        help='directories to search for .yml files')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='worker processes (default: one per CPU)')
+    parser.add_argument('--manifest', default=MANIFEST,
+                        help='content hash manifest (default: %(default)s)')
+    parser.add_argument('--force', action='store_true',
+                        help='convert every file, ignoring the manifest')
+    args = parser.parse_args()
+
+    manifest = {} if args.force else load_manifest(args.manifest)
+    sources = find_yaml_files(args.dirs)
+    changed = [s for s in sources if not is_current(s, manifest)]
+
+    if changed:
+        with multiprocessing.Pool(args.jobs) as pool:
+            for source, yml_hash, json_hash in pool.imap_unordered(
+                    convert, changed, chunksize=8):
+                manifest[source] = [yml_hash, json_hash]
+
+    manifest = {s: manifest[s] for s in sources if s in manifest}
+    with open(args.manifest, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+    print('[yaml2json]: %d of %d files converted' % (len(changed), len(sources)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/python
+"""Load spec test YAML files through a cache of parsed documents.
+
+Parsing is done by yaml2json.load_yaml, with libyaml's C loader when PyYAML
+has it and the same anchor, alias and merge key handling as js-yaml, so the
+documents equal what the committed JSON files contain.
+
+Each parsed file is pickled in CACHE_DIR (or $SPEC_YAML_CACHE). A cache entry
+is reused while the file's mtime and size are unchanged; if they change but
+the file's SHA-256 doesn't, the entry is reused and its mtime updated.
+
+Scripts outside bin/ can import this module after adding bin/ to sys.path::
+
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../../../bin'))
+    import yamlcache
+"""
+
+import argparse
+import hashlib
+import os
+import pickle
+import tempfile
+
+from yaml2json import load_yaml
+
+CACHE_DIR = os.environ.get('SPEC_YAML_CACHE', os.path.join(
+    os.path.expanduser('~'), '.cache', 'mongodb-specifications', 'yaml'))
+
+# Bump when the loader changes in a way that changes parsed documents.
+CACHE_VERSION = 1
+
+######################################################################
+
+def cache_path(path):
+    key = hashlib.sha256(os.path.abspath(path).encode('utf-8')).hexdigest()
+    return os.path.join(CACHE_DIR, key + '.pickle')
+
+def read_entry(path):
+    try:
+        with open(path, 'rb') as f:
+            entry = pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError):
+        return None
+
+    if entry.get('version') != CACHE_VERSION:
+        return None
+    return entry
+
+def write_entry(path, entry):
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+
+    fd, tmp = tempfile.mkstemp(dir=dirname)
+    with os.fdopen(fd, 'wb') as f:
+        pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+def loads(text):
+    """Parse YAML text, without caching."""
+    return load_yaml(text)
+
+def load(path):
+    """Return the parsed document in the YAML file at path."""
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    entry_path = cache_path(path)
+    entry = read_entry(entry_path)
+    if entry is not None and entry['stamp'] == stamp:
+        return entry['doc']
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    digest = hashlib.sha256(data).hexdigest()
+
+    if entry is not None and entry['sha256'] == digest:
+        # Touched but not changed.
+        entry['stamp'] = stamp
+    else:
+        entry = {'version': CACHE_VERSION, 'stamp': stamp, 'sha256': digest,
+                 'doc': load_yaml(data.decode('utf-8'))}
+    write_entry(entry_path, entry)
+
+    return entry['doc']
+
+def iter_tests(path, key='tests'):
+    """Yield the tests in a YAML test file one at a time.
+
+    Anchors may be defined in one test and used in another, so the whole
+    file is parsed (or read from the cache) before the first test.
+    """
+    for test in load(path).get(key) or []:
+        yield test
+
+######################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('files', nargs='+', help='YAML files to load')
+    args = parser.parse_args()
+
+    for path in args.files:
+        print('%s: %d tests' % (path, sum(1 for _ in iter_tests(path))))
+
+if __name__ == '__main__':
+    main()
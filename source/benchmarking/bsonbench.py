@@ -0,0 +1,108 @@
+"""Run the BSON micro-benchmarks in benchmarking.rst against a Python codec.
+
+Each task loads its dataset from data/extended_bson.tgz, then encodes the
+document to BSON, or decodes its BSON, 10,000 times per iteration. The
+deep_bson.json in that tarball is a gzipped tarball of the other two files,
+not JSON, so the Deep tasks read it from extended_bson_legacy.tgz instead.
+
+Codecs are loaded as in ../bson-corpus/run_corpus.py; only json_to_native,
+native_to_bson and bson_to_native are used. The default is PyMongo's bson
+package.
+
+    python bsonbench.py --json before.json
+    python bsonbench.py --compare before.json flat
+"""
+
+import os
+import sys
+
+import driverbench
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "bson-corpus"))
+from run_corpus import load_codec  # noqa: E402
+
+NUM_DOCS = 10000
+
+LEGACY_TARBALL = "extended_bson_legacy"
+GZIP_MAGIC = b"\x1f\x8b"
+
+DATASETS = (
+    ("Flat", "flat_bson.json"),
+    ("Deep", "deep_bson.json"),
+    ("Full", "full_bson.json"),
+)
+
+
+class BSONTask(driverbench.Task):
+    def __init__(self, codec, datasets, tarball, kind, filename):
+        self.codec = codec
+        self.datasets = datasets
+        self.tarball = tarball
+        self.filename = filename
+        self.name = "%s BSON %s" % (kind, self.operation)
+
+    def setup(self):
+        text = self.datasets.read(self.tarball, self.filename)
+        if text.startswith(GZIP_MAGIC):
+            text = self.datasets.read(LEGACY_TARBALL, self.filename)
+        self.size = len(text) * NUM_DOCS
+        self.document = self.codec.json_to_native(text.decode("utf-8"))
+
+
+class Encoding(BSONTask):
+    operation = "Encoding"
+
+    def do_task(self):
+        native_to_bson = self.codec.native_to_bson
+        document = self.document
+        for _ in range(NUM_DOCS):
+            native_to_bson(document)
+
+
+class Decoding(BSONTask):
+    operation = "Decoding"
+
+    def setup(self):
+        BSONTask.setup(self)
+        self.data = self.codec.native_to_bson(self.document)
+
+    def do_task(self):
+        bson_to_native = self.codec.bson_to_native
+        data = self.data
+        for _ in range(NUM_DOCS):
+            bson_to_native(data)
+
+
+def main():
+    parser = driverbench.parser(__doc__.split("\n\n")[0])
+    parser.add_argument("--codec", metavar="MODULE:NAME",
+                        help="codec to benchmark (default: PyMongo's bson package)")
+    parser.add_argument("--legacy-data", action="store_true",
+                        help="use the datasets in extended_bson_legacy.tgz")
+    options = parser.parse_args()
+
+    codec = load_codec(options.codec)
+    datasets = driverbench.Datasets()
+    tarball = LEGACY_TARBALL if options.legacy_data else "extended_bson"
+
+    tasks = []
+    for (kind, filename) in DATASETS:
+        for cls in (Encoding, Decoding):
+            tasks.append(cls(codec, datasets, tarball, kind, filename))
+
+    name = getattr(codec, "name", type(codec).__name__)
+    info = {"codec": name, "data": tarball}
+    if name == "pymongo":
+        import bson
+        import pymongo
+        info["version"] = pymongo.version
+        info["c_extension"] = bson.has_c()
+    try:
+        driverbench.run(driverbench.selected(tasks, options.tasks), options, info)
+    finally:
+        datasets.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,315 @@
+"""Run the Single-Doc and Multi-Doc micro-benchmarks in benchmarking.rst.
+
+Tasks load their datasets from data/single_and_multi_document.tgz and run
+against a server at --uri, or by default against a LocalServer from
+localmongod.py started in this process, so they can run without a mongod.
+
+Each task's setup connects a client and its teardown closes it. A client is
+any object with these methods, where db and coll are names:
+
+    json_to_native(text)                 JSON str -> native document
+    native_to_json(doc)                  native document -> JSON str
+    run_command(db, command)             run a command, return its reply
+    drop_database(db)
+    create_collection(db, coll)
+    drop_collection(db, coll)
+    insert_one(db, coll, doc)            may add an _id to doc
+    insert_many(db, coll, docs, ordered=True)
+                                         may add _ids to docs
+    find_one(db, coll, _id)              return the document with this _id
+    find_all(db, coll, filter=None)      iterate over every document, or
+                                         every one matching filter
+    gridfs_upload(db, filename, data)    upload data, bytes or a readable
+                                         file, to the default bucket and
+                                         return the file's _id
+    gridfs_download(db, file_id)         return the file's bytes
+    close()
+
+Use --client module:name to load one; name is called with the server's URI.
+The default uses PyMongo.
+"""
+
+import importlib
+import json
+import sys
+
+import driverbench
+
+TARBALL = "single_and_multi_document"
+DB = "perftest"
+COLL = "corpus"
+NUM_DOCS = 10000
+
+
+class PyMongoClient(object):
+    """A client using PyMongo and its gridfs package."""
+
+    name = "pymongo"
+
+    def __init__(self, uri):
+        try:
+            import gridfs
+            import pymongo
+            from bson import json_util
+        except ImportError:
+            sys.exit("the default client needs PyMongo (pip install pymongo), or use --client")
+        self._gridfs = gridfs
+        self._json_util = json_util
+        self.client = pymongo.MongoClient(uri)
+        self._collections = {}
+        self._buckets = {}
+
+    def collection(self, db, coll):
+        key = (db, coll)
+        if key not in self._collections:
+            self._collections[key] = self.client[db][coll]
+        return self._collections[key]
+
+    def bucket(self, db):
+        if db not in self._buckets:
+            self._buckets[db] = self._gridfs.GridFSBucket(self.client[db])
+        return self._buckets[db]
+
+    def json_to_native(self, text):
+        return json.loads(text)
+
+    def native_to_json(self, doc):
+        return self._json_util.dumps(doc)
+
+    def run_command(self, db, command):
+        return self.client[db].command(command)
+
+    def drop_database(self, db):
+        self.client.drop_database(db)
+        self._buckets.pop(db, None)
+
+    def create_collection(self, db, coll):
+        self.client[db].create_collection(coll)
+
+    def drop_collection(self, db, coll):
+        self.client[db].drop_collection(coll)
+
+    def insert_one(self, db, coll, doc):
+        self.collection(db, coll).insert_one(doc)
+
+    def insert_many(self, db, coll, docs, ordered=True):
+        self.collection(db, coll).insert_many(docs, ordered=ordered)
+
+    def find_one(self, db, coll, _id):
+        return self.collection(db, coll).find_one({"_id": _id})
+
+    def find_all(self, db, coll, filter=None):
+        return self.collection(db, coll).find(filter)
+
+    def gridfs_upload(self, db, filename, data):
+        return self.bucket(db).upload_from_stream(filename, data)
+
+    def gridfs_download(self, db, file_id):
+        return self.bucket(db).open_download_stream(file_id).read()
+
+    def close(self):
+        self.client.close()
+
+
+def load_client(spec):
+    if spec is None:
+        return PyMongoClient
+    module_name, _, attr = spec.partition(":")
+    if not attr:
+        sys.exit("--client must be module:name")
+    return getattr(importlib.import_module(module_name), attr)
+
+
+class ClientTask(driverbench.Task):
+    """A task that connects in setup and drops the database in teardown."""
+
+    filename = None
+    count = NUM_DOCS
+
+    def __init__(self, connect, datasets):
+        self.connect = connect
+        self.datasets = datasets
+
+    def setup(self):
+        self.client = self.connect()
+        self.client.drop_database(DB)
+        if self.filename:
+            data = self.datasets.read(TARBALL, self.filename)
+            self.size = len(data) * self.count
+            self.data = data
+
+    def load_document(self):
+        return self.client.json_to_native(self.data.decode("utf-8"))
+
+    def teardown(self):
+        self.client.drop_database(DB)
+        self.client.close()
+
+
+class RunCommand(ClientTask):
+    name = "Run command"
+    # 10,000 times the 16 bytes of {ismaster: true}.
+    size = 160000
+
+    def setup(self):
+        self.client = self.connect()
+
+    def do_task(self):
+        run_command = self.client.run_command
+        for _ in range(NUM_DOCS):
+            run_command("admin", {"ismaster": True})
+
+    def teardown(self):
+        self.client.close()
+
+
+class FindOneByID(ClientTask):
+    name = "Find one by ID"
+    filename = "tweet.json"
+
+    def setup(self):
+        ClientTask.setup(self)
+        document = self.load_document()
+        docs = []
+        for i in range(1, NUM_DOCS + 1):
+            doc = dict(document)
+            doc["_id"] = i
+            docs.append(doc)
+        self.client.insert_many(DB, COLL, docs)
+
+    def do_task(self):
+        find_one = self.client.find_one
+        for i in range(1, NUM_DOCS + 1):
+            find_one(DB, COLL, i)
+
+
+class InsertTask(ClientTask):
+    """Inserts count copies of a document into an empty collection."""
+
+    def setup(self):
+        ClientTask.setup(self)
+        self.document = self.load_document()
+
+    def before_task(self):
+        self.client.drop_collection(DB, COLL)
+        self.client.create_collection(DB, COLL)
+        # Fresh copies, since clients may add an _id to what they insert.
+        self.docs = [dict(self.document) for _ in range(self.count)]
+
+
+class InsertOne(InsertTask):
+    def do_task(self):
+        insert_one = self.client.insert_one
+        for doc in self.docs:
+            insert_one(DB, COLL, doc)
+
+
+class SmallDocInsertOne(InsertOne):
+    name = "Small doc insertOne"
+    filename = "small_doc.json"
+
+
+class LargeDocInsertOne(InsertOne):
+    name = "Large doc insertOne"
+    filename = "large_doc.json"
+    count = 10
+
+
+class FindMany(ClientTask):
+    name = "Find many and empty the cursor"
+    filename = "tweet.json"
+
+    def setup(self):
+        ClientTask.setup(self)
+        document = self.load_document()
+        self.client.insert_many(DB, COLL, [dict(document) for _ in range(NUM_DOCS)])
+
+    def do_task(self):
+        for _ in self.client.find_all(DB, COLL):
+            pass
+
+
+class BulkInsert(InsertTask):
+    def do_task(self):
+        self.client.insert_many(DB, COLL, self.docs)
+
+
+class SmallDocBulkInsert(BulkInsert):
+    name = "Small doc bulk insert"
+    filename = "small_doc.json"
+
+
+class LargeDocBulkInsert(BulkInsert):
+    name = "Large doc bulk insert"
+    filename = "large_doc.json"
+    count = 10
+
+
+class GridFSUpload(ClientTask):
+    name = "GridFS upload"
+    filename = "gridfs_large.bin"
+    count = 1
+
+    def before_task(self):
+        self.client.drop_collection(DB, "fs.files")
+        self.client.drop_collection(DB, "fs.chunks")
+        self.client.gridfs_upload(DB, "onebyte", b"\x00")
+
+    def do_task(self):
+        self.client.gridfs_upload(DB, "gridfstest", self.data)
+
+
+class GridFSDownload(ClientTask):
+    name = "GridFS download"
+    filename = "gridfs_large.bin"
+    count = 1
+
+    def setup(self):
+        ClientTask.setup(self)
+        self.file_id = self.client.gridfs_upload(DB, "gridfstest", self.data)
+
+    def do_task(self):
+        self.client.gridfs_download(DB, self.file_id)
+
+
+TASKS = [
+    RunCommand, FindOneByID, SmallDocInsertOne, LargeDocInsertOne,
+    FindMany, SmallDocBulkInsert, LargeDocBulkInsert, GridFSUpload, GridFSDownload,
+]
+
+
+def main():
+    parser = driverbench.parser(__doc__.split("\n\n")[0])
+    parser.add_argument("--uri",
+                        help="MongoDB URI of the server to use (default: start "
+                        "a localmongod.py server in this process)")
+    parser.add_argument("--client", metavar="MODULE:NAME",
+                        help="client to benchmark (default: PyMongo)")
+    options = parser.parse_args()
+
+    client_class = load_client(options.client)
+    server = None
+    uri = options.uri
+    if uri is None:
+        import localmongod
+        server = localmongod.LocalServer().start()
+        uri = server.uri
+
+    info = {"client": getattr(client_class, "name", client_class.__name__),
+            "server": "external" if options.uri else "localmongod"}
+    if info["client"] == "pymongo":
+        import pymongo
+        info["version"] = pymongo.version
+
+    datasets = driverbench.Datasets()
+    tasks = [cls(lambda: client_class(uri), datasets) for cls in TASKS]
+    try:
+        driverbench.run(driverbench.selected(tasks, options.tasks), options, info)
+    finally:
+        datasets.close()
+        if server is not None:
+            server.stop()
+
+
+if __name__ == "__main__":
+    main()
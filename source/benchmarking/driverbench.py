@@ -0,0 +1,325 @@
+"""Shared pieces of the Python DriverBench runners in this directory.
+
+Tasks follow the phases in benchmarking.rst: setup once, then for each
+iteration before_task, a timed do_task and after_task, then teardown. The
+runner times do_task with a monotonic clock, records the spec's percentiles
+using its nearest-rank rule and a histogram of the times, and scores each task
+as its size in MB over the median time. Composites average the tasks of theirs
+that were run, and say so when some were not. Results can be written to JSON
+and compared with an earlier run.
+
+Datasets are read from the tarballs in data/ when a task first asks for
+them, straight into memory, without extracting the tarballs to disk.
+"""
+
+import argparse
+import bisect
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tarfile
+import time
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+PERCENTILES = (10, 25, 50, 75, 90, 95, 98, 99)
+
+# Upper bounds, in seconds, of the iteration time histogram's buckets.
+BUCKETS = [m * 10.0 ** e for e in range(-6, 3) for m in (1, 2, 5)]
+
+# Composite name -> names of the tasks averaged into it.
+COMPOSITES = {
+    "BSONBench": [
+        "Flat BSON Encoding", "Flat BSON Decoding",
+        "Deep BSON Encoding", "Deep BSON Decoding",
+        "Full BSON Encoding", "Full BSON Decoding",
+    ],
+    "SingleBench": [
+        "Find one by ID", "Small doc insertOne", "Large doc insertOne",
+    ],
+    "MultiBench": [
+        "Find many and empty the cursor", "Small doc bulk insert",
+        "Large doc bulk insert", "GridFS upload", "GridFS download",
+    ],
+    "ParallelBench": [
+        "LDJSON multi-file import", "LDJSON multi-file export",
+        "GridFS multi-file upload", "GridFS multi-file download",
+    ],
+    "ReadBench": [
+        "Find one by ID", "Find many and empty the cursor", "GridFS download",
+        "LDJSON multi-file export", "GridFS multi-file download",
+    ],
+    "WriteBench": [
+        "Small doc insertOne", "Large doc insertOne", "Small doc bulk insert",
+        "Large doc bulk insert", "GridFS upload", "LDJSON multi-file import",
+        "GridFS multi-file upload",
+    ],
+}
+
+
+class Datasets(object):
+    """Files in the data/ tarballs, read into memory on first use.
+
+    Archives are scanned only as far as the file asked for, so reading
+    tweet.json doesn't decompress gridfs_large.bin.
+    """
+
+    def __init__(self, data_dir=DATA_DIR):
+        self.data_dir = data_dir
+        self._tarballs = {}
+        self._files = {}
+
+    def tarball(self, name):
+        if name not in self._tarballs:
+            self._tarballs[name] = tarfile.open(os.path.join(self.data_dir, name + ".tgz"))
+        return self._tarballs[name]
+
+    def _find(self, tarball, path):
+        # Every member is under one top directory, e.g. "extended_bson/".
+        for member in self.tarball(tarball):
+            if member.isfile() and member.name.split("/", 1)[1:] == [path]:
+                return member
+        raise KeyError("%s not in %s.tgz" % (path, tarball))
+
+    def read(self, tarball, path):
+        """Return the bytes of a file in a tarball, by its path under the
+        tarball's top directory, e.g. ("extended_bson", "flat_bson.json")."""
+        key = (tarball, path)
+        if key not in self._files:
+            t = self.tarball(tarball)
+            self._files[key] = t.extractfile(self._find(tarball, path)).read()
+        return self._files[key]
+
+    def extract(self, tarball, path, filename):
+        """Copy a file in a tarball to filename, without keeping it in memory."""
+        source = self.tarball(tarball).extractfile(self._find(tarball, path))
+        with open(filename, "wb") as f:
+            shutil.copyfileobj(source, f, 1024 * 1024)
+
+    def size(self, tarball, path):
+        return self._find(tarball, path).size
+
+    def members(self, tarball, directory):
+        """Return the paths of the files in a directory of a tarball."""
+        paths = [m.name.split("/", 1)[1] for m in self.tarball(tarball).getmembers()
+                 if m.isfile() and "/" in m.name]
+        return sorted(p for p in paths if p.startswith(directory + "/"))
+
+    def close(self):
+        for t in self._tarballs.values():
+            t.close()
+        self._tarballs.clear()
+
+
+class Task(object):
+    """A micro-benchmark. Subclasses set name and size (in bytes) and
+    implement do_task; the other phases are optional."""
+
+    name = None
+    size = 0
+
+    def setup(self):
+        pass
+
+    def before_task(self):
+        pass
+
+    def do_task(self):
+        raise NotImplementedError
+
+    def after_task(self):
+        pass
+
+    def teardown(self):
+        pass
+
+
+def percentile(times, p):
+    """The spec's nearest-rank percentile of ascending times."""
+    return times[max(0, int(len(times) * p / 100) - 1)]
+
+
+def histogram(times):
+    """Count ascending times into BUCKETS, as [upper bound, count] pairs
+    from the first bucket used to the last; the last bound may be None."""
+    counts = [0] * (len(BUCKETS) + 1)
+    for t in times:
+        counts[bisect.bisect_left(BUCKETS, t)] += 1
+    used = [i for (i, n) in enumerate(counts) if n]
+    bounds = BUCKETS + [None]
+    return [[bounds[i], counts[i]] for i in range(used[0], used[-1] + 1)]
+
+
+def format_seconds(s):
+    if s is None:
+        return "inf"
+    for (unit, scale) in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if s >= scale:
+            return "%g%s" % (round(s / scale, 3), unit)
+    return "%gs" % s
+
+
+def print_histogram(buckets):
+    most = max(n for (_, n) in buckets)
+    for (bound, n) in buckets:
+        print("    <= %-7s %-40s %d" % (format_seconds(bound), "#" * int(round(40.0 * n / most)), n))
+
+
+def measure(task, options):
+    """Run a task's iterations and return its result."""
+    task.setup()
+    try:
+        for _ in range(options.warmup):
+            task.before_task()
+            task.do_task()
+            task.after_task()
+
+        times = []
+        total = 0.0
+        while True:
+            task.before_task()
+            start = time.perf_counter()
+            task.do_task()
+            elapsed = time.perf_counter() - start
+            task.after_task()
+
+            times.append(elapsed)
+            total += elapsed
+            # At least min_time, and then stop after max_iterations or
+            # max_time, whichever comes first.
+            if len(times) >= options.max_iterations and total >= options.min_time:
+                break
+            if total >= options.max_time:
+                break
+    finally:
+        task.teardown()
+
+    times.sort()
+    median = percentile(times, 50)
+    return {
+        "name": task.name,
+        "size_mb": task.size / 1e6,
+        "iterations": len(times),
+        "percentiles": dict((str(p), percentile(times, p)) for p in PERCENTILES),
+        "histogram": histogram(times),
+        "score": task.size / 1e6 / median,
+    }
+
+
+def composite_scores(results):
+    """Average the scores of the tasks run from each composite.
+
+    Returns composite name -> {"score", "tasks", "of"}, where tasks is how
+    many of the composite's "of" tasks were run; a composite is complete
+    only when they are equal.
+    """
+    scores = dict((r["name"], r["score"]) for r in results)
+    composites = {}
+    for (name, tasks) in COMPOSITES.items():
+        ran = [scores[t] for t in tasks if t in scores]
+        if ran:
+            composites[name] = {"score": sum(ran) / len(ran), "tasks": len(ran), "of": len(tasks)}
+    if "ReadBench" in composites and "WriteBench" in composites:
+        read, write = composites["ReadBench"], composites["WriteBench"]
+        composites["DriverBench"] = {
+            "score": (read["score"] + write["score"]) / 2,
+            "tasks": read["tasks"] + write["tasks"],
+            "of": read["of"] + write["of"],
+        }
+    return composites
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def add_arguments(parser):
+    parser.add_argument("tasks", nargs="*",
+                        help="only run tasks whose names contain one of these "
+                        "strings (case-insensitive)")
+    parser.add_argument("--min-time", type=float, default=60,
+                        help="run each task for at least this many seconds (default: 60)")
+    parser.add_argument("--max-time", type=float, default=300,
+                        help="stop each task after this many seconds (default: 300)")
+    parser.add_argument("--max-iterations", type=int, default=100,
+                        help="stop each task after this many iterations, once "
+                        "--min-time has passed (default: 100)")
+    parser.add_argument("--warmup", type=int, default=1,
+                        help="untimed iterations before timing each task (default: 1)")
+    parser.add_argument("--json", metavar="FILE",
+                        help="write the results to FILE as JSON")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="compare the scores with an earlier --json FILE")
+    parser.add_argument("--label",
+                        help="a label for this run, saved with --json")
+    parser.add_argument("--histogram", action="store_true",
+                        help="print a histogram of each task's iteration times")
+
+
+def selected(tasks, patterns):
+    if not patterns:
+        return tasks
+    patterns = [p.lower() for p in patterns]
+    return [t for t in tasks if any(p in t.name.lower() for p in patterns)]
+
+
+def run(tasks, options, info=None):
+    """Measure tasks, print a table and write or compare JSON results."""
+    previous = None
+    if options.compare:
+        with open(options.compare) as f:
+            previous = json.load(f)
+        previous = dict((r["name"], r["score"]) for r in previous["results"])
+
+    results = []
+    print("%-32s %6s %10s %10s %10s %10s" % (
+        "task", "iters", "p10 (s)", "p50 (s)", "p90 (s)", "MB/s"))
+    for task in tasks:
+        r = measure(task, options)
+        results.append(r)
+        p = r["percentiles"]
+        line = "%-32s %6d %10.6f %10.6f %10.6f %10.2f" % (
+            r["name"], r["iterations"], p["10"], p["50"], p["90"], r["score"])
+        if previous and r["name"] in previous:
+            line += "  %+6.1f%%" % (100.0 * (r["score"] / previous[r["name"]] - 1))
+        print(line)
+        if options.histogram:
+            print_histogram(r["histogram"])
+        sys.stdout.flush()
+
+    composites = composite_scores(results)
+    for (name, c) in sorted(composites.items()):
+        line = "%-32s %50.2f" % (name, c["score"])
+        if c["tasks"] < c["of"]:
+            line += "  (%d of %d tasks)" % (c["tasks"], c["of"])
+        print(line)
+
+    if options.json:
+        output = {
+            "label": options.label,
+            "revision": git_revision(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "info": info or {},
+            "results": results,
+            "composites": composites,
+        }
+        with open(options.json, "w") as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+
+    return results
+
+
+def parser(description):
+    p = argparse.ArgumentParser(description=description)
+    add_arguments(p)
+    return p
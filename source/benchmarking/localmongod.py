@@ -0,0 +1,623 @@
+"""An in-process stand-in for mongod, for running the benchmarks offline.
+
+LocalServer listens on a local port in a background thread and answers the
+wire protocol (OP_MSG, and OP_QUERY for the first hello of a connection) with
+the commands the Single-Doc, Multi-Doc and Parallel tasks need: hello and
+isMaster, ping, buildInfo, endSessions, create, drop, dropDatabase, insert,
+delete, find, getMore, killCursors, createIndexes, listIndexes and
+listCollections.
+
+Documents are kept in memory as the BSON they were sent as. Queries support
+equality and the $eq, $ne, $gt, $gte, $lt, $lte and $in operators on dotted
+paths, $and and $or, sort, skip, limit, batchSize and top-level projections.
+Only the _id index is enforced; other indexes are recorded for listIndexes.
+
+It needs PyMongo's bson package. It is not a database: there are no
+transactions, write concerns or replication, and one lock serializes all
+commands. Scores against it measure the client plus this server, so compare
+them only with other runs against it.
+
+    python localmongod.py --port 27017
+"""
+
+import argparse
+import datetime
+import itertools
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+
+try:
+    import bson
+    from bson import Int64, ObjectId
+    from bson.raw_bson import RawBSONDocument
+except ImportError:
+    sys.exit("localmongod.py needs PyMongo's bson package (pip install pymongo)")
+
+OP_REPLY = 1
+OP_QUERY = 2004
+OP_MSG = 2013
+
+CHECKSUM_PRESENT = 1 << 0
+MORE_TO_COME = 1 << 1
+
+MAX_BSON_SIZE = 16 * 1024 * 1024
+MAX_MESSAGE_SIZE = 48000000
+MAX_WRITE_BATCH_SIZE = 100000
+MAX_WIRE_VERSION = 21
+DEFAULT_BATCH_SIZE = 101
+
+HEADER = struct.Struct("<iiii")
+INT32 = struct.Struct("<i")
+
+# BSON type -> size of a value of that type, for reading a leading _id
+# without decoding the rest of its document.
+FIXED_SIZES = {0x01: 8, 0x07: 12, 0x08: 1, 0x09: 8, 0x0A: 0, 0x10: 4,
+               0x11: 8, 0x12: 8, 0x13: 16, 0x7F: 0, 0xFF: 0}
+
+
+class CommandError(Exception):
+    def __init__(self, code, code_name, message):
+        Exception.__init__(self, message)
+        self.code = code
+        self.code_name = code_name
+
+
+def id_key(value):
+    """Return a dict key for an _id; equal numbers of any type share one."""
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return bson.encode({"": value})
+
+
+def leading_id(raw):
+    """Return the _id of a BSON document if it is the first field (as
+    drivers and mongod put it), else None."""
+    kind = raw[4]
+    if raw[5:9] != b"_id\x00":
+        return None
+    start = 9
+    if kind in FIXED_SIZES:
+        end = start + FIXED_SIZES[kind]
+    elif kind in (0x02, 0x0D, 0x0E):
+        end = start + 4 + INT32.unpack_from(raw, start)[0]
+    elif kind == 0x05:
+        end = start + 5 + INT32.unpack_from(raw, start)[0]
+    elif kind in (0x03, 0x04):
+        end = start + INT32.unpack_from(raw, start)[0]
+    else:
+        return RawBSONDocument(raw)["_id"]
+    element = raw[4:end]
+    return bson.decode(INT32.pack(len(element) + 5) + element + b"\x00")["_id"]
+
+
+def with_id(raw):
+    """Return raw, a BSON document, with a new ObjectId _id put first."""
+    element = b"\x07_id\x00" + ObjectId().binary
+    return INT32.pack(len(raw) + len(element)) + element + raw[4:]
+
+
+def get_path(doc, path):
+    value = doc
+    for part in path.split("."):
+        if isinstance(value, list) and part.isdigit() and int(part) < len(value):
+            value = value[int(part)]
+        elif hasattr(value, "get") and not isinstance(value, (str, bytes)):
+            value = value.get(part, Missing)
+        else:
+            return Missing
+        if value is Missing:
+            return Missing
+    return value
+
+
+class _Missing(object):
+    def __repr__(self):
+        return "Missing"
+
+
+Missing = _Missing()
+
+
+def compare(value, operand, test):
+    try:
+        return test(value, operand)
+    except TypeError:
+        return False
+
+
+def equals(value, operand):
+    if value is Missing:
+        return operand is None
+    if isinstance(value, list) and not isinstance(operand, list):
+        return any(v == operand for v in value)
+    return value == operand
+
+
+OPERATORS = {
+    "$eq": equals,
+    "$ne": lambda v, o: not equals(v, o),
+    "$gt": lambda v, o: v is not Missing and compare(v, o, lambda a, b: a > b),
+    "$gte": lambda v, o: v is not Missing and compare(v, o, lambda a, b: a >= b),
+    "$lt": lambda v, o: v is not Missing and compare(v, o, lambda a, b: a < b),
+    "$lte": lambda v, o: v is not Missing and compare(v, o, lambda a, b: a <= b),
+    "$in": lambda v, o: any(equals(v, x) for x in o),
+}
+
+
+def matches(doc, query):
+    for (key, condition) in query.items():
+        if key == "$and":
+            if not all(matches(doc, q) for q in condition):
+                return False
+        elif key == "$or":
+            if not any(matches(doc, q) for q in condition):
+                return False
+        elif key.startswith("$"):
+            raise CommandError(2, "BadValue", "unknown top level operator: %s" % key)
+        else:
+            value = get_path(doc, key)
+            if (isinstance(condition, dict) and condition
+                    and all(k.startswith("$") for k in condition)):
+                for (op, operand) in condition.items():
+                    if op not in OPERATORS:
+                        raise CommandError(2, "BadValue", "unknown operator: %s" % op)
+                    if not OPERATORS[op](value, operand):
+                        return False
+            elif not equals(value, condition):
+                return False
+    return True
+
+
+def sort_key(value):
+    # Order by type first, roughly as mongod does, so mixed types sort.
+    if value is Missing or value is None:
+        return (0, 0)
+    if isinstance(value, bool):
+        return (5, value)
+    if isinstance(value, (int, float, Int64)):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    if isinstance(value, ObjectId):
+        return (4, value.binary)
+    return (3, bson.encode({"": value}))
+
+
+def project(doc, projection):
+    if not projection:
+        return doc
+    include = [k for (k, v) in projection.items() if v and k != "_id"]
+    exclude = [k for (k, v) in projection.items() if not v]
+    if include:
+        keep = set(include)
+        if "_id" not in exclude:
+            keep.add("_id")
+        return dict((k, v) for (k, v) in doc.items() if k in keep)
+    return dict((k, v) for (k, v) in doc.items() if k not in exclude)
+
+
+class Collection(object):
+    def __init__(self):
+        # _id key -> RawBSONDocument, in insertion order.
+        self.documents = {}
+        self.indexes = [{"v": 2, "key": {"_id": 1}, "name": "_id_"}]
+
+    def insert(self, raw):
+        _id = leading_id(raw)
+        if _id is None:
+            doc = RawBSONDocument(raw)
+            if "_id" in doc:
+                _id = doc["_id"]
+            else:
+                raw = with_id(raw)
+                _id = leading_id(raw)
+        key = id_key(_id)
+        if key in self.documents:
+            raise CommandError(11000, "DuplicateKey",
+                               "E11000 duplicate key error dup key: { _id: %r }" % (_id,))
+        self.documents[key] = RawBSONDocument(raw)
+
+    def query(self, query):
+        if not query:
+            return list(self.documents.values())
+        # Use the _id index for {_id: value}, {_id: {$eq: value}} and
+        # {_id: {$in: [values]}}.
+        if len(query) == 1 and "_id" in query:
+            value = query["_id"]
+            if isinstance(value, dict) and list(value) == ["$eq"]:
+                value = value["$eq"]
+            if isinstance(value, dict) and list(value) == ["$in"]:
+                keys = dict.fromkeys(id_key(v) for v in value["$in"])
+                found = (self.documents.get(k) for k in keys)
+                return [d for d in found if d is not None]
+            if not (isinstance(value, dict) and any(k.startswith("$") for k in value)):
+                doc = self.documents.get(id_key(value))
+                return [doc] if doc is not None else []
+        return [d for d in self.documents.values() if matches(d, query)]
+
+    def delete(self, query, limit):
+        deleted = 0
+        for doc in self.query(query):
+            del self.documents[id_key(doc["_id"])]
+            deleted += 1
+            if limit and deleted >= limit:
+                break
+        return deleted
+
+
+class Store(object):
+    """The databases, collections and cursors of a LocalServer."""
+
+    def __init__(self):
+        self.databases = {}
+        self.cursors = {}
+        self.cursor_ids = itertools.count(1)
+        self.connection_ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def collection(self, db, name, create=True):
+        colls = self.databases.setdefault(db, {}) if create else self.databases.get(db, {})
+        if name not in colls and create:
+            colls[name] = Collection()
+        return colls.get(name)
+
+    def run(self, db, command, connection_id):
+        name = next(iter(command))
+        handler = COMMANDS.get(name.lower() if name.lower() in LOWERCASE else name)
+        try:
+            if handler is None:
+                raise CommandError(59, "CommandNotFound", "no such command: '%s'" % name)
+            with self.lock:
+                reply = handler(self, db, command, connection_id)
+        except CommandError as exc:
+            return {"ok": 0.0, "errmsg": str(exc), "code": exc.code, "codeName": exc.code_name}
+        reply["ok"] = 1.0
+        return reply
+
+    def cursor_batch(self, ns, documents, batch_size, first):
+        if not batch_size:
+            batch_size = DEFAULT_BATCH_SIZE if first else len(documents)
+        batch = []
+        size = 0
+        for doc in documents[:batch_size]:
+            size += len(doc.raw)
+            if batch and size > MAX_BSON_SIZE:
+                break
+            batch.append(doc)
+        rest = documents[len(batch):]
+        cursor_id = 0
+        if rest:
+            cursor_id = next(self.cursor_ids)
+            self.cursors[cursor_id] = (ns, rest)
+        return batch, Int64(cursor_id)
+
+
+def cmd_hello(store, db, command, connection_id):
+    reply = {
+        "helloOk": True,
+        "maxBsonObjectSize": MAX_BSON_SIZE,
+        "maxMessageSizeBytes": MAX_MESSAGE_SIZE,
+        "maxWriteBatchSize": MAX_WRITE_BATCH_SIZE,
+        "localTime": datetime.datetime.now(datetime.timezone.utc),
+        "logicalSessionTimeoutMinutes": 30,
+        "connectionId": connection_id,
+        "minWireVersion": 0,
+        "maxWireVersion": MAX_WIRE_VERSION,
+        "readOnly": False,
+    }
+    if "hello" in command:
+        reply["isWritablePrimary"] = True
+    else:
+        reply["ismaster"] = True
+    return reply
+
+
+def cmd_ping(store, db, command, connection_id):
+    return {}
+
+
+def cmd_build_info(store, db, command, connection_id):
+    return {"version": "7.0.0-localmongod", "versionArray": [7, 0, 0, 0],
+            "maxBsonObjectSize": MAX_BSON_SIZE}
+
+
+def cmd_create(store, db, command, connection_id):
+    name = command["create"]
+    if store.collection(db, name, create=False) is not None:
+        raise CommandError(48, "NamespaceExists", "Collection %s.%s already exists." % (db, name))
+    store.collection(db, name)
+    return {}
+
+
+def cmd_drop(store, db, command, connection_id):
+    store.databases.get(db, {}).pop(command["drop"], None)
+    return {"ns": "%s.%s" % (db, command["drop"])}
+
+
+def cmd_drop_database(store, db, command, connection_id):
+    store.databases.pop(db, None)
+    return {"dropped": db}
+
+
+def cmd_insert(store, db, command, connection_id):
+    coll = store.collection(db, command["insert"])
+    ordered = command.get("ordered", True)
+    n = 0
+    errors = []
+    for (i, doc) in enumerate(command.get("documents", [])):
+        raw = doc.raw if isinstance(doc, RawBSONDocument) else bson.encode(doc)
+        try:
+            coll.insert(raw)
+            n += 1
+        except CommandError as exc:
+            errors.append({"index": i, "code": exc.code, "errmsg": str(exc)})
+            if ordered:
+                break
+    reply = {"n": n}
+    if errors:
+        reply["writeErrors"] = errors
+    return reply
+
+
+def cmd_delete(store, db, command, connection_id):
+    coll = store.collection(db, command["delete"], create=False)
+    n = 0
+    if coll is not None:
+        for statement in command.get("deletes", []):
+            n += coll.delete(statement["q"], statement.get("limit", 0))
+    return {"n": n}
+
+
+def cmd_find(store, db, command, connection_id):
+    ns = "%s.%s" % (db, command["find"])
+    coll = store.collection(db, command["find"], create=False)
+    documents = coll.query(command.get("filter") or {}) if coll is not None else []
+    for (key, direction) in reversed(list((command.get("sort") or {}).items())):
+        documents.sort(key=lambda d: sort_key(get_path(d, key)), reverse=direction < 0)
+    skip = command.get("skip", 0)
+    limit = abs(command.get("limit", 0))
+    documents = documents[skip:skip + limit] if limit else documents[skip:]
+    projection = command.get("projection")
+    if projection:
+        documents = [RawBSONDocument(bson.encode(project(d, projection))) for d in documents]
+    batch_size = command.get("batchSize", 0)
+    if command.get("singleBatch"):
+        batch_size = len(documents)
+    batch, cursor_id = store.cursor_batch(ns, documents, batch_size, True)
+    return {"cursor": {"firstBatch": batch, "id": cursor_id, "ns": ns}}
+
+
+def cmd_get_more(store, db, command, connection_id):
+    cursor_id = int(command["getMore"])
+    if cursor_id not in store.cursors:
+        raise CommandError(43, "CursorNotFound", "cursor id %d not found" % cursor_id)
+    ns, documents = store.cursors.pop(cursor_id)
+    batch, next_id = store.cursor_batch(ns, documents, command.get("batchSize", 0), False)
+    if next_id:
+        # Keep the client's cursor id for the rest of the results.
+        store.cursors[cursor_id] = store.cursors.pop(int(next_id))
+        next_id = Int64(cursor_id)
+    return {"cursor": {"nextBatch": batch, "id": next_id, "ns": ns}}
+
+
+def cmd_kill_cursors(store, db, command, connection_id):
+    killed = []
+    not_found = []
+    for cursor_id in command.get("cursors", []):
+        if store.cursors.pop(int(cursor_id), None) is None:
+            not_found.append(cursor_id)
+        else:
+            killed.append(cursor_id)
+    return {"cursorsKilled": killed, "cursorsNotFound": not_found,
+            "cursorsAlive": [], "cursorsUnknown": []}
+
+
+def cmd_create_indexes(store, db, command, connection_id):
+    existed = store.collection(db, command["createIndexes"], create=False) is not None
+    coll = store.collection(db, command["createIndexes"])
+    before = len(coll.indexes)
+    names = set(i["name"] for i in coll.indexes)
+    for index in command.get("indexes", []):
+        if index["name"] not in names:
+            spec = {"v": 2}
+            spec.update(index)
+            coll.indexes.append(spec)
+            names.add(index["name"])
+    return {"createdCollectionAutomatically": not existed,
+            "numIndexesBefore": before, "numIndexesAfter": len(coll.indexes)}
+
+
+def cmd_list_indexes(store, db, command, connection_id):
+    ns = "%s.%s" % (db, command["listIndexes"])
+    coll = store.collection(db, command["listIndexes"], create=False)
+    if coll is None:
+        raise CommandError(26, "NamespaceNotFound", "ns does not exist: %s" % ns)
+    return {"cursor": {"firstBatch": coll.indexes, "id": Int64(0), "ns": ns}}
+
+
+def cmd_list_collections(store, db, command, connection_id):
+    infos = [{"name": name, "type": "collection", "options": {}, "info": {"readOnly": False}}
+             for name in store.databases.get(db, {})]
+    query = command.get("filter") or {}
+    infos = [i for i in infos if matches(i, query)]
+    return {"cursor": {"firstBatch": infos, "id": Int64(0), "ns": "%s.$cmd.listCollections" % db}}
+
+
+def cmd_end_sessions(store, db, command, connection_id):
+    return {}
+
+
+COMMANDS = {
+    "hello": cmd_hello,
+    "ismaster": cmd_hello,
+    "ping": cmd_ping,
+    "buildinfo": cmd_build_info,
+    "create": cmd_create,
+    "drop": cmd_drop,
+    "dropDatabase": cmd_drop_database,
+    "insert": cmd_insert,
+    "delete": cmd_delete,
+    "find": cmd_find,
+    "getMore": cmd_get_more,
+    "killCursors": cmd_kill_cursors,
+    "createIndexes": cmd_create_indexes,
+    "listIndexes": cmd_list_indexes,
+    "listCollections": cmd_list_collections,
+    "endSessions": cmd_end_sessions,
+}
+
+# Commands whose names mongod matches case-insensitively.
+LOWERCASE = ("ismaster", "buildinfo")
+
+
+def read_sections(data, flags):
+    """Return the command in an OP_MSG body, with any document sequences
+    added to it as lists of RawBSONDocument."""
+    end = len(data) - (4 if flags & CHECKSUM_PRESENT else 0)
+    pos = 4
+    command = None
+    sequences = []
+    while pos < end:
+        kind = data[pos]
+        pos += 1
+        size = INT32.unpack_from(data, pos)[0]
+        if kind == 0:
+            command = bson.decode(data[pos:pos + size])
+        else:
+            null = data.index(b"\x00", pos + 4)
+            identifier = bytes(data[pos + 4:null]).decode("utf-8")
+            docs = []
+            p = null + 1
+            while p < pos + size:
+                n = INT32.unpack_from(data, p)[0]
+                docs.append(RawBSONDocument(bytes(data[p:p + n])))
+                p += n
+            sequences.append((identifier, docs))
+        pos += size
+    for (identifier, docs) in sequences:
+        command.setdefault(identifier, []).extend(docs)
+    return command
+
+
+class Handler(socketserver.BaseRequestHandler):
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connection_id = next(self.server.store.connection_ids)
+
+    def read(self, n):
+        buf = bytearray(n)
+        view = memoryview(buf)
+        pos = 0
+        while pos < n:
+            got = self.request.recv_into(view[pos:])
+            if not got:
+                return None
+            pos += got
+        return buf
+
+    def handle(self):
+        store = self.server.store
+        while True:
+            header = self.read(16)
+            if header is None:
+                return
+            length, request_id, _, opcode = HEADER.unpack(header)
+            data = self.read(length - 16)
+            if data is None:
+                return
+            if opcode == OP_MSG:
+                flags = INT32.unpack_from(data, 0)[0]
+                command = read_sections(data, flags)
+                reply = store.run(command.pop("$db", "admin"), command, self.connection_id)
+                if flags & MORE_TO_COME:
+                    continue
+                body = b"\x00\x00\x00\x00\x00" + bson.encode(reply)
+                self.send(request_id, OP_MSG, body)
+            elif opcode == OP_QUERY:
+                null = data.index(b"\x00", 4)
+                namespace = bytes(data[4:null]).decode("utf-8")
+                pos = null + 9
+                size = INT32.unpack_from(data, pos)[0]
+                command = bson.decode(data[pos:pos + size])
+                if "$query" in command:
+                    command = command["$query"]
+                reply = store.run(namespace.split(".")[0], command, self.connection_id)
+                body = struct.pack("<iqii", 0, 0, 0, 1) + bson.encode(reply)
+                self.send(request_id, OP_REPLY, body)
+            else:
+                return
+
+    def send(self, response_to, opcode, body):
+        self.request.sendall(HEADER.pack(16 + len(body), 0, response_to, opcode) + body)
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class LocalServer(object):
+    """A stand-in mongod in a background thread:
+
+        with LocalServer() as server:
+            client = MongoClient(server.uri)
+    """
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.server = _TCPServer((host, port), Handler)
+        self.server.store = Store()
+        self.thread = None
+
+    @property
+    def address(self):
+        return self.server.server_address[:2]
+
+    @property
+    def uri(self):
+        return "mongodb://%s:%d/?directConnection=true" % self.address
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={"poll_interval": 0.1})
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=27017,
+                        help="port to listen on (default: 27017)")
+    args = parser.parse_args()
+
+    server = LocalServer(args.host, args.port).start()
+    print("listening on %s" % server.uri)
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
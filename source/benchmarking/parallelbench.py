@@ -0,0 +1,496 @@
+"""Run the Parallel micro-benchmarks in benchmarking.rst.
+
+The LDJSON multi-file import and export and GridFS multi-file upload and
+download tasks spread their files over a pool of workers, chosen with
+--backend:
+
+    thread     a thread pool sharing one client
+    process    a process pool with a client in each process
+    asyncio    coroutines on one event loop, with file I/O in threads
+
+--workers sets the pool size, or for asyncio the number of files in flight.
+With --read mmap, import and upload map each file instead of reading it into
+memory first: LDJSON lines are parsed straight from the map, and GridFS
+uploads read their chunks from it.
+
+The 100 LDJSON files are generated from tweet.json, 5,000 lines each, unless
+--ldjson tarball uses the ones in parallel.tgz; the 50 GridFS files are
+extracted from parallel.tgz. Both are written to --data-dir, where later runs
+reuse them; by default that is a temporary directory removed afterwards.
+
+Clients are as in docbench.py and must be safe to share between threads. The
+asyncio backend uses --async-client, whose methods other than json_to_native
+and native_to_json are coroutines; its default uses PyMongo's AsyncMongoClient.
+As in docbench.py, the tasks run against --uri or an in-process localmongod.
+"""
+
+import asyncio
+import concurrent.futures
+import json
+import mmap
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+
+import docbench
+import driverbench
+
+DB = docbench.DB
+COLL = docbench.COLL
+
+LDJSON_FILES = 100
+LDJSON_LINES = 5000
+
+# The client used by worker functions: shared by a thread pool, or one per
+# process in a process pool.
+_client = None
+
+
+def init_worker(client_spec, uri):
+    global _client
+    _client = docbench.load_client(client_spec)(uri)
+
+
+def init_process_worker(started, client_spec, uri):
+    """Set up a worker process, then wait for the rest at the barrier."""
+    try:
+        init_worker(client_spec, uri)
+    finally:
+        started.wait()
+
+
+def read_lines(path, use_mmap, parse):
+    """Return parse(line) for each line of an LDJSON file."""
+    with open(path, "rb") as f:
+        if not use_mmap:
+            return [parse(line) for line in f.read().splitlines()]
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return [parse(line.rstrip(b"\n")) for line in iter(m.readline, b"")]
+        finally:
+            m.close()
+
+
+def read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def write_file(path, chunks):
+    """Write chunks to path and flush them to disk."""
+    with open(path, "wb") as f:
+        for chunk in chunks:
+            f.write(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def ldjson_chunks(client, docs):
+    for doc in docs:
+        yield (client.native_to_json(doc) + "\n").encode("utf-8")
+
+
+def numbered(docs, first_id):
+    if first_id is not None:
+        for (i, doc) in enumerate(docs):
+            doc["_id"] = first_id + i
+    return docs
+
+
+def import_file(path, use_mmap, first_id=None):
+    """Insert the documents in an LDJSON file, numbering their _ids from
+    first_id if it is given. Returns how many there were."""
+    parse = lambda line: _client.json_to_native(line.decode("utf-8"))
+    docs = numbered(read_lines(path, use_mmap, parse), first_id)
+    _client.insert_many(DB, COLL, docs, ordered=False)
+    return len(docs)
+
+
+def export_file(first_id, count, path):
+    docs = _client.find_all(DB, COLL, {"_id": {"$in": list(range(first_id, first_id + count))}})
+    write_file(path, ldjson_chunks(_client, docs))
+
+
+def upload_file(path, use_mmap):
+    if not use_mmap:
+        return _client.gridfs_upload(DB, os.path.basename(path), read_file(path))
+    with open(path, "rb") as f:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return _client.gridfs_upload(DB, os.path.basename(path), m)
+        finally:
+            m.close()
+
+
+def download_file(file_id, path):
+    write_file(path, [_client.gridfs_download(DB, file_id)])
+
+
+async def import_file_async(client, path, use_mmap, first_id=None):
+    parse = lambda line: client.json_to_native(line.decode("utf-8"))
+    docs = await asyncio.to_thread(read_lines, path, use_mmap, parse)
+    await client.insert_many(DB, COLL, numbered(docs, first_id), ordered=False)
+    return len(docs)
+
+
+async def export_file_async(client, first_id, count, path):
+    docs = await client.find_all(DB, COLL, {"_id": {"$in": list(range(first_id, first_id + count))}})
+    await asyncio.to_thread(write_file, path, list(ldjson_chunks(client, docs)))
+
+
+async def upload_file_async(client, path, use_mmap):
+    if not use_mmap:
+        data = await asyncio.to_thread(read_file, path)
+        return await client.gridfs_upload(DB, os.path.basename(path), data)
+    with open(path, "rb") as f:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return await client.gridfs_upload(DB, os.path.basename(path), m)
+        finally:
+            m.close()
+
+
+async def download_file_async(client, file_id, path):
+    data = await client.gridfs_download(DB, file_id)
+    await asyncio.to_thread(write_file, path, [data])
+
+
+ASYNC_WORKERS = {
+    import_file: import_file_async,
+    export_file: export_file_async,
+    upload_file: upload_file_async,
+    download_file: download_file_async,
+}
+
+
+class AsyncPyMongoClient(object):
+    """The --async-client counterpart of docbench.PyMongoClient, using
+    PyMongo's AsyncMongoClient and gridfs.AsyncGridFSBucket."""
+
+    name = "pymongo-async"
+
+    def __init__(self, uri):
+        try:
+            import pymongo
+            from bson import json_util
+            from gridfs import AsyncGridFSBucket
+        except ImportError:
+            sys.exit("the default async client needs PyMongo 4.9 or later, or use --async-client")
+        self._json_util = json_util
+        self._bucket_class = AsyncGridFSBucket
+        self.client = pymongo.AsyncMongoClient(uri)
+        self._buckets = {}
+
+    def bucket(self, db):
+        if db not in self._buckets:
+            self._buckets[db] = self._bucket_class(self.client[db])
+        return self._buckets[db]
+
+    def json_to_native(self, text):
+        return json.loads(text)
+
+    def native_to_json(self, doc):
+        return self._json_util.dumps(doc)
+
+    async def insert_many(self, db, coll, docs, ordered=True):
+        await self.client[db][coll].insert_many(docs, ordered=ordered)
+
+    async def find_all(self, db, coll, filter=None):
+        return await self.client[db][coll].find(filter).to_list()
+
+    async def gridfs_upload(self, db, filename, data):
+        return await self.bucket(db).upload_from_stream(filename, data)
+
+    async def gridfs_download(self, db, file_id):
+        stream = await self.bucket(db).open_download_stream(file_id)
+        return await stream.read()
+
+    async def close(self):
+        await self.client.close()
+
+
+class PoolBackend(object):
+    def map(self, fn, args):
+        """Call fn with each tuple in args and return the results in order."""
+        return list(self.pool.map(fn, *zip(*args)))
+
+
+class ThreadBackend(PoolBackend):
+    def __init__(self, options, uri):
+        init_worker(options.client, uri)
+        self.pool = concurrent.futures.ThreadPoolExecutor(options.workers)
+
+    def close(self):
+        self.pool.shutdown()
+        _client.close()
+
+
+class ProcessBackend(PoolBackend):
+    def __init__(self, options, uri):
+        # Spawn rather than fork: the parent has client and server threads.
+        context = multiprocessing.get_context("spawn")
+        started = context.Barrier(options.workers + 1)
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            options.workers, mp_context=context,
+            initializer=init_process_worker,
+            initargs=(started, options.client, uri))
+        # Workers start on demand. Submit one task per worker to start them
+        # all, and wait until each has connected, so no timed iteration pays
+        # for spawning an interpreter and creating a client.
+        futures = [self.pool.submit(os.getpid) for _ in range(options.workers)]
+        started.wait()
+        for future in futures:
+            future.result()
+
+    def close(self):
+        self.pool.shutdown()
+
+
+class AsyncioBackend(object):
+    def __init__(self, options, uri):
+        self.loop = asyncio.new_event_loop()
+        self.workers = options.workers
+        self.client = self.loop.run_until_complete(
+            self._connect(load_async_client(options.async_client), uri))
+
+    async def _connect(self, client_class, uri):
+        # Clients bind to the running loop when they're created.
+        return client_class(uri)
+
+    def map(self, fn, args):
+        worker = ASYNC_WORKERS[fn]
+        limit = asyncio.Semaphore(self.workers)
+
+        async def call(a):
+            async with limit:
+                return await worker(self.client, *a)
+
+        async def call_all():
+            return await asyncio.gather(*[call(a) for a in args])
+
+        return self.loop.run_until_complete(call_all())
+
+    def close(self):
+        self.loop.run_until_complete(self.client.close())
+        self.loop.close()
+
+
+BACKENDS = {
+    "thread": ThreadBackend,
+    "process": ProcessBackend,
+    "asyncio": AsyncioBackend,
+}
+
+
+def load_async_client(spec):
+    if spec is None:
+        return AsyncPyMongoClient
+    return docbench.load_client(spec)
+
+
+def prepare_data(datasets, data_dir, ldjson_source, limit):
+    """Write the datasets to data_dir unless they're already there, and
+    return the paths of the LDJSON and GridFS files."""
+    ldjson_dir = os.path.join(data_dir, "ldjson_multi")
+    gridfs_dir = os.path.join(data_dir, "gridfs_multi")
+    for d in (ldjson_dir, gridfs_dir):
+        if not os.path.isdir(d):
+            os.makedirs(d)
+
+    ldjson = []
+    if ldjson_source == "tweet":
+        tweet = datasets.read(docbench.TARBALL, "tweet.json").strip() + b"\n"
+        for i in range(LDJSON_FILES):
+            path = os.path.join(ldjson_dir, "ldjson%03d.txt" % i)
+            if not os.path.exists(path) or os.path.getsize(path) != len(tweet) * LDJSON_LINES:
+                write_file(path, [tweet * LDJSON_LINES])
+            ldjson.append(path)
+    else:
+        for name in datasets.members("parallel", "ldjson_multi"):
+            path = os.path.join(data_dir, name)
+            if not os.path.exists(path) or os.path.getsize(path) != datasets.size("parallel", name):
+                datasets.extract("parallel", name, path)
+            ldjson.append(path)
+
+    gridfs = []
+    for name in datasets.members("parallel", "gridfs_multi"):
+        path = os.path.join(data_dir, name)
+        if not os.path.exists(path) or os.path.getsize(path) != datasets.size("parallel", name):
+            datasets.extract("parallel", name, path)
+        gridfs.append(path)
+
+    if limit:
+        ldjson, gridfs = ldjson[:limit], gridfs[:limit]
+    return ldjson, gridfs
+
+
+def empty_directory(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+
+
+class ParallelTask(driverbench.Task):
+    """A task that maps its files over a backend's workers."""
+
+    def __init__(self, connect, make_backend, files, options, output_dir):
+        self.connect = connect
+        self.make_backend = make_backend
+        self.files = files
+        self.use_mmap = options.read == "mmap"
+        self.output_dir = output_dir
+        self.size = sum(os.path.getsize(f) for f in files)
+
+    def setup(self):
+        self.client = self.connect()
+        self.client.drop_database(DB)
+        self.backend = self.make_backend()
+
+    def teardown(self):
+        self.backend.close()
+        self.client.drop_database(DB)
+        self.client.close()
+
+
+class LDJSONImport(ParallelTask):
+    name = "LDJSON multi-file import"
+
+    def before_task(self):
+        self.client.drop_collection(DB, COLL)
+        self.client.create_collection(DB, COLL)
+
+    def do_task(self):
+        self.backend.map(import_file, [(path, self.use_mmap) for path in self.files])
+
+
+class LDJSONExport(ParallelTask):
+    name = "LDJSON multi-file export"
+
+    def setup(self):
+        ParallelTask.setup(self)
+        # Number the documents so that each file's worker can ask for its
+        # share by _id; which documents go in which file doesn't matter.
+        first_ids = []
+        first_id = 0
+        for path in self.files:
+            first_ids.append(first_id)
+            with open(path, "rb") as f:
+                first_id += sum(1 for _ in f)
+        self.client.drop_collection(DB, COLL)
+        counts = self.backend.map(import_file, [
+            (path, self.use_mmap, i) for (path, i) in zip(self.files, first_ids)])
+        self.shares = [
+            (i, n, os.path.join(self.output_dir, "ldjson%03d.txt" % k))
+            for (k, (i, n)) in enumerate(zip(first_ids, counts))]
+
+    def before_task(self):
+        empty_directory(self.output_dir)
+
+    def do_task(self):
+        self.backend.map(export_file, self.shares)
+
+
+class GridFSMultiUpload(ParallelTask):
+    name = "GridFS multi-file upload"
+
+    def before_task(self):
+        self.client.drop_collection(DB, "fs.files")
+        self.client.drop_collection(DB, "fs.chunks")
+        self.client.gridfs_upload(DB, "onebyte", b"\x00")
+
+    def do_task(self):
+        self.backend.map(upload_file, [(path, self.use_mmap) for path in self.files])
+
+
+class GridFSMultiDownload(ParallelTask):
+    name = "GridFS multi-file download"
+
+    def setup(self):
+        ParallelTask.setup(self)
+        file_ids = self.backend.map(upload_file, [(path, self.use_mmap) for path in self.files])
+        self.downloads = [
+            (file_id, os.path.join(self.output_dir, os.path.basename(path)))
+            for (file_id, path) in zip(file_ids, self.files)]
+
+    def before_task(self):
+        empty_directory(self.output_dir)
+
+    def do_task(self):
+        self.backend.map(download_file, self.downloads)
+
+
+def main():
+    parser = driverbench.parser(__doc__.split("\n\n")[0])
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="thread",
+                        help="how to run the workers (default: thread)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="number of workers (default: the number of CPUs)")
+    parser.add_argument("--read", choices=("read", "mmap"), default="read",
+                        help="how import and upload read their files (default: read)")
+    parser.add_argument("--ldjson", choices=("tweet", "tarball"), default="tweet",
+                        help="generate the LDJSON files from tweet.json, or use "
+                        "the ones in parallel.tgz (default: tweet)")
+    parser.add_argument("--limit-files", type=int, metavar="N",
+                        help="use only the first N files of each dataset, for "
+                        "quick runs whose scores aren't comparable with full ones")
+    parser.add_argument("--data-dir",
+                        help="where to keep the datasets and outputs (default: "
+                        "a temporary directory)")
+    parser.add_argument("--uri",
+                        help="MongoDB URI of the server to use (default: start "
+                        "a localmongod.py server in this process)")
+    parser.add_argument("--client", metavar="MODULE:NAME",
+                        help="client for setup and the thread and process "
+                        "backends (default: PyMongo)")
+    parser.add_argument("--async-client", metavar="MODULE:NAME",
+                        help="client for the asyncio backend (default: "
+                        "PyMongo's AsyncMongoClient)")
+    options = parser.parse_args()
+
+    client_class = docbench.load_client(options.client)
+    data_dir = options.data_dir or tempfile.mkdtemp(prefix="parallelbench-")
+    datasets = driverbench.Datasets()
+    server = None
+    try:
+        ldjson, gridfs = prepare_data(datasets, data_dir, options.ldjson, options.limit_files)
+        datasets.close()
+
+        uri = options.uri
+        if uri is None:
+            import localmongod
+            server = localmongod.LocalServer().start()
+            uri = server.uri
+
+        connect = lambda: client_class(uri)
+        make_backend = lambda: BACKENDS[options.backend](options, uri)
+        exports = os.path.join(data_dir, "export")
+        downloads = os.path.join(data_dir, "downloads")
+        tasks = [
+            LDJSONImport(connect, make_backend, ldjson, options, None),
+            LDJSONExport(connect, make_backend, ldjson, options, exports),
+            GridFSMultiUpload(connect, make_backend, gridfs, options, None),
+            GridFSMultiDownload(connect, make_backend, gridfs, options, downloads),
+        ]
+
+        info = {"backend": options.backend, "workers": options.workers,
+                "read": options.read, "ldjson": options.ldjson,
+                "files": options.limit_files,
+                "server": "external" if options.uri else "localmongod"}
+        if options.backend == "asyncio":
+            client = load_async_client(options.async_client)
+        else:
+            client = client_class
+        info["client"] = getattr(client, "name", client.__name__)
+        driverbench.run(driverbench.selected(tasks, options.tasks), options, info)
+    finally:
+        datasets.close()
+        if server is not None:
+            server.stop()
+        if not options.data_dir:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,638 @@
+"""Dump BSON documents with color output showing structure.
+
+A Python companion to tests/bsonview, with the same annotated output: each
+element's type, key, lengths and value, colored by role and shown in red
+where they are malformed.
+
+Documents are read through memoryview and struct.unpack_from offsets into
+the input, so subdocuments are never copied, and --file maps the file with
+mmap; a multi-GB dump such as a mongodump .bson file is dumped in constant
+memory. --path prints only the element at a dotted path like a.b.0.c, found
+without decoding the rest of the document, and --grep only the documents
+(or path elements) whose raw bytes match a regular expression.
+
+    echo "0900000010610005000000" | python bsonview.py -x
+    python bsonview.py --file dump/test/coll.bson --path user.name
+
+The LazyDocument class gives the same lazy access from Python.
+"""
+
+import argparse
+import mmap
+import os
+import re
+import struct
+import sys
+import unicodedata
+
+NULL = 0
+
+INT32 = struct.Struct("<i")
+INT64 = struct.Struct("<q")
+DOUBLE = struct.Struct("<d")
+
+# Minimum field size. Decimal128 (0x13) isn't listed, as in tests/bsonview.
+FIELD_SIZES = {
+    0x01: 8,
+    0x02: 5,
+    0x03: 5,
+    0x04: 5,
+    0x05: 5,
+    0x06: 0,
+    0x07: 12,
+    0x08: 1,
+    0x09: 8,
+    0x0A: 0,
+    0x0B: 2,
+    0x0C: 17,
+    0x0D: 5,
+    0x0E: 5,
+    0x0F: 14,
+    0x10: 4,
+    0x11: 8,
+    0x12: 8,
+    0x7F: 0,
+    0xFF: 0,
+}
+
+FIXED_SIZES = {0x01: 8, 0x07: 12, 0x09: 8, 0x10: 4, 0x11: 8, 0x12: 8}
+
+COLORS = {
+    "red": 31,
+    "green": 32,
+    "yellow": 33,
+    "blue": 34,
+    "magenta": 35,
+    "cyan": 36,
+}
+
+######################################################################
+# Annotated output.
+
+
+class Window(object):
+    """The unread part of a BSON string: data[pos:end].
+
+    take() consumes bytes from the front and returns them as a new Window,
+    like substr($$ref, 0, $n, '') in tests/bsonview, without copying.
+    """
+
+    __slots__ = ("data", "view", "pos", "end")
+
+    def __init__(self, data, view, pos, end):
+        self.data = data
+        self.view = view
+        self.pos = pos
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.pos
+
+    def take(self, n):
+        if n < 0:
+            n = max(0, len(self) + n)
+        start = self.pos
+        self.pos = min(self.end, start + n)
+        return Window(self.data, self.view, start, self.pos)
+
+    def byte(self, i=0):
+        return self.view[self.pos + i]
+
+    def find_null(self, start=0):
+        i = self.data.find(b"\x00", self.pos + start, self.end)
+        return -1 if i == -1 else i - self.pos
+
+    def int32(self):
+        return INT32.unpack_from(self.view, self.pos)[0]
+
+    def tobytes(self):
+        return self.view[self.pos:self.end].tobytes()
+
+    def hex(self):
+        return self.view[self.pos:self.end].hex()
+
+
+def escape_bytes(b):
+    # Keys, regexes: bytes outside printable ASCII are escaped.
+    return re.sub(rb"[^\x21-\x7e]", lambda m: b"\\x%02x" % m.group()[0], b).decode("ascii")
+
+
+def is_graph(c):
+    return not c.isspace() and unicodedata.category(c) not in ("Cc", "Cs", "Cn")
+
+
+def escape_text(s):
+    # Decoded strings: characters that aren't graphic are escaped.
+    if s.isascii():
+        return escape_bytes(s.encode("ascii"))
+    return "".join(c if is_graph(c) else "\\x%02x" % ord(c) for c in s)
+
+
+class Printer(object):
+    """Writes the annotated dump, colored as tests/bsonview colors it."""
+
+    def __init__(self, out, color=True):
+        self.out = out
+        self.color = color
+
+    def write(self, text):
+        self.out.write(text)
+
+    def colored(self, color, text):
+        if self.color:
+            text = "\x1b[%dm%s\x1b[0m" % (COLORS[color], text)
+        self.out.write(text)
+
+    def error(self, text):
+        self.colored("red", text)
+
+    def type(self, t, color="magenta"):
+        self.colored(color, " %02x" % t)
+
+    def key(self, key):
+        self.string(escape_bytes(key), "yellow")
+
+    def string(self, s, color="green"):
+        self.colored(color, ' "%s" 00' % s)
+
+    def length(self, n, color="cyan"):
+        self.colored(color, " " + INT32.pack(n).hex())
+
+    def hex(self, w, color="green"):
+        self.colored(color, " " + w.hex().upper())
+
+
+def get_length(p, w, adj=0):
+    b = w.take(4)
+    if len(b) < 4:
+        return None
+    n = b.int32()
+
+    # check if requested length is too long
+    if n < 0 or n > len(w) + adj:
+        p.length(n, "red")
+        return None
+
+    return n
+
+
+def get_string(p, w):
+    n = get_length(p, w)
+    if n is None:
+        return None
+
+    # len must be at least 1 for trailing 0x00
+    if n == 0:
+        p.length(n, "red")
+        return None
+
+    s = w.take(n)
+
+    # check if null terminated
+    if s.byte(len(s) - 1) != NULL:
+        p.length(n)
+        p.hex(s, "red")
+        return None
+
+    try:
+        text = s.view[s.pos:s.end - 1].tobytes().decode("utf-8", "surrogatepass")
+    except UnicodeDecodeError:
+        p.length(n)
+        p.hex(s, "red")
+        return None
+
+    return n, text
+
+
+def dump_document(p, w, is_array=None):
+    if is_array is not None:
+        p.write(" [" if is_array else " {")
+    dump_header(p, w)
+    while dump_field(p, w):
+        pass
+    if len(w):
+        p.error(" " + w.hex())
+    if is_array is not None:
+        p.write(" ]" if is_array else " }")
+
+
+def dump_header(p, w):
+    n = get_length(p, w, 4)
+    if n is None:
+        return
+
+    if n < 5 or n < len(w) + 4:
+        p.length(n, "red")
+    else:
+        p.length(n, "blue")
+
+
+def dump_field(p, w):
+    # detect end of document
+    if len(w) < 2:
+        if len(w) == 0:
+            p.error(" [missing terminator]")
+        else:
+            end = w.take(1)
+            p.hex(end, "blue" if end.byte() == NULL else "red")
+        return False
+
+    t = w.take(1).byte()
+
+    if t not in FIELD_SIZES:
+        p.type(t, "red")
+        return False
+
+    p.type(t)
+
+    # check for key termination
+    key_end = w.find_null()
+    if key_end == -1:
+        return False
+
+    key = w.take(key_end + 1)
+    p.key(key.view[key.pos:key.end - 1].tobytes())
+
+    # Check if there is enough data to complete field for this type
+    min_size = FIELD_SIZES[t]
+    if len(w) < min_size:
+        return False
+
+    # fields without payload: 0x06, 0x0A, 0x7F, 0xFF
+    if min_size == 0:
+        return True
+
+    # document or array
+    if t == 0x03 or t == 0x04:
+        doc = w.take(w.int32())
+        dump_document(p, doc, t == 0x04)
+        return True
+
+    # fixed width fields
+    if t in FIXED_SIZES:
+        p.hex(w.take(FIXED_SIZES[t]))
+        return True
+
+    # boolean
+    if t == 0x08:
+        b = w.take(1)
+        p.hex(b, "green" if b.byte() in (0, 1) else "red")
+        return True
+
+    # binary field
+    if t == 0x05:
+        n = get_length(p, w, -1)
+        subtype = w.take(1)
+
+        if n is None:
+            p.hex(subtype)
+            return False
+
+        binary = w.take(n)
+
+        p.length(n)
+        p.hex(subtype)
+
+        if subtype.byte() == 0x02:
+            bin_len = get_length(p, binary)
+            if bin_len is None:
+                p.hex(binary, "red")
+                return False
+            if bin_len != len(binary):
+                p.length(bin_len, "red")
+                p.hex(binary, "red")
+                return False
+
+        if len(binary):
+            p.hex(binary)
+        return True
+
+    # string or symbol or code
+    if t == 0x02 or t == 0x0E or t == 0x0D:
+        s = get_string(p, w)
+        if s is None:
+            return False
+
+        p.length(s[0], "cyan")
+        p.string(escape_text(s[1]))
+        return True
+
+    # regex 0x0B
+    if t == 0x0B:
+        pattern_end = w.find_null()
+        if pattern_end == -1:
+            pattern, flags = w.tobytes(), b""
+        else:
+            flags_end = w.find_null(pattern_end + 1)
+            if flags_end == -1:
+                flags_end = len(w)
+            pattern = w.view[w.pos:w.pos + pattern_end].tobytes()
+            flags = w.view[w.pos + pattern_end + 1:w.pos + flags_end].tobytes()
+        w.take(len(pattern) + len(flags) + 2)
+        p.string(escape_bytes(pattern))
+        p.string(escape_bytes(flags))
+        return True
+
+    # code with scope 0x0F
+    if t == 0x0F:
+        n = get_length(p, w, 4)
+        if n is None:
+            return False
+
+        # len + string + doc minimum size is 4 + 5 + 5
+        if n < 14:
+            p.length(n, "red")
+            return False
+
+        p.length(n)
+
+        cws = w.take(n - 4)
+
+        s = get_string(p, cws)
+        if s is None:
+            p.hex(cws, "red")
+            return False
+
+        p.length(s[0])
+        p.string(escape_text(s[1]))
+
+        dump_document(p, cws, False)
+
+        return True
+
+    # dbpointer 0x0C
+    if t == 0x0C:
+        s = get_string(p, w)
+        if s is None:
+            return False
+
+        p.length(s[0])
+        p.string(escape_text(s[1]))
+
+        # Check if there are 12 bytes (plus terminator) or more
+        if len(w) < 13:
+            return False
+
+        p.hex(w.take(12))
+
+        return True
+
+    raise AssertionError("Shouldn't reach here")
+
+
+######################################################################
+# Lazy access.
+
+
+def iter_documents(data, start=0, end=None):
+    """Yield (start, end) offsets of the documents concatenated in data."""
+    view = memoryview(data)
+    end = len(data) if end is None else end
+    pos = start
+    while pos < end:
+        n = INT32.unpack_from(view, pos)[0] if end - pos >= 4 else 0
+        if n <= 0:
+            # Not a document; the rest is dumped as one malformed document.
+            n = end - pos
+        yield pos, min(end, pos + n)
+        pos += n
+
+
+def find_null(data, start):
+    i = data.find(b"\x00", start)
+    if i == -1:
+        raise ValueError("unterminated string at offset %d" % start)
+    return i
+
+
+def value_size(data, view, t, pos):
+    """Return the size of a value of type t at pos."""
+    if t in FIXED_SIZES:
+        return FIXED_SIZES[t]
+    if t in (0x02, 0x0D, 0x0E):
+        return 4 + INT32.unpack_from(view, pos)[0]
+    if t in (0x03, 0x04, 0x0F):
+        return INT32.unpack_from(view, pos)[0]
+    if t == 0x05:
+        return 5 + INT32.unpack_from(view, pos)[0]
+    if t in (0x06, 0x0A, 0x7F, 0xFF):
+        return 0
+    if t == 0x08:
+        return 1
+    if t == 0x0B:
+        flags = find_null(data, pos) + 1
+        return find_null(data, flags) + 1 - pos
+    if t == 0x0C:
+        return 4 + INT32.unpack_from(view, pos)[0] + 12
+    if t == 0x13:
+        return 16
+    raise ValueError("unknown BSON type 0x%02x at offset %d" % (t, pos - 1))
+
+
+def iter_elements(data, view, start):
+    """Yield (type, key, element start, value start, value end) for the
+    elements of the document at start."""
+    end = start + INT32.unpack_from(view, start)[0] - 1
+    pos = start + 4
+    while pos < end:
+        t = view[pos]
+        key_end = find_null(data, pos + 1)
+        value = key_end + 1
+        value_end = value + value_size(data, view, t, value)
+        yield t, view[pos + 1:key_end], pos, value, value_end
+        pos = value_end
+
+
+def find_path(data, view, start, path):
+    """Return (type, element start, value start, value end) of the element
+    at a dotted path in the document at start, or None."""
+    for depth, key in enumerate(path):
+        for (t, k, element, value, value_end) in iter_elements(data, view, start):
+            if k == key:
+                break
+        else:
+            return None
+        if depth == len(path) - 1:
+            return t, element, value, value_end
+        if t not in (0x03, 0x04):
+            return None
+        start = value
+    return None
+
+
+def split_path(path):
+    return [key.encode("utf-8") for key in path.split(".")]
+
+
+class LazyDocument(object):
+    """A read-only view of a BSON document in a buffer.
+
+    Elements are found by scanning the document when they are asked for;
+    subdocuments and arrays are LazyDocuments over the same buffer.
+    """
+
+    def __init__(self, data, start=0):
+        self._data = data
+        self._view = memoryview(data)
+        self._start = start
+
+    def __iter__(self):
+        for (t, key, element, value, value_end) in iter_elements(self._data, self._view, self._start):
+            yield key.tobytes().decode("utf-8")
+
+    def items(self):
+        for (t, key, element, value, value_end) in iter_elements(self._data, self._view, self._start):
+            yield key.tobytes().decode("utf-8"), self._value(t, value, value_end)
+
+    def __getitem__(self, key):
+        return self.get_path([key.encode("utf-8")])
+
+    def get(self, path, default=None):
+        """Return the value at a dotted path like "a.b.0.c"."""
+        try:
+            return self.get_path(split_path(path))
+        except KeyError:
+            return default
+
+    def get_path(self, path):
+        found = find_path(self._data, self._view, self._start, path)
+        if found is None:
+            raise KeyError(b".".join(path).decode("utf-8"))
+        t, element, value, value_end = found
+        return self._value(t, value, value_end)
+
+    def raw(self):
+        end = self._start + INT32.unpack_from(self._view, self._start)[0]
+        return self._view[self._start:end]
+
+    def _value(self, t, pos, end):
+        view = self._view
+        if t == 0x01:
+            return DOUBLE.unpack_from(view, pos)[0]
+        if t in (0x02, 0x0D, 0x0E):
+            return view[pos + 4:end - 1].tobytes().decode("utf-8")
+        if t in (0x03, 0x04):
+            return LazyDocument(self._data, pos)
+        if t == 0x05:
+            return view[pos + 5:end]
+        if t == 0x08:
+            return view[pos] == 1
+        if t in (0x06, 0x0A, 0x7F, 0xFF):
+            return None
+        if t == 0x10:
+            return INT32.unpack_from(view, pos)[0]
+        if t in (0x09, 0x12):
+            return INT64.unpack_from(view, pos)[0]
+        # Other types are returned as their raw bytes.
+        return view[pos:end]
+
+
+######################################################################
+
+
+class Filter(object):
+    """The --path and --grep options."""
+
+    def __init__(self, args):
+        self.path = args.path and split_path(args.path)
+        self.pattern = args.grep and re.compile(args.grep.encode("utf-8"))
+
+    def dump(self, p, data, view, start, end):
+        """Dump the document at data[start:end], or its element at the path."""
+        if self.path:
+            try:
+                found = find_path(data, view, start, self.path)
+            except (ValueError, IndexError, struct.error):
+                found = None
+            if found is None:
+                return
+            t, start, value, end = found
+        if self.pattern and not self.pattern.search(view[start:end]):
+            return
+        w = Window(data, view, start, end)
+        if self.path:
+            dump_field(p, w)
+        else:
+            dump_document(p, w)
+        p.write("\n")
+
+
+def dump_buffer(p, data, selected):
+    view = memoryview(data)
+    for (start, end) in iter_documents(data):
+        selected.dump(p, data, view, start, end)
+
+
+def dump_stdin(p, stdin, selected):
+    # Documents are read one at a time, since standard input can't be mapped.
+    while True:
+        header = stdin.read(4)
+        if not header:
+            return
+        n = INT32.unpack(header)[0] if len(header) == 4 else 0
+        data = header + stdin.read(n - 4) if n > 4 else header + stdin.read()
+        selected.dump(p, data, memoryview(data), 0, len(data))
+
+
+def dump_hex_lines(p, lines, selected):
+    for line in lines:
+        line = line.rstrip("\n")
+        if not line:
+            p.error("[ no document ]\n")
+            continue
+        # in -x mode, treat leading # as a comment
+        if line.startswith("#"):
+            p.write(line + "\n")
+            continue
+        line = line.replace(" ", "")
+        if len(line) % 2:
+            line += "0"
+        data = bytes.fromhex(line)
+        selected.dump(p, data, memoryview(data), 0, len(data))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--file",
+                        help="read documents from this BSON file, mapped with mmap")
+    parser.add_argument("-x", action="store_true",
+                        help="standard input is one hex document per line")
+    parser.add_argument("--path",
+                        help="only dump the element at this dotted path, like a.b.0.c")
+    parser.add_argument("--grep", metavar="REGEX",
+                        help="only dump documents (or --path elements) whose raw "
+                        "bytes match this regular expression")
+    parser.add_argument("--no-color", action="store_true",
+                        help="don't color the output")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    color = not (args.no_color or "ANSI_COLORS_DISABLED" in os.environ
+                 or "NO_COLOR" in os.environ)
+    out = open(sys.stdout.fileno(), "w", encoding="utf-8", errors="surrogatepass",
+               buffering=1 << 16, closefd=False)
+    p = Printer(out, color)
+    selected = Filter(args)
+
+    try:
+        if args.file:
+            with open(args.file, "rb") as f:
+                if os.fstat(f.fileno()).st_size:
+                    # Unmapped at exit; views into it may still be alive here.
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    dump_buffer(p, data, selected)
+        elif args.x:
+            dump_hex_lines(p, sys.stdin, selected)
+        else:
+            dump_stdin(p, sys.stdin.buffer, selected)
+        out.flush()
+    except BrokenPipeError:
+        # Output piped to head, etc.; don't fail flushing at exit too.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
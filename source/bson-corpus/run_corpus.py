@@ -0,0 +1,325 @@
+"""Run the BSON corpus against a Python codec and time it.
+
+Loads the valid, decodeErrors and parseErrors cases in tests/*.json, checks
+the assertions the spec gives for codecs with a language-native
+representation, and times decoding and encoding each valid case's
+canonical_bson for a number of iterations.
+
+A codec is any object with these methods:
+
+    bson_to_native(data)                     bytes -> native document
+    native_to_bson(doc)                      native document -> bytes
+    native_to_canonical_extended_json(doc)   native document -> str
+    native_to_relaxed_extended_json(doc)     native document -> str
+    json_to_native(text)                     Extended JSON str -> native document
+    parse_decimal128(string)                 str -> Decimal128 value
+
+Decoding and parsing must raise an exception for the error cases. Use
+--codec module:name to load one; name is called with no arguments. The
+default is PyMongo's bson package.
+"""
+
+import argparse
+import binascii
+import glob
+import importlib
+import json
+import os
+import sys
+import time
+from collections import OrderedDict
+
+TESTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tests")
+
+
+class PyMongoCodec(object):
+    """The codec in PyMongo's bson package."""
+
+    name = "pymongo"
+
+    def __init__(self):
+        try:
+            import bson
+            from bson import json_util
+            from bson.codec_options import CodecOptions, DatetimeConversion
+            from bson.decimal128 import Decimal128
+        except ImportError:
+            sys.exit("the default codec needs PyMongo's bson package "
+                     "(pip install pymongo), or use --codec")
+
+        self._bson = bson
+        self._json_util = json_util
+        self._decimal128 = Decimal128
+        # Keep subtype 4 binaries and out of range dates as they are.
+        self._codec_options = CodecOptions(
+            document_class=OrderedDict,
+            datetime_conversion=DatetimeConversion.DATETIME_AUTO)
+        self._canonical = json_util.JSONOptions(
+            json_mode=json_util.JSONMode.CANONICAL,
+            document_class=OrderedDict,
+            datetime_conversion=DatetimeConversion.DATETIME_AUTO)
+        self._relaxed = json_util.JSONOptions(
+            json_mode=json_util.JSONMode.RELAXED,
+            document_class=OrderedDict,
+            datetime_conversion=DatetimeConversion.DATETIME_AUTO)
+
+    def bson_to_native(self, data):
+        return self._bson.decode(data, self._codec_options)
+
+    def native_to_bson(self, doc):
+        return self._bson.encode(doc, codec_options=self._codec_options)
+
+    def native_to_canonical_extended_json(self, doc):
+        return self._json_util.dumps(doc, json_options=self._canonical)
+
+    def native_to_relaxed_extended_json(self, doc):
+        return self._json_util.dumps(doc, json_options=self._relaxed)
+
+    def json_to_native(self, text):
+        return self._json_util.loads(text, json_options=self._canonical)
+
+    def parse_decimal128(self, string):
+        return self._decimal128(string)
+
+
+def load_codec(spec):
+    if spec is None:
+        return PyMongoCodec()
+    module_name, _, attr = spec.partition(":")
+    if not attr:
+        sys.exit("--codec must be module:name")
+    return getattr(importlib.import_module(module_name), attr)()
+
+
+def normalize_pairs(pairs):
+    # Finite doubles have many string forms ("1.23456789012345677E+18" is
+    # 1.2345678901234568e+18), so compare Python's shortest repr of each.
+    if len(pairs) == 1 and pairs[0][0] == "$numberDouble":
+        value = pairs[0][1]
+        if isinstance(value, str) and value not in ("Infinity", "-Infinity", "NaN"):
+            try:
+                value = repr(float(value))
+            except ValueError:
+                pass
+        return OrderedDict([("$numberDouble", value)])
+    return OrderedDict(pairs)
+
+
+def normalize_json(text):
+    # Compare Extended JSON after undoing differences in whitespace and
+    # escaping; key order is kept, since it is significant in BSON.
+    return json.dumps(json.loads(text, object_pairs_hook=normalize_pairs))
+
+
+def unhex(s):
+    return binascii.unhexlify(s.encode("ascii"))
+
+
+class Checker(object):
+    """Runs one file's cases against a codec and collects failures."""
+
+    def __init__(self, codec, filename):
+        self.codec = codec
+        self.filename = filename
+        self.passed = 0
+        self.failures = []
+
+    def fail(self, case, message):
+        self.failures.append("%s: %s: %s" % (self.filename, case["description"], message))
+
+    def expect(self, case, assertion, expected, compute):
+        try:
+            actual = compute()
+        except Exception as exc:
+            self.fail(case, "%s raised %s: %s" % (assertion, type(exc).__name__, exc))
+            return False
+        if actual != expected:
+            self.fail(case, "%s: expected %s, got %s" % (assertion, expected, actual))
+            return False
+        return True
+
+    def expect_error(self, case, assertion, compute):
+        try:
+            compute()
+        except Exception:
+            return True
+        self.fail(case, "%s did not raise an error" % assertion)
+        return False
+
+    def valid(self, case):
+        codec = self.codec
+        cB = unhex(case["canonical_bson"])
+        cEJ = normalize_json(case["canonical_extjson"])
+        rEJ = case.get("relaxed_extjson")
+        rEJ = rEJ and normalize_json(rEJ)
+        lossy = case.get("lossy", False)
+
+        def to_canonical(doc):
+            return normalize_json(codec.native_to_canonical_extended_json(doc))
+
+        def to_relaxed(doc):
+            return normalize_json(codec.native_to_relaxed_extended_json(doc))
+
+        checks = [
+            ("native_to_bson(bson_to_native(cB))", cB,
+             lambda: codec.native_to_bson(codec.bson_to_native(cB))),
+            ("native_to_canonical_extended_json(bson_to_native(cB))", cEJ,
+             lambda: to_canonical(codec.bson_to_native(cB))),
+            ("native_to_canonical_extended_json(json_to_native(cEJ))", cEJ,
+             lambda: to_canonical(codec.json_to_native(cEJ))),
+        ]
+        if rEJ is not None:
+            checks.append(("native_to_relaxed_extended_json(bson_to_native(cB))", rEJ,
+                           lambda: to_relaxed(codec.bson_to_native(cB))))
+            checks.append(("native_to_relaxed_extended_json(json_to_native(rEJ))", rEJ,
+                           lambda: to_relaxed(codec.json_to_native(rEJ))))
+        if not lossy:
+            checks.append(("native_to_bson(json_to_native(cEJ))", cB,
+                           lambda: codec.native_to_bson(codec.json_to_native(cEJ))))
+
+        if "degenerate_bson" in case:
+            dB = unhex(case["degenerate_bson"])
+            checks.append(("native_to_bson(bson_to_native(dB))", cB,
+                           lambda: codec.native_to_bson(codec.bson_to_native(dB))))
+        if "degenerate_extjson" in case:
+            dEJ = case["degenerate_extjson"]
+            checks.append(("native_to_canonical_extended_json(json_to_native(dEJ))", cEJ,
+                           lambda: to_canonical(codec.json_to_native(dEJ))))
+            if not lossy:
+                checks.append(("native_to_bson(json_to_native(dEJ))", cB,
+                               lambda: codec.native_to_bson(codec.json_to_native(dEJ))))
+
+        ok = True
+        for (assertion, expected, compute) in checks:
+            ok = self.expect(case, assertion, expected, compute) and ok
+        return ok
+
+    def decode_error(self, case):
+        data = unhex(case["bson"])
+        return self.expect_error(case, "bson_to_native(bson)",
+                                 lambda: self.codec.bson_to_native(data))
+
+    def parse_error(self, bson_type, case):
+        if bson_type == "0x00":
+            return self.expect_error(case, "json_to_native(string)",
+                                     lambda: self.codec.json_to_native(case["string"]))
+        if bson_type == "0x13":
+            return self.expect_error(case, "parse_decimal128(string)",
+                                     lambda: self.codec.parse_decimal128(case["string"]))
+        # No other type defines how to use its parse errors.
+        return True
+
+    def run(self, suite):
+        bson_type = suite["bson_type"]
+        for case in suite.get("valid", []):
+            self.passed += self.valid(case)
+        for case in suite.get("decodeErrors", []):
+            self.passed += self.decode_error(case)
+        for case in suite.get("parseErrors", []):
+            self.passed += self.parse_error(bson_type, case)
+
+
+def time_case(codec, data, iterations):
+    """Return seconds to decode and to encode data, iterations times each."""
+    bson_to_native = codec.bson_to_native
+    native_to_bson = codec.native_to_bson
+    loop = range(iterations)
+
+    start = time.perf_counter()
+    for _ in loop:
+        doc = bson_to_native(data)
+    decode = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in loop:
+        native_to_bson(doc)
+    encode = time.perf_counter() - start
+
+    return decode, encode
+
+
+def time_suite(codec, suite, iterations):
+    """Return (cases, bytes, decode seconds, encode seconds) for the valid
+    cases that the codec can decode."""
+    cases = size = 0
+    decode = encode = 0.0
+    for case in suite.get("valid", []):
+        data = unhex(case["canonical_bson"])
+        try:
+            d, e = time_case(codec, data, iterations)
+        except Exception:
+            continue
+        cases += 1
+        size += len(data)
+        decode += d
+        encode += e
+    return cases, size, decode, encode
+
+
+def rate(count, seconds):
+    return count / seconds if seconds else 0.0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("files", nargs="*",
+                        help="corpus files (default: every file in tests/)")
+    parser.add_argument("--codec", metavar="MODULE:NAME",
+                        help="codec to test (default: PyMongo's bson package)")
+    parser.add_argument("--iterations", type=int, default=1000,
+                        help="times to decode and encode each valid case "
+                        "for the throughput table; 0 skips timing "
+                        "(default: 1000)")
+    parser.add_argument("--deprecated", action="store_true",
+                        help="also run the files for deprecated types")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="print every failure, not only the count per file")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    codec = load_codec(args.codec)
+    files = args.files or sorted(glob.glob(os.path.join(TESTS_DIR, "*.json")))
+
+    rows = []
+    failures = 0
+    for path in files:
+        with open(path) as f:
+            suite = json.load(f, object_pairs_hook=OrderedDict)
+        name = os.path.splitext(os.path.basename(path))[0]
+        if suite.get("deprecated") and not args.deprecated:
+            continue
+
+        checker = Checker(codec, name)
+        checker.run(suite)
+        failures += len(checker.failures)
+        if args.verbose:
+            for failure in checker.failures:
+                print("FAIL %s" % failure)
+
+        timing = time_suite(codec, suite, args.iterations) if args.iterations else None
+        rows.append((name, checker.passed, len(checker.failures), timing))
+
+    header = "%-28s %6s %6s" % ("file", "passed", "failed")
+    if args.iterations:
+        header += " %11s %11s %11s %11s" % ("decode/s", "decode MB/s", "encode/s", "encode MB/s")
+    print(header)
+    for (name, passed, failed, timing) in rows:
+        line = "%-28s %6d %6d" % (name, passed, failed)
+        if timing and timing[0]:
+            cases, size, decode, encode = timing
+            ops = cases * args.iterations
+            mb = size * args.iterations / 1e6
+            line += " %11.0f %11.2f %11.0f %11.2f" % (
+                rate(ops, decode), rate(mb, decode), rate(ops, encode), rate(mb, encode))
+        print(line)
+
+    print("%s: %d passed, %d failed" % (
+        getattr(codec, "name", type(codec).__name__),
+        sum(r[1] for r in rows), failures))
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
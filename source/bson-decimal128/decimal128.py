@@ -0,0 +1,352 @@
+"""Batched Decimal128 conversion with NumPy.
+
+Converts arrays of BSON Decimal128 values to and from strings, following
+"To String Representation" and "From String Representation" in
+decimal128.rst, and to and from decimal.Decimal.
+
+Values are 16-byte payloads in BSON's byte order, held in arrays of the
+PAYLOAD dtype (a "low" and a "high" little-endian uint64), so a buffer of
+concatenated BSON Decimal128 values can be read with payloads(). Whole
+arrays are converted with NumPy when coefficients fit in 64 bits and the
+string has no exponent, which covers most money columns; other values are
+converted one at a time, exactly, in Python.
+
+Run as a script to check every case in the bson-corpus decimal128 files,
+and with --benchmark N to time N values against per-value conversion.
+"""
+
+import argparse
+import decimal
+import glob
+import json
+import os
+import random
+import re
+import sys
+import time
+
+import numpy as np
+
+PAYLOAD = np.dtype([("low", "<u8"), ("high", "<u8")])
+
+# Longest string form, e.g. "-1.234567890123456789012345678901234E-6176".
+STRING = np.dtype("U42")
+
+EXPONENT_BIAS = 6176
+MAX_DIGITS = 34
+MAX_COEFFICIENT = 10 ** MAX_DIGITS - 1
+
+SIGN = 1 << 63
+INFINITY = 0x7800000000000000
+NAN = 0x7C00000000000000
+SNAN = 0x7E00000000000000
+COEFFICIENT_HIGH = (1 << 49) - 1
+LOW = (1 << 64) - 1
+
+# Plain decimals up to this many digits have a uint64 coefficient.
+FAST_DIGITS = 19
+POWERS = np.array([10 ** i for i in range(FAST_DIGITS + 1)], dtype=np.uint64)
+
+# Rounding that would be inexact, overflow and invalid strings are errors;
+# clamping and exact rounding are not.
+CONTEXT = decimal.Context(
+    prec=MAX_DIGITS, Emin=-6143, Emax=6144, rounding=decimal.ROUND_HALF_EVEN,
+    capitals=1, clamp=1,
+    traps=[decimal.InvalidOperation, decimal.Overflow, decimal.Inexact])
+
+# The numeric-string grammar. decimal.Decimal also accepts whitespace,
+# underscores and non-ASCII digits, which the spec doesn't.
+NUMERIC_STRING = re.compile(
+    r"[+-]?(?:(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?"
+    r"|(?i:inf|infinity|s?nan[0-9]*))", re.ASCII)
+
+
+def payloads(buffer):
+    """View a buffer of concatenated 16-byte Decimal128 values as an array."""
+    return np.frombuffer(buffer, dtype=PAYLOAD)
+
+
+######################################################################
+# One value at a time.
+
+
+def format_decimal(sign, coefficient, exponent):
+    digits = str(coefficient)
+    adjusted = exponent + len(digits) - 1
+    if exponent <= 0 and adjusted >= -6:
+        if exponent == 0:
+            return sign + digits
+        if len(digits) <= -exponent:
+            digits = "0" * (1 - exponent - len(digits)) + digits
+        point = len(digits) + exponent
+        return sign + digits[:point] + "." + digits[point:]
+
+    if len(digits) > 1:
+        digits = digits[0] + "." + digits[1:]
+    return "%s%sE%+d" % (sign, digits, adjusted)
+
+
+def decode(high, low):
+    """Return the string form of the Decimal128 value with these words."""
+    sign = "-" if high & SIGN else ""
+    combination = (high >> 58) & 0x1F
+    if combination == 0x1F:
+        return "NaN"
+    if combination == 0x1E:
+        return sign + "Infinity"
+
+    if (high >> 61) & 3 == 3:
+        # The implied 0b100 coefficient prefix makes it over 10**34 - 1.
+        exponent = ((high >> 47) & 0x3FFF) - EXPONENT_BIAS
+        coefficient = 0
+    else:
+        exponent = ((high >> 49) & 0x3FFF) - EXPONENT_BIAS
+        coefficient = ((high & COEFFICIENT_HIGH) << 64) | low
+        if coefficient > MAX_COEFFICIENT:
+            # Non-canonical coefficients are treated as zero.
+            coefficient = 0
+
+    return format_decimal(sign, coefficient, exponent)
+
+
+def encode_decimal(value):
+    """Return the (high, low) words of a decimal.Decimal that fits exactly."""
+    sign, digits, exponent = value.as_tuple()
+    high = SIGN if sign else 0
+    if value.is_nan():
+        return high | (SNAN if value.is_snan() else NAN), 0
+    if value.is_infinite():
+        return high | INFINITY, 0
+
+    coefficient = int("".join(map(str, digits)))
+    high |= ((exponent + EXPONENT_BIAS) << 49) | (coefficient >> 64)
+    return high, coefficient & LOW
+
+
+def encode(string):
+    """Return the (high, low) words of a numeric string.
+
+    Raises ValueError if the string isn't a numeric string, or its value
+    can't be stored without overflow or inexact rounding.
+    """
+    if not NUMERIC_STRING.fullmatch(string):
+        raise ValueError("invalid Decimal128 string: %r" % (string,))
+    try:
+        value = CONTEXT.create_decimal(string)
+    except decimal.DecimalException as exc:
+        raise ValueError("can't store %r as a Decimal128: %s" % (
+            string, type(exc).__name__))
+    return encode_decimal(value)
+
+
+######################################################################
+# Whole arrays.
+
+
+def to_strings(values, fast=True):
+    """Return an array of the string forms of an array of payloads."""
+    values = np.asarray(values, dtype=PAYLOAD)
+    high = values["high"].reshape(-1)
+    low = values["low"].reshape(-1)
+    out = np.empty(high.shape, dtype=STRING)
+
+    exponent = ((high >> 49) & 0x3FFF).astype(np.int64) - EXPONENT_BIAS
+    plain = np.zeros(high.shape, dtype=bool)
+    if fast:
+        # A canonical uint64 coefficient, written without exponential
+        # notation: the exponent is at most 0 and the adjusted exponent is
+        # at least -6.
+        plain = (((high >> 61) & 3) != 3) & ((high & COEFFICIENT_HIGH) == 0) \
+            & (exponent <= 0) & (exponent >= -FAST_DIGITS)
+        plain &= (exponent >= -6) | (low >= POWERS[np.clip(-6 - exponent, 0, FAST_DIGITS)])
+
+    for e in np.unique(exponent[plain]):
+        rows = np.flatnonzero(plain & (exponent == e))
+        c = low[rows]
+        if e == 0:
+            strings = c.astype("U20")
+        else:
+            scale = POWERS[-e]
+            strings = np.char.add(np.char.add((c // scale).astype("U20"), "."),
+                                  np.char.zfill((c % scale).astype("U20"), -e))
+        negative = (high[rows] & SIGN) != 0
+        out[rows] = np.where(negative, np.char.add("-", strings), strings)
+
+    for i in np.flatnonzero(~plain):
+        out[i] = decode(int(high[i]), int(low[i]))
+
+    return out.reshape(values.shape)
+
+
+def from_strings(strings, fast=True):
+    """Return an array of payloads for an array of numeric strings.
+
+    Raises ValueError for the first string that can't be stored.
+    """
+    strings = np.asarray(strings, dtype=str)
+    out = np.empty(strings.shape, dtype=PAYLOAD)
+    flat = strings.reshape(-1)
+    flat_out = out.reshape(-1)
+    n = flat.size
+
+    simple = np.zeros(n, dtype=bool)
+    if fast and n and flat.dtype.itemsize:
+        # An optional sign and up to 19 ASCII digits with an optional point.
+        codes = flat.view(np.uint32).reshape(n, -1)
+        ascii = (codes < 128).all(axis=1)
+        negative = np.char.startswith(flat, "-")
+        body = np.char.lstrip(flat, "+-")
+        one_sign = np.char.str_len(flat) - np.char.str_len(body) <= 1
+        parts = np.char.partition(body, ".")
+        digits = np.char.add(parts[:, 0], parts[:, 2])
+        ndigits = np.char.str_len(digits)
+        simple = ascii & one_sign & (ndigits > 0) & (ndigits <= FAST_DIGITS) \
+            & np.char.isdigit(digits)
+
+        rows = np.flatnonzero(simple)
+        scale = np.char.str_len(parts[rows, 2]).astype(np.uint64)
+        sign = np.where(negative[rows], np.uint64(SIGN), np.uint64(0))
+        flat_out["high"][rows] = ((EXPONENT_BIAS - scale) << 49) | sign
+        flat_out["low"][rows] = digits[rows].astype(np.uint64)
+
+    for i in np.flatnonzero(~simple):
+        try:
+            high, low = encode(str(flat[i]))
+        except ValueError as exc:
+            raise ValueError("at index %d: %s" % (i, exc))
+        flat_out[i] = (low, high)
+
+    return out
+
+
+def to_decimals(values):
+    """Return an object array of decimal.Decimal values.
+
+    Values are converted through their string form, so NaNs lose their sign
+    and payload, as in the spec's string conversion.
+    """
+    return np.frompyfunc(decimal.Decimal, 1, 1)(to_strings(values))
+
+
+def from_decimals(values):
+    """Return an array of payloads for decimal.Decimal values (or anything
+    whose str() is a numeric string)."""
+    return from_strings([str(v) for v in values])
+
+
+######################################################################
+# Checking against the corpus.
+
+
+def load_cases(corpus_dir):
+    valid, parse_errors = [], []
+    for path in sorted(glob.glob(os.path.join(corpus_dir, "decimal128-*.json"))):
+        with open(path) as f:
+            suite = json.load(f)
+        key = suite["test_key"]
+        offset = 4 + 1 + len(key) + 1
+        for case in suite.get("valid", []):
+            bson = bytes.fromhex(case["canonical_bson"])
+            degenerate = case.get("degenerate_extjson")
+            valid.append({
+                "description": "%s: %s" % (os.path.basename(path), case["description"]),
+                "payload": bson[offset:offset + 16],
+                "string": json.loads(case["canonical_extjson"])[key]["$numberDecimal"],
+                "degenerate": degenerate and json.loads(degenerate)[key]["$numberDecimal"],
+                "lossy": case.get("lossy", False),
+            })
+        for case in suite.get("parseErrors", []):
+            parse_errors.append(("%s: %s" % (os.path.basename(path), case["description"]),
+                                 case["string"]))
+    return valid, parse_errors
+
+
+def check_corpus(corpus_dir):
+    """Check every decimal128 corpus case, with and without the fast paths.
+    Return the number of failures."""
+    valid, parse_errors = load_cases(corpus_dir)
+    expected = payloads(b"".join(c["payload"] for c in valid))
+    failures = []
+
+    def compare(what, actual, wanted, cases):
+        for (case, a, w) in zip(cases, actual, wanted):
+            if a != w:
+                failures.append("%s: %s: expected %r, got %r" % (case["description"], what, w, a))
+
+    exact = [c for c in valid if not c["lossy"]]
+    exact_payloads = payloads(b"".join(c["payload"] for c in exact))
+    degenerate = [c for c in exact if c["degenerate"]]
+
+    for fast in (True, False):
+        path = "fast" if fast else "exact"
+        compare("to_strings (%s)" % path, to_strings(expected, fast),
+                [c["string"] for c in valid], valid)
+        compare("from_strings (%s)" % path, from_strings([c["string"] for c in exact], fast),
+                exact_payloads, exact)
+        compare("from_strings of degenerate string (%s)" % path,
+                from_strings([c["degenerate"] for c in degenerate], fast),
+                payloads(b"".join(c["payload"] for c in degenerate)), degenerate)
+    compare("from_decimals(to_decimals())", from_decimals(to_decimals(exact_payloads)),
+            exact_payloads, exact)
+
+    for (description, string) in parse_errors:
+        for fast in (True, False):
+            try:
+                from_strings([string], fast)
+            except ValueError:
+                continue
+            failures.append("%s: from_strings(%r) did not raise an error" % (description, string))
+
+    for failure in failures:
+        print(failure)
+    print("checked %d valid cases and %d parse errors: %d failures" % (
+        len(valid), len(parse_errors), len(failures)))
+    return len(failures)
+
+
+def benchmark(n, seed):
+    # Prices in cents, and rates with four decimal places.
+    rng = random.Random(seed)
+    strings = ["%d.%02d" % (rng.randrange(-10 ** 9, 10 ** 9), rng.randrange(100))
+               if i % 4 else "%d.%04d" % (rng.randrange(100), rng.randrange(10 ** 4))
+               for i in range(n)]
+    values = from_strings(strings)
+
+    def timed(label, per_value, batched):
+        start = time.perf_counter()
+        per_value()
+        slow = time.perf_counter() - start
+        start = time.perf_counter()
+        batched()
+        fast = time.perf_counter() - start
+        print("%-14s per value %10.0f/s   batched %10.0f/s   %5.1fx" % (
+            label, n / slow, n / fast, slow / fast))
+
+    timed("from_strings", lambda: [encode(s) for s in strings],
+          lambda: from_strings(strings))
+    timed("to_strings", lambda: [decode(int(h), int(l)) for (l, h) in values.tolist()],
+          lambda: to_strings(values))
+    decimals = [decimal.Decimal(s) for s in strings]
+    timed("from_decimals", lambda: [encode_decimal(CONTEXT.create_decimal(d)) for d in decimals],
+          lambda: from_decimals(decimals))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--corpus", default=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..", "bson-corpus", "tests"),
+        help="directory with the decimal128-*.json corpus files")
+    parser.add_argument("--benchmark", type=int, metavar="N",
+                        help="also time converting N values")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed for the --benchmark values")
+    args = parser.parse_args()
+
+    failures = check_corpus(args.corpus)
+    if args.benchmark:
+        benchmark(args.benchmark, args.seed)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,16 @@
+import argparse
+import base64
+import hashlib
+import itertools
 import json
-import sys
 import os
 
 description = """Generates the data and JSON Schema for the corpus test in the target directory.
-"""
-
-if len(sys.argv) != 2:
-    print(description)
-    print("usage: python generate-corpus.py <target directory>")
-    print("example: python ./generate-corpus.py ./")
-    sys.exit(1)
 
-targetdir = sys.argv[1]
+The axes of the test matrix and the number of padding cases can be changed with
+a JSON config file and command line options, e.g. to generate large corpora for
+load testing. Fields are written to disk as they are generated.
+"""
 
 # Generate test data from this matrix of axes.
 axes = [
@@ -43,15 +42,9 @@ def gen_schema (map):
         return """ { "bsonType": "object", "properties": { "value": { "bsonType": "binData" } } } """ 
 
     if map["identifier"] == "id":
-        if map["kms"] == "local":
-            key_id = """[ { "$binary": { "base64": "LOCALAAAAAAAAAAAAAAAAA==", "subType": "04" } } ]"""
-        else:
-            key_id = """[ { "$binary": { "base64": "AWSAAAAAAAAAAAAAAAAAAA==", "subType": "04" } } ]"""
+        key_id = """[ { "$binary": { "base64": "%s", "subType": "04" } } ]""" % key_id_base64(map["kms"])
     else:
-        if map["kms"] == "local":
-            key_id = "\"/altname_local\""
-        else:
-            key_id = "\"/altname_aws\""
+        key_id = "\"/altname_%s\"" % map["kms"]
 
     if map["algo"] == "rand":
         algorithm = "AEAD_AES_256_CBC_HMAC_SHA_512-Random"
@@ -64,6 +57,19 @@ def gen_schema (map):
     
     return fmt % (key_id, algorithm, type)
 
+# The ids of the keys in corpus-key-aws.json and corpus-key-local.json.
+KEY_IDS = {
+    "aws": "AWSAAAAAAAAAAAAAAAAAAA==",
+    "local": "LOCALAAAAAAAAAAAAAAAAA==",
+}
+
+def key_id_base64 (kms):
+    # Other providers get the first 16 bytes of the SHA-256 of their name, a
+    # UUID-sized id whatever characters the name has.
+    if kms in KEY_IDS:
+        return KEY_IDS[kms]
+    return base64.b64encode(hashlib.sha256(kms.encode("utf-8")).digest()[:16]).decode("ascii")
+
 def get_bson_value (bson_type):
     if bson_type == "double":
         return """{ "$numberDouble" : "1.234" }"""
@@ -120,47 +126,103 @@ def gen_field (map):
     allow = "true" if allowed(map) else "false"
     return """ { "kms": "%s", "type": "%s", "algo": "%s", "method": "%s", "identifier": "%s", "allowed": %s, "value": %s }""" % (map["kms"], map["type"], map["algo"], map["method"], map["identifier"], allow, get_bson_value (map["type"]))
 
-schema_sections = []
-corpus_sections = [
-    """ "_id": "client_side_encryption_corpus" """ ,
-    """ "altname_aws": "aws" """ ,
-    """ "altname_local": "local" """ ,
-]
-
-def enumerate_axis (map, axis, remaining):
-    name = axis[0]
-    for item in axis[1]:
-        map[name] = item
-        if remaining == []:
-            key = field_name (map)
-            schema_section = gen_schema (map)
-            corpus_section = gen_field (map)
+class JoinedWriter:
+    """Writes prefix, the sections joined by separator, then suffix, as the sections arrive."""
+
+    def __init__(self, path, prefix, separator, suffix):
+        self.file = open(path, "w")
+        self.file.write(prefix)
+        self.separator = separator
+        self.suffix = suffix
+        self.count = 0
+
+    def write(self, section):
+        if self.count:
+            self.file.write(self.separator)
+        self.file.write(section)
+        self.count += 1
+
+    def close(self):
+        self.file.write(self.suffix)
+        self.file.close()
+
+def enumerate_axes (axes):
+    names = [axis[0] for axis in axes]
+    for items in itertools.product(*[axis[1] for axis in axes]):
+        yield dict(zip(names, items))
+
+def generate (axes, payload_sizes, copies, schema_writer, corpus_writer):
+    corpus_writer.write(""" "_id": "client_side_encryption_corpus" """)
+    for kms in dict(axes)["kms"]:
+        corpus_writer.write(""" "altname_%s": "%s" """ % (kms, kms))
+
+    for map in enumerate_axes(axes):
+        schema_section = gen_schema (map)
+        corpus_section = gen_field (map)
+        for copy in range(copies):
+            # Copies after the first get a numbered suffix.
+            key = field_name (map) + ("_%d" % copy if copy else "")
             if schema_section:
-                schema_sections.append(""" "%s": %s """ % (key, schema_section))
+                schema_writer.write(""" "%s": %s """ % (key, schema_section))
             if corpus_section:
-                corpus_sections.append(""" "%s": %s """ % (key, corpus_section))
-        else:
-            enumerate_axis (map, remaining[0], remaining[1:])
-
-enumerate_axis({}, axes[0], axes[1:])
-
-# Add padding cases
-for algo in ("rand", "det"):
-    for i in range(17):
-        key = "payload=%d,algo=%s" % (i, algo)
-        map = {
-            "kms": "local",
-            "type": "string",
-            "algo": algo,
-            "method": "explicit",
-            "identifier": "id",
-            "allowed": True,
-            "value": "a" * i
-        }
-        corpus_sections.append (""" "%s": %s """ % (key, json.dumps(map)))
-
-
-schema = """{ "bsonType": "object", "properties": { %s } }""" % (",\n".join(schema_sections))
-open(os.path.join(targetdir, "corpus-schema.json"), "w").write(schema)
-open(os.path.join(targetdir, "corpus.json"), "w").write("{%s}" % ",\n".join(corpus_sections))
-print("Generated corpus.json and corpus-schema.json in target directory")
\ No newline at end of file
+                corpus_writer.write(""" "%s": %s """ % (key, corpus_section))
+
+    # Add padding cases
+    for algo in ("rand", "det"):
+        for i in range(payload_sizes):
+            key = "payload=%d,algo=%s" % (i, algo)
+            map = {
+                "kms": "local",
+                "type": "string",
+                "algo": algo,
+                "method": "explicit",
+                "identifier": "id",
+                "allowed": True,
+                "value": "a" * i
+            }
+            corpus_writer.write(""" "%s": %s """ % (key, json.dumps(map)))
+
+def parse_args ():
+    parser = argparse.ArgumentParser(description=description, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("targetdir", metavar="target directory")
+    parser.add_argument("--config", type=argparse.FileType("r"),
+                        help="JSON file with lists for any of %s, and/or \"payload_sizes\" and \"copies\"" % ", ".join(name for name, items in axes))
+    for name, items in axes:
+        parser.add_argument("--" + name, help="comma-separated %s values (default: %s)" % (name, ",".join(items)))
+    parser.add_argument("--payload-sizes", type=int,
+                        help="number of string padding cases per algorithm, with lengths 0 to N-1 (default: 17)")
+    parser.add_argument("--copies", type=int,
+                        help="number of copies of each field in the matrix (default: 1)")
+    args = parser.parse_args()
+
+    config = json.load(args.config) if args.config else {}
+    chosen = []
+    for name, items in axes:
+        if getattr(args, name):
+            items = getattr(args, name).split(",")
+        elif name in config:
+            items = config[name]
+        chosen.append((name, items))
+
+    unknown = [t for t in dict(chosen)["type"] if get_bson_value(t) is None]
+    if unknown:
+        parser.error("unknown types: %s" % ", ".join(unknown))
+
+    payload_sizes = args.payload_sizes
+    if payload_sizes is None:
+        payload_sizes = config.get("payload_sizes", 17)
+
+    copies = args.copies
+    if copies is None:
+        copies = config.get("copies", 1)
+
+    return args.targetdir, chosen, payload_sizes, copies
+
+if __name__ == "__main__":
+    targetdir, chosen_axes, payload_sizes, copies = parse_args()
+    schema_writer = JoinedWriter(os.path.join(targetdir, "corpus-schema.json"), """{ "bsonType": "object", "properties": { """, ",\n", """ } }""")
+    corpus_writer = JoinedWriter(os.path.join(targetdir, "corpus.json"), "{", ",\n", "}")
+    generate(chosen_axes, payload_sizes, copies, schema_writer, corpus_writer)
+    schema_writer.close()
+    corpus_writer.close()
+    print("Generated corpus.json and corpus-schema.json in target directory")
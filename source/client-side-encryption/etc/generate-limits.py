@@ -1,30 +1,144 @@
-
 """
 A utility script written to generate the limits schema and data.
+
+Writes canonical Extended JSON without needing a driver or a server. By
+default this is a document with 100 deterministically encrypted string fields,
+and its JSON Schema; the number of fields, their nesting depth, and the size of
+each value can be raised to generate fixtures near BSON's size and nesting
+limits. Files are written as they are generated, so they can be large.
 """
-from pymongo import MongoClient
-from bson import json_util
-import bson
-from bson.son import SON
-from bson.codec_options import CodecOptions
+import argparse
 import base64
+import json
+import os
+
+# BSON limits: the maximum document size, and the nesting depth the server allows.
+MAX_BSON_SIZE = 16 * 1024 * 1024
+MAX_NESTING_DEPTH = 100
+
+key_id = [{"$binary": {"base64": "LOCALAAAAAAAAAAAAAAAAA==", "subType": "04"}}]
 
 
-codec_options = CodecOptions(uuid_representation=bson.binary.STANDARD)
-json_options = json_util.JSONOptions(json_mode=json_util.JSONMode.CANONICAL, uuid_representation=bson.binary.STANDARD)
-schema = SON()
-doc = SON()
+def field_names(n):
+    width = max(2, len(str(n - 1)))
+    return ["%0*d" % (width, i) for i in range(n)]
 
-for i in range(100):
-    key = "%02d" % i
-    doc[key] = "a"
-    schema[key] = {
+
+def encrypted_field():
+    return {
         "encrypt": {
-            "keyId": [bson.Binary(base64.b64decode("LOCALAAAAAAAAAAAAAAAAA=="), bson.binary.UUID_SUBTYPE)],
+            "keyId": key_id,
             "algorithm": "AEAD_AES_256_CBC_HMAC_SHA_512-Deterministic",
             "bsonType": "string"
         }
     }
 
-open("limits-doc.json", "w").write(json_util.dumps(doc, json_options=json_options, indent=4))
-open("limits-schema.json", "w").write(json_util.dumps({"bsonType": "object", "properties": schema}, json_options=json_options, indent=4))
\ No newline at end of file
+
+def write_value(f, value, level):
+    # Same layout as json.dumps(..., indent=4), at this nesting level.
+    f.write(json.dumps(value, indent=4).replace("\n", "\n" + "    " * level))
+
+
+def write_object(f, items, level=0):
+    """Write a JSON object from (key, value) pairs, where a value that is a
+    callable returns the pairs of a nested object."""
+    indent = "    " * (level + 1)
+    first = True
+    for key, value in items:
+        f.write("{\n" if first else ",\n")
+        first = False
+        f.write(indent + json.dumps(key) + ": ")
+        if callable(value):
+            write_object(f, value(), level + 1)
+        else:
+            write_value(f, value, level + 1)
+    f.write("{}" if first else "\n" + "    " * level + "}")
+
+
+def doc_items(names, depth, value):
+    # The fields are inside depth levels of nested documents under "nested".
+    if depth:
+        yield "nested", lambda: doc_items(names, depth - 1, value)
+    else:
+        for name in names:
+            yield name, value
+
+
+def schema_properties(names, depth):
+    if depth:
+        yield "nested", lambda: schema_items(names, depth - 1)
+    else:
+        for name in names:
+            yield name, encrypted_field()
+
+
+def schema_items(names, depth):
+    yield "bsonType", "object"
+    yield "properties", lambda: schema_properties(names, depth)
+
+
+def bson_size(items):
+    """Return the size in bytes and the nesting depth of the BSON document
+    write_object(f, items) writes, counting the document itself as 1."""
+    # int32 length + elements + terminating 0; an element is a type byte, the
+    # key as a cstring and the value.
+    size, depth = 5, 1
+    for key, value in items:
+        value_size, value_depth = bson_value_size(value)
+        size += 1 + len(key.encode("utf-8")) + 1 + value_size
+        depth = max(depth, 1 + value_depth)
+    return size, depth
+
+
+def bson_value_size(value):
+    if callable(value):
+        return bson_size(value())
+    if isinstance(value, list):
+        return bson_size((str(i), v) for i, v in enumerate(value))
+    if isinstance(value, dict):
+        if "$binary" in value:
+            # int32 length, subtype byte and the bytes.
+            return 4 + 1 + len(base64.b64decode(value["$binary"]["base64"])), 0
+        return bson_size(value.items())
+    # A string: int32 length and the value with its 0 byte.
+    return 4 + len(value.encode("utf-8")) + 1, 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--fields", type=int, default=100,
+                        help="number of encrypted fields (default: 100)")
+    parser.add_argument("--depth", type=int, default=0,
+                        help="nest the fields this many subdocuments deep (default: 0)")
+    parser.add_argument("--value-size", type=int, default=1,
+                        help="length of each field's string value (default: 1)")
+    parser.add_argument("--target", default=".",
+                        help="directory to write limits-doc.json and limits-schema.json to")
+    args = parser.parse_args()
+
+    names = field_names(args.fields)
+    value = "a" * args.value_size
+
+    # The schema nests two levels per level of the document, and three more
+    # for each field's encrypt options, so it reaches the limits first.
+    for name, items in (("document", doc_items(names, args.depth, value)),
+                        ("schema", schema_items(names, args.depth))):
+        size, depth = bson_size(items)
+        if depth > MAX_NESTING_DEPTH:
+            parser.error("the %s would be nested %d levels deep, over the limit of %d"
+                         % (name, depth, MAX_NESTING_DEPTH))
+        if size > MAX_BSON_SIZE:
+            parser.error("the %s would be %d bytes, over the %d byte BSON limit"
+                         % (name, size, MAX_BSON_SIZE))
+    size, _ = bson_size(doc_items(names, args.depth, value))
+
+    with open(os.path.join(args.target, "limits-doc.json"), "w") as f:
+        write_object(f, doc_items(names, args.depth, value))
+    with open(os.path.join(args.target, "limits-schema.json"), "w") as f:
+        write_object(f, schema_items(names, args.depth))
+
+    print("Generated a %d byte document with %d fields in %s" % (size, args.fields, args.target))
+
+
+if __name__ == "__main__":
+    main()
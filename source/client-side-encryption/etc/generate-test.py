@@ -1,13 +1,18 @@
 import bson
+import multiprocessing
 import os
 import sys
-import yaml
-from jinja2 import Template
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "bin"))
+import yamlcache
 description = """Generates YAML/JSON tests from a template file.
 
 This keeps key documents, JSONSchemas, and ciphertexts out of the
 handwritten test files to make them more readable and easier
 to change.
+
+With -j N, renders the templates in N processes.
 """
 
 master_keys = {
@@ -415,11 +420,17 @@ def key(name="basic"):
     return keys[name]
 
 
+# The first ciphertext listed for each (schema, field, plaintext).
+ciphertexts_by_key = {}
+for c in ciphertexts:
+    ciphertexts_by_key.setdefault((c["schema"], c["field"], c["plaintext"]), c["data"])
+
+
 def ciphertext(plaintext, field, schema="basic"):
-    for ciphertext in ciphertexts:
-        if schema == ciphertext["schema"] and field == ciphertext["field"] and plaintext == ciphertext["plaintext"]:
-            return ciphertext["data"]
-    raise Exception("Ciphertext needs to be pre-generated")
+    try:
+        return ciphertexts_by_key[(schema, field, plaintext)]
+    except KeyError:
+        raise Exception("Ciphertext needs to be pre-generated")
 
 
 def local_provider():
@@ -427,41 +438,80 @@ def local_provider():
         "key": {"$binary": {"base64": "Mng0NCt4ZHVUYUJCa1kxNkVyNUR1QURhZ2h2UzR2d2RrZzh0cFBwM3R6NmdWMDFBMUN3YkQ5aXRRMkhGRGdQV09wOGVNYUMxT2k3NjZKelhaQmRCZGJkTXVyZG9uSjFk", "subType": "00"}}
     }
 
-if sys.version_info < (3, 0):
-    print("Use Python 3")
-    sys.exit(1)
+injections = {
+    "schema": schema,
+    "ciphertext": ciphertext,
+    "key": key,
+    "local_provider": local_provider,
+    "schema_w_type": schema_w_type
+}
+
+# One Environment per template directory, sharing a bytecode cache so
+# templates are only compiled again when they change.
+environments = {}
+bytecode_cache = FileSystemBytecodeCache()
 
-if len(sys.argv) < 3:
-    print(description)
-    print("usage: python generate-test.py ./test-templates/<filename>.yml.template [...] <target directory>")
-    print("example: python ./generate-test.py ./test-templates/bulk.yml.template ./")
-    sys.exit(1)
 
-targetdir = sys.argv[-1]
+def get_template(filepath):
+    filedir = os.path.dirname(os.path.abspath(filepath))
+    if filedir not in environments:
+        environments[filedir] = Environment(loader=FileSystemLoader(filedir),
+                                            bytecode_cache=bytecode_cache)
+        environments[filedir].globals.update(injections)
+    return environments[filedir].get_template(os.path.basename(filepath))
 
-for filepath in sys.argv[1:-1]:
-    filedir = os.path.dirname(filepath)
+
+def generate(job):
+    filepath, targetdir = job
     (filename, ext) = os.path.splitext(os.path.basename(filepath))
-    if ext != ".template":
-        print("Input file must end with .yml.template")
-        sys.exit(1)
     (filename, ext) = os.path.splitext(filename)
-    if ext != ".yml":
-        print("Input file must end with .yml.template")
-        sys.exit(1)
 
-    template = Template(open(filepath, "r").read())
-    injections = {
-        "schema": schema,
-        "ciphertext": ciphertext,
-        "key": key,
-        "local_provider": local_provider,
-        "schema_w_type": schema_w_type
-    }
-
-    rendered = template.render(**injections)
+    rendered = get_template(filepath).render()
     # check for valid YAML.
-    parsed = yaml.load(rendered)
+    parsed = yamlcache.loads(rendered)
     open(f"{os.path.join(targetdir,filename + '.yml')}", "w").write(rendered)
-    print(f"Generated {os.path.join(targetdir,filename)}.yml")
+    return f"Generated {os.path.join(targetdir,filename)}.yml"
+
+
+def main(argv):
+    jobs = 1
+    if len(argv) > 1 and argv[1].startswith("-j"):
+        jobs = int(argv[1][2:] or argv.pop(2))
+        argv = argv[:1] + argv[2:]
+
+    if len(argv) < 3:
+        print(description)
+        print("usage: python generate-test.py [-j N] ./test-templates/<filename>.yml.template [...] <target directory>")
+        print("example: python ./generate-test.py ./test-templates/bulk.yml.template ./")
+        sys.exit(1)
+
+    targetdir = argv[-1]
+
+    for filepath in argv[1:-1]:
+        (filename, ext) = os.path.splitext(os.path.basename(filepath))
+        if ext != ".template":
+            print("Input file must end with .yml.template")
+            sys.exit(1)
+        (filename, ext) = os.path.splitext(filename)
+        if ext != ".yml":
+            print("Input file must end with .yml.template")
+            sys.exit(1)
+
+    work = [(filepath, targetdir) for filepath in argv[1:-1]]
+    if jobs > 1:
+        with multiprocessing.Pool(jobs) as pool:
+            for message in pool.imap(generate, work):
+                print(message)
+    else:
+        for message in map(generate, work):
+            print(message)
+
     print("""Run "make" from specifications/source directory to generate corresponding JSON file""")
+
+
+if __name__ == "__main__":
+    if sys.version_info < (3, 0):
+        print("Use Python 3")
+        sys.exit(1)
+
+    main(sys.argv)
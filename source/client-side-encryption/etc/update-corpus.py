@@ -1,28 +1,164 @@
 import json
+import os
+import shutil
 import sys
+import tempfile
 
 description = """Update the existing corpus data from a file with only deterministically encrypted fields.
+
+Both corpora are streamed, one top-level field at a time, so memory use doesn't grow with the
+size of the files. The result is written to a temporary file that replaces the old corpus only
+once it is complete.
 """
 
-if len(sys.argv) != 3:
-    print(description)
-    print("usage: python update-corpus.py <new-corpus-data.json> <old-corpus-data.json>")
-    print("Updates the deterministic fields of <old-corpus-data.json> in place.")
-    sys.exit(1)
-
-new_corpus_path = sys.argv[1]
-old_corpus_path = sys.argv[2]
-new_corpus_data = json.loads(open(new_corpus_path, "r").read())
-old_corpus_data = json.loads(open(old_corpus_path, "r").read())
-
-for (key, val) in new_corpus_data.items():
-    if key == "_id" or key == "altname_aws" or key == "altname_local":
-        continue
-    if new_corpus_data[key]["algo"] == "det":
-        old_corpus_data[key] = new_corpus_data[key]
-    # add random field if it did not exist
-    if new_corpus_data[key]["algo"] == "rand" and key not in old_corpus_data:
-        old_corpus_data[key] = new_corpus_data[key]
-
-open(old_corpus_path, "w").write(json.dumps(old_corpus_data))
-print ("updated %s" % (old_corpus_path))
+CHUNK_SIZE = 1 << 20
+
+decoder = json.JSONDecoder()
+
+
+def skip_whitespace(buf, pos):
+    while pos < len(buf) and buf[pos] in " \t\n\r":
+        pos += 1
+    return pos
+
+
+def iter_fields(f):
+    """Yield (key, value, start, end) for each field of the top-level JSON object in binary file f.
+
+    start and end are the byte offsets of the field's raw value, for reading it again later. The
+    file is scanned as latin-1 so that character offsets are byte offsets.
+    """
+    buf = ""
+    base = 0  # file offset of buf[0]
+    pos = 0
+    eof = False
+
+    def more():
+        nonlocal buf, base, pos, eof
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            eof = True
+        base += pos
+        buf = buf[pos:] + chunk.decode("latin-1")
+        pos = 0
+
+    def parse():
+        # Find the end of one JSON value at pos, reading more of the file until it is complete.
+        nonlocal pos
+        while True:
+            pos = skip_whitespace(buf, pos)
+            try:
+                _, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                more()
+                continue
+            # A number at the end of buf may continue in the next chunk.
+            if skip_whitespace(buf, end) == len(buf) and not eof:
+                more()
+                continue
+            start = pos
+            pos = end
+            # Decode the raw bytes again as UTF-8.
+            return json.loads(buf[start:end].encode("latin-1").decode("utf-8")), start, end
+
+    def punctuation(allowed):
+        nonlocal pos
+        while True:
+            pos = skip_whitespace(buf, pos)
+            if pos < len(buf):
+                break
+            if eof:
+                raise ValueError("unexpected end of corpus file")
+            more()
+        c = buf[pos]
+        if c not in allowed:
+            raise ValueError("expected one of %r at byte %d, found %r" % (allowed, base + pos, c))
+        pos += 1
+        return c
+
+    more()
+    punctuation("{")
+    pos = skip_whitespace(buf, pos)
+    if buf[pos:pos + 1] == "}":
+        return
+    while True:
+        key, _, _ = parse()
+        punctuation(":")
+        value, start, end = parse()
+        yield key, value, base + start, base + end
+        if punctuation(",}") == "}":
+            return
+
+
+def read_value(f, start, end):
+    f.seek(start)
+    return json.loads(f.read(end - start).decode("utf-8"))
+
+
+def is_special(key):
+    return key == "_id" or key.startswith("altname_")
+
+
+def main():
+    if len(sys.argv) != 3:
+        print(description)
+        print("usage: python update-corpus.py <new-corpus-data.json> <old-corpus-data.json>")
+        print("Updates the deterministic fields of <old-corpus-data.json> in place.")
+        sys.exit(1)
+
+    new_corpus_path = sys.argv[1]
+    old_corpus_path = sys.argv[2]
+
+    with open(new_corpus_path, "rb") as new_file, open(old_corpus_path, "rb") as old_file:
+        # Index the new corpus: key -> (algo, value offsets). Values stay on disk.
+        new_index = {}
+        for (key, value, start, end) in iter_fields(new_file):
+            if is_special(key):
+                continue
+            new_index[key] = (value["algo"], start, end)
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(old_corpus_path)))
+        replaced = 0
+        added = {"det": 0, "rand": 0}
+        try:
+            with os.fdopen(fd, "w") as out:
+                separator = "{"
+                old_keys = set()
+
+                def write_field(key, value):
+                    nonlocal separator
+                    out.write(separator + json.dumps(key) + ": " + json.dumps(value))
+                    separator = ", "
+
+                for (key, value, start, end) in iter_fields(old_file):
+                    old_keys.add(key)
+                    entry = new_index.get(key)
+                    if entry and entry[0] == "det":
+                        replaced += 1
+                        write_field(key, read_value(new_file, entry[1], entry[2]))
+                    else:
+                        write_field(key, value)
+
+                # New det fields, and random fields that did not exist.
+                for (key, (algo, start, end)) in new_index.items():
+                    if key not in old_keys and algo in ("det", "rand"):
+                        added[algo] += 1
+                        write_field(key, read_value(new_file, start, end))
+
+                out.write("{}" if separator == "{" else "}")
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    # Only replace the old corpus once the merged one is complete.
+    shutil.copymode(old_corpus_path, tmp_path)
+    os.replace(tmp_path, old_corpus_path)
+
+    print ("updated %s" % (old_corpus_path))
+    print ("det: %d replaced, %d added; rand: %d added" % (replaced, added["det"], added["rand"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -12,24 +12,38 @@ if len(sys.argv) != 3:
 corpus = json.loads(open(sys.argv[1], "r").read())
 corpus_encrypted = json.loads(open(sys.argv[2], "r").read())
 
-# Get all deterministically encrypted fields that have the same value + kms + type
-def get_matching_fields (item):
-    for (key, val) in corpus.items():
-        if key == "_id" or key == "altname_aws" or key == "altname_local":
-            continue
-        if val["value"] == item["value"] and val["algo"] == "det" and item["algo"] == val["algo"] and val["kms"] == item["kms"] and val["type"] == item["type"]:
-            yield key
-    
-count = 0
+# Group all deterministically encrypted fields that have the same value + kms + type,
+# in one pass over the corpus.
+groups = {}
 for (key, val) in corpus.items():
-    if key == "_id" or key == "altname_aws" or key == "altname_local":
+    if key == "_id" or key.startswith("altname_"):
+        continue
+    if val["algo"] != "det":
         continue
-    for matching_field in get_matching_fields (val):
-        count += 1
-        if matching_field == key:
-            continue
-        if corpus_encrypted[matching_field]["value"] != corpus_encrypted[key]["value"]:
-            print ("error: %s does not match %s" % (matching_field, key))
-            sys.exit(1)
+    group_key = (val["kms"], val["type"], json.dumps(val["value"], sort_keys=True))
+    groups.setdefault(group_key, []).append(key)
+
+# Every field in a group is checked against every other, as before. Mismatches are
+# reported against the ciphertext most of the group has.
+count = 0
+errors = 0
+for fields in groups.values():
+    count += len(fields) * len(fields)
+    by_ciphertext = {}
+    for field in fields:
+        ciphertext = json.dumps(corpus_encrypted[field]["value"], sort_keys=True)
+        by_ciphertext.setdefault(ciphertext, []).append(field)
+    if len(by_ciphertext) == 1:
+        continue
+    expected = max(by_ciphertext.values(), key=len)
+    matching = set(expected)
+    for field in fields:
+        if field not in matching:
+            print ("error: %s does not match %s" % (field, expected[0]))
+            errors += 1
+
+if errors:
+    print("found %d mismatched ciphertexts" % errors)
+    sys.exit(1)
 
-print("validated that %d ciphertexts are exact matches" % count)
\ No newline at end of file
+print("validated that %d ciphertexts are exact matches" % count)
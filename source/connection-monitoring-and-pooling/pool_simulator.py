@@ -0,0 +1,668 @@
+"""A reference CMAP connection pool on a discrete-event simulator.
+
+Simulated threads are generators run by a Simulator with a virtual clock in
+milliseconds. A thread yields a Future to wait for it, e.g. sim.timeout(ms),
+and "yield from pool.check_out()" to check out a connection. Events at the
+same virtual time run in the order they were scheduled, so every run is
+deterministic and takes no wall-clock time to sleep.
+
+Pool follows the Connection Pool Behaviors in
+connection-monitoring-and-pooling.rst: a fair wait queue with aggressive
+timeouts, generations for clear(), perished (stale or idle) connections
+closed on check out and check in, a background task that keeps minPoolSize
+connections, and the monitoring events.
+
+With no arguments, runs each tests/*.json script, and the EXTRA_TESTS below,
+and matches its events and error. --scenario instead simulates application
+threads that repeatedly think, check out a connection, run an operation and
+check it back in, and reports percentiles of the time spent waiting to check
+out; comma-separated --threads and --max-pool-size values run every
+combination:
+
+    python pool_simulator.py
+    python pool_simulator.py --scenario --threads 100,200 --max-pool-size 10,25,50,100 \\
+        --op-time exp:5 --think-time exp:20 --wait-queue-timeout-ms 1000
+"""
+
+import argparse
+import collections
+import glob
+import heapq
+import json
+import math
+import os
+import random
+import sys
+
+TESTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tests")
+
+ADDRESS = "localhost:27017"
+DEFAULT_MAX_POOL_SIZE = 100
+PERCENTILES = (50, 90, 95, 99, 99.9)
+
+
+class Future(object):
+    """A value or error that a simulated thread can wait for."""
+
+    def __init__(self, sim):
+        self.sim = sim
+        self.done = False
+        self.value = None
+        self.error = None
+        self._callbacks = []
+
+    def add_callback(self, callback):
+        if self.done:
+            self.sim.schedule(0, callback, self)
+        else:
+            self._callbacks.append(callback)
+
+    def succeed(self, value=None):
+        self._finish(value, None)
+
+    def fail(self, error):
+        self._finish(None, error)
+
+    def _finish(self, value, error):
+        if self.done:
+            raise RuntimeError("future already done")
+        self.done = True
+        self.value = value
+        self.error = error
+        for callback in self._callbacks:
+            self.sim.schedule(0, callback, self)
+        self._callbacks = []
+
+
+class Simulator(object):
+    """Runs callbacks and generator threads in virtual time."""
+
+    def __init__(self):
+        self.now = 0.0
+        self._queue = []
+        self._sequence = 0
+
+    def schedule(self, delay, callback, *args):
+        self._sequence += 1
+        heapq.heappush(self._queue, (self.now + delay, self._sequence, callback, args))
+
+    def future(self):
+        return Future(self)
+
+    def timeout(self, ms):
+        future = Future(self)
+        self.schedule(ms, future.succeed)
+        return future
+
+    def spawn(self, generator):
+        """Start a thread; the returned Future has its result or error."""
+        result = Future(self)
+        self.schedule(0, self._step, generator, result, None)
+        return result
+
+    def _step(self, generator, result, future):
+        try:
+            if future is None:
+                waiting = next(generator)
+            elif future.error is not None:
+                waiting = generator.throw(future.error)
+            else:
+                waiting = generator.send(future.value)
+        except StopIteration as exc:
+            result.succeed(exc.value)
+            return
+        except Exception as exc:
+            result.fail(exc)
+            return
+        waiting.add_callback(lambda f: self._step(generator, result, f))
+
+    def run(self, until=None):
+        """Run until nothing is scheduled, or until the future until is done."""
+        while self._queue and not (until is not None and until.done):
+            (self.now, _, callback, args) = heapq.heappop(self._queue)
+            callback(*args)
+
+
+class PoolClosedError(Exception):
+    def __init__(self, address):
+        Exception.__init__(self, "Attempted to check out a connection from closed connection pool")
+        self.address = address
+
+
+class WaitQueueTimeoutError(Exception):
+    def __init__(self, address):
+        Exception.__init__(self, "Timed out while checking out a connection from connection pool")
+        self.address = address
+
+
+class Connection(object):
+    def __init__(self, id, generation):
+        self.id = id
+        self.generation = generation
+        self.ready = False
+        self.available_since = None
+
+
+class Pool(object):
+    """A connection pool for one address.
+
+    options are the CMAP pool options by their spec names: maxPoolSize
+    (0 for no cap), minPoolSize, maxIdleTimeMS and waitQueueTimeoutMS.
+    connect_time() returns how long setting up a new connection takes.
+    listener is called with each monitoring event, a dict with "type" and
+    the event's fields.
+    """
+
+    def __init__(self, sim, options=None, listener=None, address=ADDRESS, connect_time=None):
+        options = options or {}
+        self.sim = sim
+        self.address = address
+        self.options = options
+        self.max_pool_size = options.get("maxPoolSize", DEFAULT_MAX_POOL_SIZE)
+        self.min_pool_size = options.get("minPoolSize", 0)
+        self.max_idle_time_ms = options.get("maxIdleTimeMS")
+        self.wait_queue_timeout_ms = options.get("waitQueueTimeoutMS")
+        self.listener = listener
+        self.connect_time = connect_time or (lambda: 0)
+
+        self.generation = 0
+        self.closed = False
+        # Connections being set up count toward the total.
+        self.total_connection_count = 0
+        self.available = collections.deque()
+        self.wait_queue = collections.deque()
+        self._next_id = 1
+        self._populating = False
+
+        self._emit("ConnectionPoolCreated", options=options)
+        self._ensure_min_size()
+
+    def _emit(self, event_type, **fields):
+        if self.listener is not None:
+            fields["type"] = event_type
+            fields["address"] = self.address
+            self.listener(fields)
+
+    def _create(self):
+        connection = Connection(self._next_id, self.generation)
+        self._next_id += 1
+        self.total_connection_count += 1
+        self._emit("ConnectionCreated", connectionId=connection.id)
+        return connection
+
+    def _close(self, connection, reason):
+        self.total_connection_count -= 1
+        self._emit("ConnectionClosed", connectionId=connection.id, reason=reason)
+        self._ensure_min_size()
+
+    def _perished(self, connection):
+        """Return "stale", "idle" or None."""
+        if connection.generation < self.generation:
+            return "stale"
+        if (self.max_idle_time_ms is not None and
+                self.sim.now - connection.available_since > self.max_idle_time_ms):
+            return "idle"
+        return None
+
+    def _capped(self):
+        return self.max_pool_size and self.total_connection_count >= self.max_pool_size
+
+    def _acquire(self):
+        """Return an available connection, a new one, or None at maxPoolSize."""
+        while self.available:
+            connection = self.available.pop()
+            reason = self._perished(connection)
+            if reason is None:
+                return connection
+            self._close(connection, reason)
+        if not self._capped():
+            return self._create()
+        return None
+
+    def _make_available(self, connection):
+        connection.available_since = self.sim.now
+        self.available.append(connection)
+        self._serve_wait_queue()
+
+    def _serve_wait_queue(self):
+        while self.wait_queue and not self.closed:
+            connection = self._acquire()
+            if connection is None:
+                return
+            self.wait_queue.popleft().succeed(connection)
+
+    def _ensure_min_size(self):
+        # The background thread: create connections until minPoolSize.
+        if (not self._populating and not self.closed and
+                self.total_connection_count < self.min_pool_size):
+            self._populating = True
+            self.sim.schedule(0, self._populate)
+
+    def _populate(self):
+        self._populating = False
+        while (not self.closed and self.total_connection_count < self.min_pool_size and
+               not self._capped()):
+            connection = self._create()
+            delay = self.connect_time()
+            if delay:
+                self.sim.timeout(delay).add_callback(
+                    lambda _, connection=connection: self._populated(connection))
+            else:
+                self._populated(connection)
+
+    def _populated(self, connection):
+        connection.ready = True
+        self._emit("ConnectionReady", connectionId=connection.id)
+        if self.closed:
+            self._close(connection, "poolClosed")
+        else:
+            self._make_available(connection)
+
+    def _expire(self, waiter):
+        if not waiter.done:
+            self.wait_queue.remove(waiter)
+            waiter.fail(WaitQueueTimeoutError(self.address))
+
+    def check_out(self):
+        """Check out a connection: "connection = yield from pool.check_out()"."""
+        self._emit("ConnectionCheckOutStarted")
+        connection = None
+        if not self.closed and not self.wait_queue:
+            connection = self._acquire()
+        if connection is None:
+            waiter = self.sim.future()
+            if self.closed:
+                waiter.fail(PoolClosedError(self.address))
+            else:
+                self.wait_queue.append(waiter)
+                if self.wait_queue_timeout_ms is not None:
+                    self.sim.schedule(self.wait_queue_timeout_ms, self._expire, waiter)
+            try:
+                connection = yield waiter
+            except PoolClosedError:
+                self._emit("ConnectionCheckOutFailed", reason="poolClosed")
+                raise
+            except WaitQueueTimeoutError:
+                self._emit("ConnectionCheckOutFailed", reason="timeout")
+                raise
+        if not connection.ready:
+            yield self.sim.timeout(self.connect_time())
+            connection.ready = True
+            self._emit("ConnectionReady", connectionId=connection.id)
+        self._emit("ConnectionCheckedOut", connectionId=connection.id)
+        return connection
+
+    def check_in(self, connection):
+        self._emit("ConnectionCheckedIn", connectionId=connection.id)
+        if self.closed:
+            self._close(connection, "poolClosed")
+        elif connection.generation < self.generation:
+            self._close(connection, "stale")
+            self._serve_wait_queue()
+        else:
+            self._make_available(connection)
+
+    def clear(self):
+        self.generation += 1
+        self._emit("ConnectionPoolCleared")
+
+    def close(self):
+        self.closed = True
+        while self.available:
+            self._close(self.available.popleft(), "poolClosed")
+        self._emit("ConnectionPoolClosed")
+        while self.wait_queue:
+            self.wait_queue.popleft().fail(PoolClosedError(self.address))
+
+
+class ScriptThread(object):
+    """A test thread: runs the operations submitted to it, in order, and
+    stops at the first error."""
+
+    def __init__(self, runner):
+        self.runner = runner
+        self.operations = collections.deque()
+        self.error = None
+        self.running = False
+        self._wake = None
+        self._idle = []
+        runner.sim.spawn(self._run())
+
+    def submit(self, operation):
+        self.operations.append(operation)
+        if self._wake is not None and not self._wake.done:
+            self._wake.succeed()
+
+    def wait_idle(self):
+        """A Future done when every submitted operation has run."""
+        future = self.runner.sim.future()
+        if self.error is not None or (not self.operations and not self.running and
+                                      self._wake is not None):
+            future.succeed()
+        else:
+            self._idle.append(future)
+        return future
+
+    def _run(self):
+        while True:
+            if not self.operations:
+                for future in self._idle:
+                    future.succeed()
+                self._idle = []
+                self._wake = self.runner.sim.future()
+                yield self._wake
+                continue
+            operation = self.operations.popleft()
+            self.running = True
+            try:
+                yield from self.runner.execute(operation)
+            except Exception as exc:
+                self.running = False
+                self.error = exc
+                self.operations.clear()
+                for future in self._idle:
+                    future.succeed()
+                self._idle = []
+                return
+            self.running = False
+
+
+class ScriptRunner(object):
+    """Runs one CMAP unit test file in virtual time."""
+
+    def __init__(self, test):
+        self.test = test
+        self.sim = Simulator()
+        self.events = []
+        self.counts = collections.Counter()
+        self.event_waiters = []
+        self.threads = {}
+        self.labels = {}
+        self.pool = Pool(self.sim, test.get("poolOptions"), self.on_event)
+
+    def on_event(self, event):
+        self.events.append(event)
+        self.counts[event["type"]] += 1
+        for (event_type, count, future) in list(self.event_waiters):
+            if self.counts[event_type] >= count:
+                self.event_waiters.remove((event_type, count, future))
+                future.succeed()
+
+    def execute(self, operation):
+        """Run one operation in the current thread."""
+        name = operation["name"]
+        if name == "start":
+            self.threads[operation["target"]] = ScriptThread(self)
+        elif name == "wait":
+            yield self.sim.timeout(operation["ms"])
+        elif name == "waitForThread":
+            thread = self.threads[operation["target"]]
+            yield thread.wait_idle()
+            if thread.error is not None:
+                raise thread.error
+        elif name == "waitForEvent":
+            if self.counts[operation["event"]] < operation["count"]:
+                future = self.sim.future()
+                self.event_waiters.append((operation["event"], operation["count"], future))
+                yield future
+        elif name == "checkOut":
+            connection = yield from self.pool.check_out()
+            if "label" in operation:
+                self.labels[operation["label"]] = connection
+        elif name == "checkIn":
+            self.pool.check_in(self.labels[operation["connection"]])
+        elif name == "clear":
+            self.pool.clear()
+        elif name == "close":
+            self.pool.close()
+        else:
+            raise ValueError("unknown operation %r" % name)
+
+    def main(self):
+        for operation in self.test["operations"]:
+            if "thread" in operation:
+                self.threads[operation["thread"]].submit(operation)
+            else:
+                yield from self.execute(operation)
+
+    def run(self):
+        """Run the main thread to completion; return its error or None."""
+        main = self.sim.spawn(self.main())
+        self.sim.run(until=main)
+        if not main.done:
+            raise RuntimeError("main thread blocked forever")
+        return main.error
+
+
+def matches(actual, expected):
+    if expected == 42 or expected == "42":
+        return actual is not None
+    if isinstance(expected, dict):
+        return (isinstance(actual, dict) and
+                all(matches(actual.get(k), v) for (k, v) in expected.items()))
+    if isinstance(expected, list):
+        return (isinstance(actual, list) and len(actual) >= len(expected) and
+                all(matches(a, e) for (a, e) in zip(actual, expected)))
+    return actual == expected
+
+
+# Cases the JSON files miss, in the same format. waitForThread must wait for
+# an operation the thread has already started, not only for queued ones.
+EXTRA_TESTS = [
+    {
+        "description": "waitForThread waits for a checkOut still in the wait queue",
+        "poolOptions": {"maxPoolSize": 1, "waitQueueTimeoutMS": 1000},
+        "operations": [
+            {"name": "checkOut", "label": "conn0"},
+            {"name": "start", "target": "thread1"},
+            {"name": "wait", "ms": 1},
+            {"name": "checkOut", "thread": "thread1"},
+            {"name": "wait", "ms": 10},
+            {"name": "waitForThread", "target": "thread1"},
+        ],
+        "error": {
+            "type": "WaitQueueTimeoutError",
+            "message": "Timed out while checking out a connection from connection pool",
+        },
+        "events": [
+            {"type": "ConnectionCheckOutStarted"},
+            {"type": "ConnectionCheckedOut", "connectionId": 1},
+            {"type": "ConnectionCheckOutStarted"},
+            {"type": "ConnectionCheckOutFailed", "reason": "timeout"},
+        ],
+        "ignore": ["ConnectionPoolCreated", "ConnectionCreated", "ConnectionReady"],
+    },
+]
+
+
+def run_file(path):
+    """Run one test file and return a list of failure messages."""
+    with open(path) as f:
+        return run_test(json.load(f))
+
+
+def run_test(test):
+    """Run one test and return a list of failure messages."""
+    runner = ScriptRunner(test)
+    error = runner.run()
+
+    failures = []
+    expected_error = test.get("error")
+    if expected_error:
+        actual = None
+        if error is not None:
+            actual = {"type": type(error).__name__, "message": str(error),
+                      "address": getattr(error, "address", None)}
+        if not matches(actual, expected_error):
+            failures.append("expected error %s, got %r" % (expected_error, error))
+    elif error is not None:
+        failures.append("unexpected error %r" % error)
+
+    ignore = set(test.get("ignore", ()))
+    events = [e for e in runner.events if e["type"] not in ignore]
+    for (i, expected) in enumerate(test.get("events", ())):
+        if i >= len(events):
+            failures.append("event %d: expected %s, got nothing" % (i, expected))
+            break
+        if not matches(events[i], expected):
+            failures.append("event %d: expected %s, got %s" % (i, expected, events[i]))
+            break
+    return failures
+
+
+def run_tests(tests_dir):
+    paths = sorted(glob.glob(os.path.join(tests_dir, "*.json")))
+    failed = 0
+    for path in paths:
+        failures = run_file(path)
+        for failure in failures:
+            print("FAIL %s: %s" % (os.path.basename(path), failure))
+        failed += bool(failures)
+    for test in EXTRA_TESTS:
+        failures = run_test(test)
+        for failure in failures:
+            print("FAIL %s: %s" % (test["description"], failure))
+        failed += bool(failures)
+    print("%d files and %d extra tests, %d failed" % (len(paths), len(EXTRA_TESTS), failed))
+    return failed == 0
+
+
+def parse_distribution(spec):
+    """Return a function of a random.Random that draws milliseconds from
+    spec: "fixed:MS", "uniform:LOW,HIGH", "exp:MEAN" or
+    "lognormal:MEDIAN,SIGMA"."""
+    kind, _, args = spec.partition(":")
+    try:
+        values = [float(v) for v in args.split(",")] if args else []
+        if kind == "fixed" and len(values) == 1:
+            return lambda rng: values[0]
+        if kind == "uniform" and len(values) == 2:
+            return lambda rng: rng.uniform(values[0], values[1])
+        if kind == "exp" and len(values) == 1:
+            return lambda rng: rng.expovariate(1.0 / values[0]) if values[0] else 0.0
+        if kind == "lognormal" and len(values) == 2:
+            mu = math.log(values[0])
+            return lambda rng: rng.lognormvariate(mu, values[1])
+    except ValueError:
+        pass
+    raise argparse.ArgumentTypeError("invalid distribution %r" % spec)
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of a sorted list."""
+    i = max(0, int(len(sorted_values) * p / 100.0 + 0.5) - 1)
+    return sorted_values[min(i, len(sorted_values) - 1)]
+
+
+def simulate(threads, options, op_time, think_time, connect_time, duration_ms, seed):
+    """Simulate application threads for duration_ms and return a dict of
+    wait times in ms, timeouts, operations, connections created, the peak
+    connection count and the time connections spent checked out before
+    duration_ms."""
+    sim = Simulator()
+    rng = random.Random(seed)
+    stats = {"waits": [], "timeouts": 0, "operations": 0, "peak": 0, "created": 0,
+             "busy": 0.0}
+
+    def listener(event):
+        if event["type"] == "ConnectionCreated":
+            stats["created"] += 1
+            stats["peak"] = max(stats["peak"], pool.total_connection_count)
+
+    pool = Pool(sim, options, listener, connect_time=lambda: connect_time(rng))
+
+    def app_thread():
+        while True:
+            yield sim.timeout(think_time(rng))
+            if sim.now >= duration_ms:
+                return
+            start = sim.now
+            try:
+                connection = yield from pool.check_out()
+            except WaitQueueTimeoutError:
+                stats["timeouts"] += 1
+                stats["waits"].append(sim.now - start)
+                continue
+            stats["waits"].append(sim.now - start)
+            busy_since = sim.now
+            yield sim.timeout(op_time(rng))
+            pool.check_in(connection)
+            # Operations that run past the end are busy only until then.
+            stats["busy"] += max(0.0, min(sim.now, duration_ms) - busy_since)
+            stats["operations"] += 1
+
+    for _ in range(threads):
+        sim.spawn(app_thread())
+    sim.run()
+    return stats
+
+
+def run_scenarios(args):
+    print("%7s %9s %9s %8s %8s %s %8s %9s %6s" % (
+        "threads", "pool size", "ops/s", "timeouts", "peak",
+        " ".join("%8s" % ("p%g" % p) for p in PERCENTILES), "max", "created", "util"))
+    for threads in args.threads:
+        for max_pool_size in args.max_pool_size:
+            options = {"maxPoolSize": max_pool_size, "minPoolSize": args.min_pool_size}
+            if args.wait_queue_timeout_ms is not None:
+                options["waitQueueTimeoutMS"] = args.wait_queue_timeout_ms
+            if args.max_idle_time_ms is not None:
+                options["maxIdleTimeMS"] = args.max_idle_time_ms
+            stats = simulate(threads, options, args.op_time, args.think_time,
+                             args.connect_time, args.duration * 1000.0, args.seed)
+            waits = sorted(stats["waits"]) or [0.0]
+            # Utilization: connection time spent checked out over the pool's
+            # capacity, or over the peak connection count with no cap.
+            capacity = (max_pool_size or stats["peak"] or 1) * args.duration * 1000.0
+            print("%7d %9d %9.0f %8d %8d %s %8.1f %9d %5.0f%%" % (
+                threads, max_pool_size, stats["operations"] / args.duration,
+                stats["timeouts"], stats["peak"],
+                " ".join("%8.1f" % percentile(waits, p) for p in PERCENTILES),
+                waits[-1], stats["created"], 100.0 * stats["busy"] / capacity))
+
+
+def comma_ints(text):
+    return [int(v) for v in text.split(",")]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--tests", default=TESTS_DIR,
+                        help="directory of CMAP tests (default: tests)")
+    parser.add_argument("--scenario", action="store_true",
+                        help="run a capacity planning scenario instead of the tests")
+    parser.add_argument("--threads", type=comma_ints, default=[100],
+                        help="comma-separated application thread counts (default: 100)")
+    parser.add_argument("--max-pool-size", type=comma_ints, default=[DEFAULT_MAX_POOL_SIZE],
+                        help="comma-separated maxPoolSize values, 0 for no cap "
+                        "(default: %d)" % DEFAULT_MAX_POOL_SIZE)
+    parser.add_argument("--min-pool-size", type=int, default=0,
+                        help="minPoolSize (default: 0)")
+    parser.add_argument("--wait-queue-timeout-ms", type=float,
+                        help="waitQueueTimeoutMS (default: wait forever)")
+    parser.add_argument("--max-idle-time-ms", type=float,
+                        help="maxIdleTimeMS (default: no limit)")
+    parser.add_argument("--op-time", type=parse_distribution, default="exp:5",
+                        help="time a connection is checked out per operation "
+                        "(default: exp:5)")
+    parser.add_argument("--think-time", type=parse_distribution, default="exp:50",
+                        help="time a thread spends between operations (default: exp:50)")
+    parser.add_argument("--connect-time", type=parse_distribution, default="fixed:20",
+                        help="time to set up a new connection (default: fixed:20)")
+    parser.add_argument("--duration", type=float, default=60,
+                        help="virtual seconds to simulate (default: 60)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed for the distributions (default: 0)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.scenario:
+        run_scenarios(args)
+        return
+    sys.exit(0 if run_tests(args.tests) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""Run the max staleness tests against the staleness module and a selector.
+
+For each file in tests/*/*.json, validate the read preference, drop the
+secondaries whose staleness estimate exceeds maxStalenessSeconds, and pass
+the rest to the server selection engine in ../server-selection, which
+applies the mode, tag sets and latency window. Every secondary's staleness
+is estimated with one call into staleness.py, the same functions
+test_staleness_estimate.py and test_max_staleness_spo.py simulate.
+
+    python run_staleness_tests.py
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+
+import numpy as np
+
+import staleness
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "server-selection"))
+from server_selection import SelectionError, Topology  # noqa: E402
+
+TESTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tests")
+
+HEARTBEAT_FREQUENCY_MS = 10000
+MIN_WIRE_VERSION = 5
+REPLICA_SETS = ("ReplicaSetWithPrimary", "ReplicaSetNoPrimary")
+
+
+def last_write_date(server):
+    value = server["lastWrite"]["lastWriteDate"]
+    if isinstance(value, dict):
+        value = value["$numberLong"]
+    return int(value)
+
+
+def fresh_servers(topology_type, servers, max_staleness_seconds, heartbeat_ms):
+    """Return servers without the secondaries that are too stale."""
+    secondaries = [s for s in servers if s["type"] == "RSSecondary"]
+    if not secondaries:
+        return servers
+    last_update = np.array([s["lastUpdateTime"] for s in secondaries], dtype=np.int64)
+    last_write = np.array([last_write_date(s) for s in secondaries], dtype=np.int64)
+    if topology_type == "ReplicaSetWithPrimary":
+        primary = next(s for s in servers if s["type"] == "RSPrimary")
+        estimates = staleness.with_primary(primary["lastUpdateTime"], last_write_date(primary),
+                                           last_update, last_write, heartbeat_ms)
+    else:
+        estimates = staleness.without_primary(last_write, heartbeat_ms)
+    keep = staleness.eligible(estimates, max_staleness_seconds * 1000)
+    stale = set(s["address"] for (s, ok) in zip(secondaries, keep) if not ok)
+    return [s for s in servers if s["address"] not in stale]
+
+
+def select(description, read_preference, heartbeat_ms=HEARTBEAT_FREQUENCY_MS):
+    """Return (suitable servers, servers in the latency window) for a read,
+    or raise SelectionError."""
+    topology_type = description["type"]
+    servers = description["servers"]
+    max_staleness = read_preference.get("maxStalenessSeconds", -1)
+    if max_staleness != -1:
+        if read_preference.get("mode", "primary").lower() == "primary":
+            raise SelectionError("maxStalenessSeconds is not allowed with mode primary")
+        for server in servers:
+            if server["type"] != "Unknown" and server["maxWireVersion"] < MIN_WIRE_VERSION:
+                raise SelectionError("server %s has maxWireVersion %d, maxStalenessSeconds "
+                                     "requires %d" % (server["address"],
+                                                      server["maxWireVersion"],
+                                                      MIN_WIRE_VERSION))
+        if topology_type in REPLICA_SETS:
+            smallest = staleness.smallest_max_staleness_seconds(heartbeat_ms)
+            if max_staleness < smallest:
+                raise SelectionError("maxStalenessSeconds must be at least %s, not %s"
+                                     % (smallest, max_staleness))
+            servers = fresh_servers(topology_type, servers, max_staleness, heartbeat_ms)
+    topology = Topology(topology_type, servers)
+    return (topology.suitable("read", read_preference),
+            topology.in_latency_window("read", read_preference))
+
+
+def addresses(servers):
+    return sorted(s["address"] for s in servers)
+
+
+def check_file(path):
+    """Return a list of failure messages for one test file."""
+    with open(path) as f:
+        test = json.load(f)
+    heartbeat_ms = test.get("heartbeatFrequencyMS", HEARTBEAT_FREQUENCY_MS)
+    try:
+        suitable, window = select(test["topology_description"], test["read_preference"],
+                                  heartbeat_ms)
+    except SelectionError as exc:
+        if test.get("error"):
+            return []
+        return ["unexpected error: %s" % exc]
+    if test.get("error"):
+        return ["expected an error, selected %s" % addresses(window)]
+    failures = []
+    for (name, got) in (("suitable_servers", suitable), ("in_latency_window", window)):
+        if addresses(got) != addresses(test[name]):
+            failures.append("%s: expected %s, got %s"
+                            % (name, addresses(test[name]), addresses(got)))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--tests", default=TESTS_DIR,
+                        help="directory of max staleness tests (default: tests)")
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(args.tests, "*", "*.json")))
+    failed = 0
+    for path in paths:
+        for failure in check_file(path):
+            print("FAIL %s: %s" % (os.path.relpath(path, args.tests), failure))
+            failed += 1
+    print("%d files, %d failures" % (len(paths), failed))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""Staleness estimates from the Max Staleness Spec, over NumPy arrays.
+
+The simulators and the test runner in this directory share these functions,
+so what they simulate is what the tests check. Each takes scalars or arrays,
+one element per secondary, and returns the same shape; any unit works as
+long as every argument uses it. The estimates are computed in the spec's
+order of operations, so for a given input every caller gets the same bits.
+"""
+
+import numpy as np
+
+IDLE_WRITE_PERIOD_MS = 10000
+SMALLEST_MAX_STALENESS_SECONDS = 90
+
+
+def with_primary(primary_last_update_time, primary_last_write_date,
+                 last_update_time, last_write_date, heartbeat_frequency):
+    """Staleness of secondaries in a replica set with a primary:
+
+        (S.lastUpdateTime - S.lastWriteDate) -
+        (P.lastUpdateTime - P.lastWriteDate) + heartbeatFrequencyMS
+    """
+    return ((last_update_time - last_write_date) -
+            (primary_last_update_time - primary_last_write_date) +
+            heartbeat_frequency)
+
+
+def without_primary(last_write_date, heartbeat_frequency):
+    """Staleness of secondaries in a replica set with no primary, given
+    every secondary's lastWriteDate:
+
+        SMax.lastWriteDate - S.lastWriteDate + heartbeatFrequencyMS
+    """
+    last_write_date = np.asarray(last_write_date)
+    return last_write_date.max() - last_write_date + heartbeat_frequency
+
+
+def eligible(staleness, max_staleness):
+    """Which secondaries a read with max_staleness may select."""
+    return staleness <= max_staleness
+
+
+def smallest_max_staleness_seconds(heartbeat_frequency_ms):
+    """The smallest maxStalenessSeconds allowed with a replica set."""
+    return np.maximum(SMALLEST_MAX_STALENESS_SECONDS,
+                      (heartbeat_frequency_ms + IDLE_WRITE_PERIOD_MS) / 1000.)
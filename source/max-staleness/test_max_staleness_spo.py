@@ -1,7 +1,12 @@
 # Attempt to maximize staleness calculation "error" per SPEC description 
 
+import argparse
+import multiprocessing
+
 import numpy as np
 import scipy.optimize as spo
+
+import staleness
 ir = lambda n: int(round(n))
 
 # Constants
@@ -26,15 +31,11 @@ def main():
 
     print("SPO Params: Iter: {}, step: {}, interval:{}".format(num_iterations,step,interval))
 
-    result = spo.basinhopping(func=simulate_staleness
-                              ,x0= (10,200000,5000 ,3000 ,250 ,250 ,250)
-                              ,niter=num_iterations
-                              ,minimizer_kwargs = dict(
-                                method="L-BFGS-B"
-                                ,bounds = list(zip(argmin,argmax)))
-                              ,stepsize=step
-                              ,interval=interval
-                              ,disp= True)
+    result = optimize(x0=(10,200000,5000 ,3000 ,250 ,250 ,250)
+                      ,num_iterations=num_iterations
+                      ,step=step
+                      ,interval=interval
+                      ,disp=True)
 
     print("Server update frequency:     {}\n"
           "Client update frequency:     {}\n"\
@@ -45,12 +46,112 @@ def main():
         print("val: {} \t {}".format(round(result.x[i]),arglabels[i]))
 
 
+def optimize(x0, num_iterations, step=2000, interval=10, disp=False, seed=None):
+    return spo.basinhopping(func=simulate_staleness
+                            ,x0=x0
+                            ,niter=num_iterations
+                            ,minimizer_kwargs = dict(
+                              method="L-BFGS-B"
+                              ,bounds = list(zip(argmin,argmax)))
+                            ,stepsize=step
+                            ,interval=interval
+                            ,disp=disp
+                            ,seed=seed)
+
+
+def sweep_job(job):
+    #One multi-start run in a worker process: set this process's constants
+    global s_freq, c_freq, argmax
+    s_freq, c_freq, x0, num_iterations, seed = job
+    argmax = [threshold,threshold,c_freq,c_freq,1000,1000,s_freq]
+    result = optimize(x0, num_iterations, seed=seed)
+    return s_freq, c_freq, abs(round(result.fun)), [round(v) for v in result.x]
+
+
+def sweep(s_freqs, c_freqs, starts, num_iterations, workers, seed=None):
+    #Worst-case error for every (idle write, heartbeat) frequency pair, from
+    #several optimizations per pair; the first starts from main()'s x0
+    seed_seq = np.random.SeedSequence(seed)
+    jobs = []
+    for c in c_freqs:
+        for s in s_freqs:
+            hi = [threshold,threshold,c,c,1000,1000,s]
+            for i, child in enumerate(seed_seq.spawn(starts)):
+                rng = np.random.default_rng(child)
+                if i == 0:
+                    x0 = np.clip((10,200000,5000 ,3000 ,250 ,250 ,250), argmin, hi)
+                else:
+                    x0 = rng.uniform(argmin, hi)
+                jobs.append((s, c, tuple(x0), num_iterations, int(rng.integers(2**32))))
+
+    print("Sweep: {} configurations x {} starts, Iter: {}, workers: {}".format(
+        len(s_freqs)*len(c_freqs), starts, num_iterations, workers or multiprocessing.cpu_count()))
+
+    worst = {}
+    with multiprocessing.Pool(workers or None) as pool:
+        for s, c, error, x in pool.imap(sweep_job, jobs):
+            if (s, c) not in worst or error > worst[(s, c)][0]:
+                worst[(s, c)] = (error, x)
+
+    #Rows are heartbeat frequencies, columns idle write frequencies
+    width = max(10, max(len(str(e)) for e, x in worst.values()) + 2)
+    print("\nPotential calculation error (ms)")
+    print("{:>14}".format("c_freq\\s_freq") + "".join("{:>{}}".format(s, width) for s in s_freqs))
+    for c in c_freqs:
+        print("{:>14}".format(c) + "".join("{:>{}}".format(worst[(s, c)][0], width) for s in s_freqs))
+
+    (s, c), (error, x) = max(worst.items(), key=lambda item: item[1][0])
+    print("\nWorst case: s_freq {}, c_freq {}, error {}".format(s, c, error))
+    for i in range(len(arglabels)):
+        print("val: {} \t {}".format(x[i],arglabels[i]))
+
+
 # Simulate staleness "error" given the absolute true lag, clock skew, and last time P/S were pinged, etc
 # This function is deterministic, given a set of inputs, there's only one output value. 
 
 def simulate_staleness(inputs): #input clobbered into a tuple for optimizer to digest
     true_lag, c_clock_skew, last_P_ago, last_S_ago, cp_latency, cs_latency,p_offset = inputs
 
+    #Same as simulate_staleness_arange, but computes the two elements it reads
+    #from p_writes and s_writes instead of building the ~750k element array
+    p_len = ir(2.5*threshold)//res + (ir(2.5*threshold) % res > 0)
+    p_start = slice_start(p_len, ir(float(p_offset)/res))
+    s_start = p_start + slice_start(p_len - p_start, ir(float(true_lag)/res))
+
+    #calculate last updated date from client's frame (ie: absolute time + skew)
+    s_last_ut = time - last_S_ago + c_clock_skew
+    p_last_ut = time - last_P_ago + c_clock_skew
+
+    #client connects to S and receiving a response last_s_ago
+    cs_offset = ir(float(last_S_ago+cs_latency)/res)
+    s_last_w = p_write(s_start + index(p_len - s_start, cs_offset))
+    cp_offset = ir(float(last_P_ago+cp_latency)/res)
+    p_last_w = p_write(p_start + index(p_len - p_start, cp_offset))
+
+    lag = staleness.with_primary(p_last_ut, p_last_w, s_last_ut, s_last_w, c_freq)
+    return -abs(lag-true_lag)
+
+def p_write(i):
+    #p_writes[i] before any slicing: time - i*res, truncated to s_freq
+    t = time - i*res
+    return np.int64(t - t % s_freq)
+
+def slice_start(length, start):
+    #where a[start:] begins in an array of this length
+    if start < 0:
+        return max(length + start, 0)
+    return min(start, length)
+
+def index(length, i):
+    #which element a[i] reads in an array of this length
+    if not -length <= i < length:
+        raise IndexError("index {} is out of bounds for axis 0 with size {}".format(i, length))
+    return i + length if i < 0 else i
+
+def simulate_staleness_arange(inputs):
+    #Original array-based simulation, kept to check simulate_staleness
+    true_lag, c_clock_skew, last_P_ago, last_S_ago, cp_latency, cs_latency,p_offset = inputs
+
     #Array of reported lastWrite times, reverse order
     #first element represents the currently reported lastWrite
     #second element represents lastwrite as of 'res' ms ago
@@ -74,7 +175,57 @@ def simulate_staleness(inputs): #input clobbered into a tuple for optimizer to d
     cp_offset = ir(float(last_P_ago+cp_latency)/res)
     p_last_w = p_writes[cp_offset]  #reported P last_write at that time
 
-    lag = (s_last_ut - s_last_w) - (p_last_ut- p_last_w) + c_freq
+    lag = staleness.with_primary(p_last_ut, p_last_w, s_last_ut, s_last_w, c_freq)
     return -abs(lag-true_lag)
 
-main()
+def check(trials):
+    #Compare simulate_staleness with simulate_staleness_arange on random inputs,
+    #mostly within the optimizer's bounds but also up to twice as far outside
+    rng = np.random.default_rng()
+    lo, hi = np.array(argmin, dtype=float), np.array(argmax, dtype=float)
+    span = hi - lo
+    for i in range(trials):
+        inputs = rng.uniform(lo - span, hi + span) if i % 2 else rng.uniform(lo, hi)
+        if i % 3 == 0:
+            inputs = np.round(inputs)
+        try:
+            expected = simulate_staleness_arange(inputs)
+        except IndexError:
+            expected = IndexError
+        try:
+            actual = simulate_staleness(inputs)
+        except IndexError:
+            actual = IndexError
+        if actual is not expected and (type(actual) != type(expected) or actual != expected):
+            print("MISMATCH: {} -> {!r}, expected {!r}".format(list(inputs), actual, expected))
+            return 1
+    print("simulate_staleness matched simulate_staleness_arange for {} inputs".format(trials))
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Attempt to maximize staleness calculation error")
+    parser.add_argument("--check", type=int, metavar="N",
+                        help="instead of optimizing, check the closed-form simulate_staleness against the array version on N random inputs")
+    parser.add_argument("--sweep", action="store_true",
+                        help="optimize every combination of --s-freqs and --c-freqs and print a table of worst-case errors")
+    parser.add_argument("--s-freqs", default="500,1000,2000,5000,10000",
+                        help="comma-separated primary idle write frequencies (ms) for --sweep")
+    parser.add_argument("--c-freqs", default="500,5000,10000,30000,60000",
+                        help="comma-separated client heartbeat frequencies (ms) for --sweep")
+    parser.add_argument("--starts", type=int, default=8,
+                        help="optimizations per configuration for --sweep")
+    parser.add_argument("--iterations", type=int, default=100,
+                        help="basinhopping iterations per optimization for --sweep")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="worker processes for --sweep, default one per CPU")
+    parser.add_argument("--seed", type=int,
+                        help="seed for --sweep's starting points and steps")
+    args = parser.parse_args()
+    if args.check:
+        exit(check(args.check))
+    if args.sweep:
+        sweep([int(f) for f in args.s_freqs.split(",")],
+              [int(f) for f in args.c_freqs.split(",")],
+              args.starts, args.iterations, args.workers, args.seed)
+    else:
+        main()
@@ -15,13 +15,33 @@
 # enforce maxStalenessSeconds for a secondary read, record the outcome.
 
 import argparse
+import heapq
+import math
+import multiprocessing
+import pickle
 import sys
+import tempfile
 from collections import OrderedDict
 
 import numpy as np
 
+import staleness as estimate
 
-IDLE_FREQ = 10
+IDLE_FREQ = estimate.IDLE_WRITE_PERIOD_MS / 1000
+OPLOG_LEN = 100
+MIN_OPLOG_SEC = 120
+
+# Doubles one trial takes from the random stream when its first oplog is
+# accepted: heartbeat, oplog, now, lag, primary ago, secondary ago, and
+# maxStalenessSeconds.
+TRIAL_DRAWS = 1 + OPLOG_LEN + 5
+
+# Rows buffered per write with --stream.
+STREAM_BLOCK_ROWS = 10000
+
+# Records per block of a spilled run with --workers; merging holds one block
+# of every chunk's run.
+MERGE_BLOCK_ROWS = 1000
 
 def parse_args():
     parser = argparse.ArgumentParser(description=__doc__)
@@ -29,6 +49,29 @@ def parse_args():
                         type=int)
     parser.add_argument("OUT", help="CSV filename",
                         type=argparse.FileType('w'))
+    parser.add_argument("--seed", help="Seed for numpy's random generator",
+                        type=int)
+    parser.add_argument("--batch-size", help="Run this many trials at a time "
+                        "as NumPy arrays, with the same results as the "
+                        "one-at-a-time loop for the same seed",
+                        type=int, default=0)
+    parser.add_argument("--workers", help="Split TRIALS across this many "
+                        "processes; each chunk of trials has its own child "
+                        "stream of --seed, so results don't depend on the "
+                        "number of workers",
+                        type=int, default=0)
+    parser.add_argument("--chunk-size", help="Trials per chunk with --workers",
+                        type=int, default=100000)
+    parser.add_argument("--stream", help="Write rows as they're produced, "
+                        "bucketed by outcome in temp files, so memory stays "
+                        "flat however many trials run",
+                        action="store_true")
+    parser.add_argument("--unsorted", help="With --stream, write rows to OUT "
+                        "in trial order instead of sorting them",
+                        action="store_true")
+    parser.add_argument("--parquet", help="Also write records to this Parquet "
+                        "file, in the order they're produced (requires "
+                        "pyarrow)")
     return parser.parse_args()
 
 
@@ -36,10 +79,10 @@ def make_primary_oplog():
     while True:
         # Primary wrote at random intervals up to 10 sec apart.
         # Time began at 0, oplog[0] is the first entry, oplog[-1] the latest.
-        oplog = np.cumsum(np.random.rand(100) * IDLE_FREQ)
+        oplog = np.cumsum(np.random.rand(OPLOG_LEN) * IDLE_FREQ)
 
         # If we generated at least 2 minutes of oplog, return, else try again.
-        if oplog[-1] >= 120:
+        if oplog[-1] >= MIN_OPLOG_SEC:
             return oplog
 
 
@@ -61,27 +104,156 @@ class ServerDescription:
         assert self.last_update_time > self.last_write_date
 
 
-def main(args):
-    incorrectly_eligible_case = False
-    result_record = OrderedDict([('correct', '%d'),
-                                 ('read_pref_valid', '%d'),
-                                 ('secondary_eligible', '%d'),
-                                 ('primary_last_write_date', '%.2f'),
-                                 ('secondary_lag', '%.2f'),
-                                 ('secondary_position', '%.2f'),
-                                 ('secondary_last_write_date', '%.2f'),
-                                 ('primary_desc_last_update_time', '%.2f'),
-                                 ('primary_desc_last_write_date', '%.2f'),
-                                 ('secondary_desc_last_update_time', '%.2f'),
-                                 ('secondary_desc_last_write_date', '%.2f'),
-                                 ('heartbeat_sec', '%.2f'),
-                                 ('max_staleness_sec', '%.2f')])
-
-    # One more format specifier for "repro".
-    result_fmt = ','.join(result_record.values()) + ',"%s"'
-    results = []
+class UniformStream:
+    """numpy's legacy stream of uniform doubles, read in blocks.
+
+    np.random.rand(), np.random.rand(n) and np.random.power() each consume
+    one double per value, so a trial's draws are a fixed-layout slice of this
+    stream. Doubles drawn for a block but not used carry over to the next.
+    """
+    def __init__(self, random_state=np.random):
+        self.random_state = random_state
+        self.buf = np.empty(0)
+        self.pos = 0
+
+    def peek(self, n):
+        available = len(self.buf) - self.pos
+        if available < n:
+            self.buf = np.concatenate(
+                (self.buf[self.pos:], self.random_state.rand(n - available)))
+            self.pos = 0
+
+        return self.buf[self.pos:self.pos + n]
+
+    def take(self, n):
+        values = self.peek(n)
+        self.pos += n
+        return values
+
+
+def legacy_power(u, a):
+    # np.random.power(a) for uniform draws u. Like numpy's C code, use libm:
+    # the SIMD np.log, np.exp and np.power can differ in the last bit.
+    inv_a = 1. / a
+    return np.fromiter(
+        (math.pow(1 - math.exp(math.log(1.0 - x)), inv_a) for x in u),
+        dtype=float, count=len(u))
+
+
+def search_rows(oplogs, values):
+    # search() for each oplog row and its value. Rows are sorted, so the
+    # count of entries <= value is searchsorted(..., side='right').
+    positions = (oplogs <= values[:, np.newaxis]).sum(axis=1) - 1
+    return np.clip(positions, 0, sys.maxsize)
+
+
+def evaluate_trials(heartbeat_u, oplogs, tail_u):
+    """Vectorized body of one trial for each row of oplogs.
+
+    heartbeat_u and tail_u are the uniform draws main() takes before and
+    after make_primary_oplog(). Returns an OrderedDict of columns.
+    """
+    rows = np.arange(len(oplogs))
+    now_u, lag_u, primary_ago_u, secondary_ago_u, max_staleness_u = tail_u.T
+
+    heartbeat_sec = .5 + (heartbeat_u * (120 - .5))
+    primary_last_write_date = oplogs[:, -1]
+    now = primary_last_write_date + now_u * IDLE_FREQ
+    secondary_lag = legacy_power(lag_u, a=.1) * now
+
+    secondary_position = search_rows(oplogs,
+                                     primary_last_write_date - secondary_lag)
+    secondary_last_write_date = oplogs[rows, secondary_position]
+    moved = secondary_position > 0
+    assert np.all(primary_last_write_date[moved] -
+                  secondary_last_write_date[moved] >=
+                  secondary_lag[moved] - 0.01)
+
+    # The two ServerDescriptions.
+    primary_ago = primary_ago_u * heartbeat_sec
+    primary_desc_last_update_time = now - primary_ago
+    primary_desc_last_write_date = oplogs[
+        rows, search_rows(oplogs, primary_desc_last_update_time)]
+    assert np.all(primary_desc_last_update_time > primary_desc_last_write_date)
+
+    secondary_ago = secondary_ago_u * heartbeat_sec
+    secondary_desc_last_update_time = now - secondary_ago
+    secondary_desc_last_write_date = oplogs[rows, search_rows(
+        oplogs, primary_last_write_date - secondary_lag - secondary_ago)]
+    assert np.all(
+        secondary_desc_last_update_time > secondary_desc_last_write_date)
+
+    max_staleness_sec = max_staleness_u * 120
+    read_pref_valid = max_staleness_sec >= (
+        estimate.smallest_max_staleness_seconds(heartbeat_sec * 1000))
+
+    staleness = estimate.with_primary(primary_desc_last_update_time,
+                                      primary_desc_last_write_date,
+                                      secondary_desc_last_update_time,
+                                      secondary_desc_last_write_date,
+                                      heartbeat_sec)
 
-    for i in range(args.TRIALS):
+    secondary_eligible = estimate.eligible(staleness, max_staleness_sec)
+    fresh = (primary_last_write_date -
+             secondary_last_write_date) <= max_staleness_sec
+    correct = np.where(fresh, secondary_eligible, ~secondary_eligible)
+
+    return OrderedDict([
+        ('correct', correct),
+        ('read_pref_valid', read_pref_valid),
+        ('secondary_eligible', secondary_eligible),
+        ('primary_last_write_date', primary_last_write_date),
+        ('secondary_lag', secondary_lag),
+        ('secondary_position', secondary_position),
+        ('secondary_last_write_date', secondary_last_write_date),
+        ('primary_desc_last_update_time', primary_desc_last_update_time),
+        ('primary_desc_last_write_date', primary_desc_last_write_date),
+        ('secondary_desc_last_update_time', secondary_desc_last_update_time),
+        ('secondary_desc_last_write_date', secondary_desc_last_write_date),
+        ('heartbeat_sec', heartbeat_sec),
+        ('max_staleness_sec', max_staleness_sec)])
+
+
+def batch_trials(stream, n):
+    """Run n trials as NumPy arrays, taking the same draws as main()'s loop.
+
+    Each block is laid out assuming every first oplog is long enough. A
+    too-short oplog shifts the rest of the stream, so a block is only used up
+    to its first rejected row; that trial is replayed with retries on its own
+    and the next block starts after it.
+    """
+    pieces = []
+    while n:
+        block = stream.peek(n * TRIAL_DRAWS).reshape(n, TRIAL_DRAWS)
+        oplogs = np.cumsum(block[:, 1:1 + OPLOG_LEN] * IDLE_FREQ, axis=1)
+        rejected = oplogs[:, -1] < MIN_OPLOG_SEC
+        accepted = int(np.argmax(rejected)) if rejected.any() else n
+        if accepted:
+            pieces.append(evaluate_trials(block[:accepted, 0],
+                                          oplogs[:accepted],
+                                          block[:accepted, 1 + OPLOG_LEN:]))
+            stream.take(accepted * TRIAL_DRAWS)
+            n -= accepted
+
+        if n and accepted < len(block):
+            heartbeat_u = stream.take(1)
+            while True:
+                oplog = np.cumsum(stream.take(OPLOG_LEN) * IDLE_FREQ)
+                if oplog[-1] >= MIN_OPLOG_SEC:
+                    break
+
+            pieces.append(evaluate_trials(heartbeat_u,
+                                          oplog[np.newaxis, :],
+                                          stream.take(5)[np.newaxis, :]))
+            n -= 1
+
+    return OrderedDict((name, np.concatenate([p[name] for p in pieces]))
+                       for name in pieces[0])
+
+
+def scalar_trials(n_trials):
+    """Run trials one at a time, yield each unexpected outcome's record."""
+    for i in range(n_trials):
         # Heartbeat frequency from 500ms to 2 minutes.
         heartbeat_sec = .5 + (np.random.rand() * (120 - .5))
         oplog = make_primary_oplog()
@@ -109,23 +281,23 @@ def main(args):
 
         # maxStalenessSeconds is between 0 (in violation of spec) and 2 minutes.
         max_staleness_sec = np.random.rand() * 120
-        read_pref_valid = max_staleness_sec >= (heartbeat_sec + IDLE_FREQ)
+        read_pref_valid = max_staleness_sec >= (
+            estimate.smallest_max_staleness_seconds(heartbeat_sec * 1000))
 
         # Estimate secondary_lag, using formula from spec.
-        staleness = ((primary.last_write_date - primary.last_update_time) -
-                     (secondary.last_write_date - secondary.last_update_time) +
-                     heartbeat_sec)
+        staleness = estimate.with_primary(primary.last_update_time,
+                                          primary.last_write_date,
+                                          secondary.last_update_time,
+                                          secondary.last_write_date,
+                                          heartbeat_sec)
 
-        secondary_eligible = staleness <= max_staleness_sec
+        secondary_eligible = estimate.eligible(staleness, max_staleness_sec)
 
         # Is the secondary's lag actually less than maxStalenessSeconds?
         if (oplog[-1] - secondary_last_write_date) <= max_staleness_sec:
             correct = secondary_eligible
         elif secondary_eligible:
             correct = False
-            if read_pref_valid:
-                # Uh-oh. We selected a secondary that was actually too stale.
-                incorrectly_eligible_case = True
         else:
             correct = True
 
@@ -134,7 +306,7 @@ def main(args):
             continue
 
         # Record the outcome.
-        r = OrderedDict([
+        yield OrderedDict([
             ('correct', correct),
             ('read_pref_valid', read_pref_valid),
             ('secondary_eligible', secondary_eligible),
@@ -149,19 +321,261 @@ def main(args):
             ('heartbeat_sec', heartbeat_sec),
             ('max_staleness_sec', max_staleness_sec)])
 
+
+def batched_trials(n_trials, batch_size, random_state=np.random):
+    """Like scalar_trials, but run batch_size trials at a time."""
+    stream = UniformStream(random_state)
+    while n_trials:
+        n = min(batch_size, n_trials)
+        n_trials -= n
+        trials = batch_trials(stream, n)
+        unexpected = ~trials['correct'] & trials['read_pref_valid']
+        for i in np.flatnonzero(unexpected):
+            yield OrderedDict((name, column[i])
+                              for name, column in trials.items())
+
+
+def outcome_key(rec):
+    return rec['correct'], rec['read_pref_valid'], rec['secondary_eligible']
+
+
+def run_chunk(job):
+    """Run one chunk of trials in a worker, return its records."""
+    n_trials, batch_size, seed_seq, sort = job
+    random_state = np.random.RandomState(np.random.MT19937(seed_seq))
+    records = list(batched_trials(n_trials, batch_size, random_state))
+    if sort:
+        records.sort(key=outcome_key)
+
+    return records
+
+
+def sharded_trials(n_trials, chunk_size, batch_size, workers, seed,
+                   merge=True):
+    """Run trials across a process pool, yield records in the CSV's order.
+
+    Workers send back each chunk's failing records as a sorted run, which is
+    spilled to a temp file as it arrives. The runs are merged from their
+    ends, last chunk first, so records come out by descending outcome_key
+    with ties in reverse trial order, as main() writes results[::-1]. Without
+    merge, yield each chunk's records in trial order as soon as the chunk is
+    done.
+    """
+    sizes = [chunk_size] * (n_trials // chunk_size)
+    if n_trials % chunk_size:
+        sizes.append(n_trials % chunk_size)
+
+    seed_seqs = np.random.SeedSequence(seed).spawn(len(sizes))
+    jobs = [(n, batch_size or chunk_size, seed_seq, merge)
+            for n, seed_seq in zip(sizes, seed_seqs)]
+
+    runs = SpilledRuns(MERGE_BLOCK_ROWS)
+    with multiprocessing.Pool(workers) as pool:
+        for records in pool.imap(run_chunk, jobs):
+            if merge:
+                runs.add(records)
+            else:
+                yield from records
+
+    if merge:
+        yield from runs.merged(outcome_key)
+
+
+class SpillBucket:
+    """Formatted rows with the same outcome_key, spilled to a temp file.
+
+    Rows are written in blocks of block_rows; reading the blocks back last
+    first gives the rows in reverse order without loading the whole file.
+    """
+    def __init__(self, block_rows):
+        self.file = tempfile.TemporaryFile('w+b')
+        self.block_rows = block_rows
+        self.pending = []
+        self.offsets = []
+
+    def append(self, line):
+        self.pending.append(line)
+        if len(self.pending) >= self.block_rows:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.offsets.append(self.file.tell())
+            self.file.write(''.join(self.pending).encode())
+            self.pending = []
+
+    def reversed_lines(self):
+        self.flush()
+        end = self.file.tell()
+        for start in reversed(self.offsets):
+            self.file.seek(start)
+            block = self.file.read(end - start).decode()
+            end = start
+            for line in reversed(block.split('\n')[:-1]):
+                yield line + '\n'
+
+        self.file.close()
+
+
+class SpilledRuns:
+    """Sorted runs of records, pickled to one temp file in blocks.
+
+    Like SpillBucket, each run is read back last block first, so merging the
+    runs holds one block of each in memory.
+    """
+    def __init__(self, block_rows):
+        self.file = tempfile.TemporaryFile()
+        self.block_rows = block_rows
+        self.runs = []
+
+    def add(self, records):
+        offsets = []
+        for i in range(0, len(records), self.block_rows):
+            offsets.append(self.file.tell())
+            pickle.dump(records[i:i + self.block_rows], self.file,
+                        pickle.HIGHEST_PROTOCOL)
+        self.runs.append(offsets)
+
+    def reversed_run(self, offsets):
+        for start in reversed(offsets):
+            self.file.seek(start)
+            yield from reversed(pickle.load(self.file))
+
+    def merged(self, key):
+        """Yield every record by descending key, later runs first on ties."""
+        yield from heapq.merge(*[self.reversed_run(offsets)
+                                 for offsets in reversed(self.runs)],
+                               key=key, reverse=True)
+        self.file.close()
+
+
+class ParquetSink:
+    """Write records to a Parquet file, one row group per block."""
+    def __init__(self, path, result_record, block_rows):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            sys.exit("ERROR: --parquet requires pyarrow")
+
+        self.pyarrow = pyarrow
+        types = {'%d': pyarrow.bool_(), '%.2f': pyarrow.float64()}
+        fields = [(name, types[fmt]) for name, fmt in result_record.items()]
+        fields[list(result_record).index('secondary_position')] = (
+            'secondary_position', pyarrow.int64())
+
+        self.schema = pyarrow.schema(fields)
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        self.block_rows = block_rows
+        self.pending = []
+
+    def append(self, r):
+        self.pending.append(r)
+        if len(self.pending) >= self.block_rows:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            columns = [[r[name] for r in self.pending]
+                       for name in self.schema.names]
+            self.writer.write_table(self.pyarrow.table(
+                columns, schema=self.schema))
+            self.pending = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def main(args):
+    incorrectly_eligible_case = False
+    result_record = OrderedDict([('correct', '%d'),
+                                 ('read_pref_valid', '%d'),
+                                 ('secondary_eligible', '%d'),
+                                 ('primary_last_write_date', '%.2f'),
+                                 ('secondary_lag', '%.2f'),
+                                 ('secondary_position', '%.2f'),
+                                 ('secondary_last_write_date', '%.2f'),
+                                 ('primary_desc_last_update_time', '%.2f'),
+                                 ('primary_desc_last_write_date', '%.2f'),
+                                 ('secondary_desc_last_update_time', '%.2f'),
+                                 ('secondary_desc_last_write_date', '%.2f'),
+                                 ('heartbeat_sec', '%.2f'),
+                                 ('max_staleness_sec', '%.2f')])
+
+    # One more format specifier for "repro".
+    result_fmt = ','.join(result_record.values()) + ',"%s"'
+    results = []
+
+    if args.seed is not None:
+        np.random.seed(args.seed)
+
+    # Sharded trials without --stream arrive already in the CSV's order.
+    presorted = args.workers and not args.stream
+    if args.workers:
+        outcomes = sharded_trials(args.TRIALS, args.chunk_size,
+                                  args.batch_size, args.workers, args.seed,
+                                  merge=not args.stream)
+    elif args.batch_size:
+        outcomes = batched_trials(args.TRIALS, args.batch_size)
+    else:
+        outcomes = scalar_trials(args.TRIALS)
+
+    if args.stream or presorted:
+        print(args.OUT.name)
+        args.OUT.write(','.join(result_record))
+        args.OUT.write(',repro')
+        args.OUT.write('\n')
+
+    buckets = {}
+    parquet = None
+    if args.parquet:
+        parquet = ParquetSink(args.parquet, result_record, STREAM_BLOCK_ROWS)
+
+    for r in outcomes:
+        # Only incorrect outcomes with a valid read preference are recorded.
+        if r['secondary_eligible']:
+            # Uh-oh. We selected a secondary that was actually too stale.
+            incorrectly_eligible_case = True
+
         r['repro'] = '%s=%s\0' % (
             ', '.join(result_record),
             ', '.join(str(r[name]) for name in result_record))
 
-        results.append(r)
+        if parquet:
+            parquet.append(r)
+
+        if presorted:
+            args.OUT.write(result_fmt % tuple(r.values()) + '\n')
+            continue
+
+        if not args.stream:
+            results.append(r)
+            continue
+
+        line = result_fmt % tuple(r.values()) + '\n'
+        if args.unsorted:
+            args.OUT.write(line)
+        else:
+            # Bucket sort by the three boolean keys.
+            key = tuple(bool(k) for k in outcome_key(r))
+            if key not in buckets:
+                buckets[key] = SpillBucket(STREAM_BLOCK_ROWS)
+            buckets[key].append(line)
 
     if incorrectly_eligible_case:
         print("ERROR: selected a too-stale secondary at least once!")
 
-    results.sort(key=lambda rec: (
-        rec['correct'], rec['read_pref_valid'], rec['secondary_eligible']))
+    if parquet:
+        parquet.close()
+
+    # Reversed, like the in-memory sort below.
+    for key in sorted(buckets, reverse=True):
+        args.OUT.writelines(buckets[key].reversed_lines())
+
+    results.sort(key=outcome_key)
 
-    if args.OUT:
+    if args.OUT and not args.stream and not presorted:
         print(args.OUT.name)
         args.OUT.write(','.join(result_record))
         args.OUT.write(',repro')
@@ -0,0 +1,638 @@
+"""A reference SDAM state machine with immutable topology snapshots.
+
+apply(topology, address, response) is a pure function: it takes a
+TopologyDescription and one ismaster outcome, and returns the next
+TopologyDescription and the SDAM monitoring events the change publishes,
+leaving its input untouched. A sequence of responses is a log of events, and
+replaying it from the seeds' initial description rebuilds every snapshot.
+
+Descriptions are namedtuples. A new snapshot shares every ServerDescription
+that didn't change with the one before it, so applying a response allocates
+the new description of the server that responded, descriptions the rules
+reset or add, and a new address -> description dict of references. A
+response equal to the server's description (per Server Description Equality)
+publishes nothing.
+
+The replay runner checks every phase's outcome in tests/{rs,sharded,single}
+and the published events in tests/monitoring. --benchmark applies rolling
+restarts of synthetic replica sets and reports responses applied per second
+and how much each response changed:
+
+    python sdam.py
+    python sdam.py --benchmark --members 50 --restarts 20
+"""
+
+import argparse
+import collections
+import glob
+import json
+import os
+import sys
+import time
+
+TESTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tests")
+
+# The wire versions this client speaks, as in PyMongo 3.6.
+CLIENT_MIN_WIRE_VERSION = 2
+CLIENT_MAX_WIRE_VERSION = 6
+
+DATA_BEARING = frozenset(["Standalone", "RSPrimary", "RSSecondary", "Mongos"])
+RS_MEMBERS = frozenset(["RSSecondary", "RSArbiter", "RSOther"])
+
+_ServerDescription = collections.namedtuple("_ServerDescription", (
+    "address", "type", "min_wire_version", "max_wire_version", "me", "hosts",
+    "passives", "arbiters", "tags", "set_name", "set_version", "election_id",
+    "primary", "logical_session_timeout_minutes",
+))
+
+
+class ServerDescription(_ServerDescription):
+    """The client's view of one server. hosts, passives and arbiters are
+    tuples of lowercased addresses in the order the server sent them."""
+
+    __slots__ = ()
+
+    def key(self):
+        """The fields compared by Server Description Equality."""
+        return (self.type, self.min_wire_version, self.max_wire_version, self.me,
+                frozenset(self.hosts), frozenset(self.passives), frozenset(self.arbiters),
+                tuple(sorted(self.tags.items())), self.set_name, self.set_version,
+                self.election_id, self.primary, self.logical_session_timeout_minutes)
+
+    def members(self):
+        return self.hosts + self.passives + self.arbiters
+
+    def to_event(self):
+        """The description as SDAM monitoring tests show it."""
+        doc = {"address": self.address, "arbiters": list(self.arbiters),
+               "hosts": list(self.hosts), "passives": list(self.passives),
+               "type": self.type}
+        if self.primary is not None:
+            doc["primary"] = self.primary
+        if self.set_name is not None:
+            doc["setName"] = self.set_name
+        return doc
+
+
+def unknown(address, server_type="Unknown"):
+    """A default ServerDescription."""
+    return ServerDescription(address, server_type, 0, 0, None, (), (), (), {}, None,
+                             None, None, None, None)
+
+
+def server_type(response):
+    if not response.get("ok"):
+        return "Unknown"
+    if response.get("isreplicaset"):
+        return "RSGhost"
+    if response.get("setName"):
+        if response.get("hidden"):
+            return "RSOther"
+        if response.get("ismaster"):
+            return "RSPrimary"
+        if response.get("secondary"):
+            return "RSSecondary"
+        if response.get("arbiterOnly"):
+            return "RSArbiter"
+        return "RSOther"
+    if response.get("msg") == "isdbgrid":
+        return "Mongos"
+    return "Standalone"
+
+
+def object_id(value):
+    """An electionId as a comparable hex string; extended JSON or str."""
+    if isinstance(value, dict):
+        return value["$oid"].lower()
+    return value
+
+
+def _addresses(response, field):
+    return tuple(address.lower() for address in response.get(field) or ())
+
+
+def parse_response(address, response):
+    """Return the ServerDescription for an ismaster outcome; {} is a
+    network error."""
+    kind = server_type(response)
+    if kind == "Unknown":
+        return unknown(address)
+    me = response.get("me")
+    primary = response.get("primary")
+    return ServerDescription(
+        address, kind,
+        response.get("minWireVersion", 0), response.get("maxWireVersion", 0),
+        me.lower() if me else None,
+        _addresses(response, "hosts"), _addresses(response, "passives"),
+        _addresses(response, "arbiters"),
+        dict(response.get("tags") or {}), response.get("setName"),
+        response.get("setVersion"), object_id(response.get("electionId")),
+        primary.lower() if primary else None,
+        response.get("logicalSessionTimeoutMinutes"))
+
+
+_TopologyDescription = collections.namedtuple("_TopologyDescription", (
+    "type", "set_name", "max_set_version", "max_election_id", "servers",
+    "compatible", "compatibility_error", "logical_session_timeout_minutes", "seeds",
+))
+
+
+class TopologyDescription(_TopologyDescription):
+    """The client's view of the deployment. servers maps each address to
+    its ServerDescription; it is never modified once the snapshot exists."""
+
+    __slots__ = ()
+
+    def to_event(self):
+        doc = {"topologyType": self.type,
+               "servers": [self.servers[a].to_event() for a in sorted(self.servers)]}
+        if self.set_name is not None:
+            doc["setName"] = self.set_name
+        return doc
+
+
+EMPTY = TopologyDescription("Unknown", None, None, None, {}, True, None, None, ())
+
+
+def parse_uri(uri):
+    """Return (seeds, set name) from a mongodb:// connection string."""
+    rest = uri[len("mongodb://"):]
+    hosts, _, options = rest.partition("/")
+    seeds = []
+    for host in hosts.split(","):
+        host = host.lower()
+        seeds.append(host if ":" in host else host + ":27017")
+    set_name = None
+    for option in options.lstrip("?").split("&"):
+        name, _, value = option.partition("=")
+        if name == "replicaSet":
+            set_name = value
+    return tuple(seeds), set_name
+
+
+def initial(seeds, set_name=None, topology_type=None):
+    """Return the initial TopologyDescription for seeds. By default one seed
+    without a set name is Single, a set name is ReplicaSetNoPrimary and
+    anything else is Unknown."""
+    if topology_type is None:
+        if set_name is not None:
+            topology_type = "ReplicaSetNoPrimary"
+        elif len(seeds) == 1:
+            topology_type = "Single"
+        else:
+            topology_type = "Unknown"
+    servers = dict((address, unknown(address)) for address in seeds)
+    return TopologyDescription(topology_type, set_name, None, None, servers, True, None,
+                               None, tuple(seeds))
+
+
+def opening_events(topology):
+    """The events a client publishes while starting to monitor topology."""
+    events = [("topology_opening_event", {}),
+              ("topology_description_changed_event", {
+                  "previousDescription": EMPTY.to_event(),
+                  "newDescription": topology.to_event()})]
+    for address in topology.seeds:
+        events.append(("server_opening_event", {"address": address}))
+    return events
+
+
+class _Update(object):
+    """The working state of one apply(): the fields of the next snapshot,
+    with servers copied on the first write."""
+
+    def __init__(self, topology):
+        self.topology = topology
+        self.type = topology.type
+        self.set_name = topology.set_name
+        self.max_set_version = topology.max_set_version
+        self.max_election_id = topology.max_election_id
+        self.servers = topology.servers
+        self._copied = False
+
+    def _write(self):
+        if not self._copied:
+            self.servers = dict(self.servers)
+            self._copied = True
+        return self.servers
+
+    def put(self, description):
+        self._write()[description.address] = description
+
+    def remove(self, address):
+        self._write().pop(address, None)
+
+    def remove_server(self, description):
+        self.remove(description.address)
+
+    def check_if_has_primary(self, description=None):
+        if any(s.type == "RSPrimary" for s in self.servers.values()):
+            self.type = "ReplicaSetWithPrimary"
+        else:
+            self.type = "ReplicaSetNoPrimary"
+
+    def add_members(self, description):
+        for address in description.members():
+            if address not in self.servers:
+                self.put(unknown(address))
+
+    def mark_possible_primary(self, description):
+        if description.primary is not None:
+            primary = self.servers.get(description.primary)
+            if primary is not None and primary.type == "Unknown":
+                self.put(unknown(primary.address, "PossiblePrimary"))
+
+    def update_unknown_with_standalone(self, description):
+        if len(self.topology.seeds) == 1:
+            self.type = "Single"
+        else:
+            self.remove(description.address)
+
+    def update_rs_without_primary(self, description):
+        if self.set_name is None:
+            self.set_name = description.set_name
+        elif self.set_name != description.set_name:
+            self.remove(description.address)
+            return
+        self.add_members(description)
+        self.mark_possible_primary(description)
+        if description.me is not None and description.address != description.me:
+            self.remove(description.address)
+
+    def update_rs_with_primary_from_member(self, description):
+        if (self.set_name != description.set_name or
+                (description.me is not None and description.address != description.me)):
+            self.remove(description.address)
+            self.check_if_has_primary()
+            return
+        if not any(s.type == "RSPrimary" for s in self.servers.values()):
+            self.type = "ReplicaSetNoPrimary"
+            self.mark_possible_primary(description)
+
+    def update_rs_from_primary(self, description):
+        if self.set_name is None:
+            self.set_name = description.set_name
+        elif self.set_name != description.set_name:
+            self.remove(description.address)
+            self.check_if_has_primary()
+            return
+
+        set_version, election_id = description.set_version, description.election_id
+        if set_version is not None and election_id is not None:
+            if (self.max_set_version is not None and self.max_election_id is not None and
+                    (self.max_set_version > set_version or
+                     (self.max_set_version == set_version and
+                      self.max_election_id > election_id))):
+                # A stale primary.
+                self.put(unknown(description.address))
+                self.check_if_has_primary()
+                return
+            self.max_election_id = election_id
+        if set_version is not None and (self.max_set_version is None or
+                                        set_version > self.max_set_version):
+            self.max_set_version = set_version
+
+        for server in list(self.servers.values()):
+            if server.address != description.address and server.type == "RSPrimary":
+                self.put(unknown(server.address))
+        self.add_members(description)
+        members = set(description.members())
+        for address in list(self.servers):
+            if address not in members:
+                self.remove(address)
+        self.check_if_has_primary()
+
+
+# (topology type, server type) -> the _Update methods to run, in order,
+# after replacing the server's description; TYPE_CHANGES sets the topology
+# type first. A missing entry is a no-op.
+ACTIONS = {}
+TYPE_CHANGES = {}
+for _kind in RS_MEMBERS:
+    ACTIONS[("Unknown", _kind)] = ("update_rs_without_primary",)
+    TYPE_CHANGES[("Unknown", _kind)] = "ReplicaSetNoPrimary"
+    ACTIONS[("ReplicaSetNoPrimary", _kind)] = ("update_rs_without_primary",)
+    ACTIONS[("ReplicaSetWithPrimary", _kind)] = ("update_rs_with_primary_from_member",)
+for _topology_type in ("Unknown", "ReplicaSetNoPrimary", "ReplicaSetWithPrimary"):
+    ACTIONS[(_topology_type, "RSPrimary")] = ("update_rs_from_primary",)
+    TYPE_CHANGES[(_topology_type, "RSPrimary")] = "ReplicaSetWithPrimary"
+for _kind in ("Standalone", "RSPrimary", "RSSecondary", "RSArbiter", "RSOther", "RSGhost"):
+    ACTIONS[("Sharded", _kind)] = ("remove_server",)
+for _kind in ("Standalone", "Mongos"):
+    ACTIONS[("ReplicaSetNoPrimary", _kind)] = ("remove_server",)
+    ACTIONS[("ReplicaSetWithPrimary", _kind)] = ("remove_server", "check_if_has_primary")
+for _kind in ("Unknown", "RSGhost"):
+    ACTIONS[("ReplicaSetWithPrimary", _kind)] = ("check_if_has_primary",)
+ACTIONS[("Unknown", "Standalone")] = ("update_unknown_with_standalone",)
+TYPE_CHANGES[("Unknown", "Mongos")] = "Sharded"
+
+
+def compatibility(servers):
+    """Return (compatible, compatibility error) for a servers dict."""
+    for server in servers.values():
+        if server.type in ("Unknown", "PossiblePrimary"):
+            continue
+        if server.min_wire_version > CLIENT_MAX_WIRE_VERSION:
+            return False, ("Server at %s requires wire version %d, but this version of "
+                           "sdam.py only supports up to %d."
+                           % (server.address, server.min_wire_version, CLIENT_MAX_WIRE_VERSION))
+        if server.max_wire_version < CLIENT_MIN_WIRE_VERSION:
+            return False, ("Server at %s reports wire version %d, but this version of "
+                           "sdam.py requires at least %d."
+                           % (server.address, server.max_wire_version, CLIENT_MIN_WIRE_VERSION))
+    return True, None
+
+
+def session_timeout(servers):
+    timeouts = [s.logical_session_timeout_minutes for s in servers.values()
+                if s.type in DATA_BEARING]
+    if not timeouts or None in timeouts:
+        return None
+    return min(timeouts)
+
+
+def apply(topology, address, response):
+    """Apply one ismaster outcome from address and return the next
+    TopologyDescription and a list of (event name, fields) pairs."""
+    old = topology.servers.get(address)
+    if old is None:
+        # A response from a server that has been removed.
+        return topology, []
+    description = parse_response(address, response)
+    changed = description.key() != old.key()
+
+    # The update rules run even for an unchanged description: they may still
+    # change other servers, e.g. mark an Unknown primary PossiblePrimary.
+    update = _Update(topology)
+    if changed:
+        update.put(description)
+    if topology.type != "Single":
+        key = (topology.type, description.type)
+        update.type = TYPE_CHANGES.get(key, update.type)
+        for action in ACTIONS.get(key, ()):
+            getattr(update, action)(description)
+
+    if not changed and not update._copied and (
+            (update.type, update.set_name, update.max_set_version, update.max_election_id) ==
+            (topology.type, topology.set_name, topology.max_set_version,
+             topology.max_election_id)):
+        # Nothing to copy: the snapshot already describes this response.
+        return topology, []
+
+    servers = update.servers
+    compatible, error = compatibility(servers)
+    new = TopologyDescription(update.type, update.set_name, update.max_set_version,
+                              update.max_election_id, servers, compatible, error,
+                              session_timeout(servers), topology.seeds)
+
+    # An unchanged description publishes no change events, as in drivers.
+    events = []
+    if changed:
+        events.append(("server_description_changed_event", {
+            "address": address,
+            "previousDescription": old.to_event(),
+            "newDescription": description.to_event()}))
+    for added in servers:
+        if added not in topology.servers:
+            events.append(("server_opening_event", {"address": added}))
+    for removed in topology.servers:
+        if removed not in servers:
+            events.append(("server_closed_event", {"address": removed}))
+    if changed:
+        events.append(("topology_description_changed_event", {
+            "previousDescription": topology.to_event(),
+            "newDescription": new.to_event()}))
+    return new, events
+
+
+def replay(topology, responses):
+    """Apply (address, response) pairs in order; return the final
+    TopologyDescription and every event published."""
+    events = []
+    for (address, response) in responses:
+        topology, published = apply(topology, address, response)
+        events.extend(published)
+    return topology, events
+
+
+def check_outcome(topology, outcome):
+    """Return a list of differences between topology and a test outcome."""
+    failures = []
+
+    def compare(name, expected, actual):
+        if expected != actual:
+            failures.append("%s: expected %r, got %r" % (name, expected, actual))
+
+    compare("topologyType", outcome["topologyType"], topology.type)
+    compare("setName", outcome["setName"], topology.set_name)
+    compare("logicalSessionTimeoutMinutes", outcome["logicalSessionTimeoutMinutes"],
+            topology.logical_session_timeout_minutes)
+    if "maxSetVersion" in outcome:
+        compare("maxSetVersion", outcome["maxSetVersion"], topology.max_set_version)
+    if "maxElectionId" in outcome:
+        compare("maxElectionId", object_id(outcome["maxElectionId"]),
+                topology.max_election_id)
+    if "compatible" in outcome:
+        compare("compatible", outcome["compatible"], topology.compatible)
+    compare("servers", sorted(outcome["servers"]), sorted(topology.servers))
+    for (address, expected) in sorted(outcome["servers"].items()):
+        server = topology.servers.get(address)
+        if server is None:
+            continue
+        compare("%s type" % address, expected["type"], server.type)
+        for (field, attr) in (("setName", "set_name"), ("setVersion", "set_version"),
+                              ("electionId", "election_id"),
+                              ("logicalSessionTimeoutMinutes", "logical_session_timeout_minutes"),
+                              ("minWireVersion", "min_wire_version"),
+                              ("maxWireVersion", "max_wire_version")):
+            if field in expected:
+                value = expected[field]
+                if field == "electionId":
+                    value = object_id(value)
+                compare("%s %s" % (address, field), value, getattr(server, attr))
+    return failures
+
+
+def normalize_event(event):
+    """Make an expected or published event comparable: drop topologyId and
+    sort each description's address lists."""
+    ((name, fields),) = event.items() if isinstance(event, dict) else (event,)
+    fields = dict((k, v) for (k, v) in fields.items() if k != "topologyId")
+
+    def server(doc):
+        doc = dict(doc)
+        for field in ("hosts", "passives", "arbiters"):
+            doc[field] = sorted(doc[field])
+        return doc
+
+    for key in ("previousDescription", "newDescription"):
+        if key in fields:
+            doc = dict(fields[key])
+            if "servers" in doc:
+                doc["servers"] = sorted((server(s) for s in doc["servers"]),
+                                        key=lambda s: s["address"])
+            else:
+                doc = server(doc)
+            fields[key] = doc
+    return name, fields
+
+
+def run_file(path):
+    """Replay one test file and return a list of failure messages."""
+    with open(path) as f:
+        test = json.load(f)
+    seeds, set_name = parse_uri(test["uri"])
+    topology = initial(seeds, set_name)
+    pending = opening_events(topology)
+    failures = []
+    for (i, phase) in enumerate(test["phases"]):
+        topology, events = replay(topology, phase.get("responses") or [])
+        outcome = phase["outcome"]
+        if "events" in outcome:
+            expected = [normalize_event(e) for e in outcome["events"]]
+            actual = [normalize_event(e) for e in pending + events]
+            if expected != actual:
+                failures.append("phase %d events:\n  expected %s\n  got      %s"
+                                % (i, expected, actual))
+            pending = []
+        else:
+            failures.extend("phase %d %s" % (i, f) for f in check_outcome(topology, outcome))
+    return failures
+
+
+def run_tests(tests_dir):
+    paths = sorted(glob.glob(os.path.join(tests_dir, "*", "*.json")))
+    failed = 0
+    for path in paths:
+        failures = run_file(path)
+        for failure in failures:
+            print("FAIL %s: %s" % (os.path.relpath(path, tests_dir), failure))
+        failed += bool(failures)
+    print("%d files, %d failed" % (len(paths), failed))
+    return failed == 0
+
+
+def member_response(hosts, address, state, election, primary=None):
+    """An ismaster response from a member of replica set "rs"; state is
+    "primary", "secondary", "recovering" or "down". primary is the address
+    a secondary reports as primary."""
+    if state == "down":
+        return {}
+    response = {"ok": 1, "setName": "rs", "setVersion": 1, "hosts": hosts,
+                "me": address, "ismaster": state == "primary",
+                "secondary": state == "secondary", "minWireVersion": 0,
+                "maxWireVersion": 6, "logicalSessionTimeoutMinutes": 30}
+    if state == "primary":
+        response["electionId"] = {"$oid": "%024x" % election}
+        response["primary"] = address
+    elif state == "secondary" and primary is not None:
+        response["primary"] = primary
+    return response
+
+
+def rolling_restart(hosts, restarts):
+    """Yield rounds of (address, response) pairs: every member answers one
+    heartbeat per round while members restart one at a time, the
+    secondaries and then the primary.
+
+    A restarting member is down for a round and recovering for a round
+    before it is a secondary again. Before the primary restarts it steps
+    down, and the next member wins an election with a new electionId.
+    """
+    states = ["primary"] + ["secondary"] * (len(hosts) - 1)
+    election = [1]
+
+    def heartbeat():
+        primary = hosts[states.index("primary")] if "primary" in states else None
+        return [(address, member_response(hosts, address, state, election[0], primary))
+                for (address, state) in zip(hosts, states)]
+
+    yield heartbeat()
+    order = []
+    for _ in range(restarts):
+        if not order:
+            # Each pass restarts the secondaries, then the primary.
+            order = sorted(range(len(hosts)), key=lambda i: states[i] == "primary")
+        member = order.pop(0)
+        if states[member] == "primary":
+            states[member] = "secondary"
+            yield heartbeat()
+            election[0] += 1
+            states[(member + 1) % len(hosts)] = "primary"
+            yield heartbeat()
+        for state in ("down", "recovering", "secondary"):
+            states[member] = state
+            yield heartbeat()
+
+
+def benchmark(members, restarts, steady_rounds):
+    hosts = ["host%d:27017" % i for i in range(members)]
+    rounds = list(rolling_restart(hosts, restarts))
+    responses = [pair for round_ in rounds[1:] for pair in round_]
+
+    # Discover the set from three seeds, then time heartbeats that change
+    # nothing.
+    topology, _ = replay(initial(tuple(hosts[:3]), "rs"), rounds[0])
+    start = time.perf_counter()
+    for _ in range(steady_rounds):
+        replay(topology, rounds[0])
+    steady_rate = steady_rounds * members / (time.perf_counter() - start)
+
+    current = topology
+    start = time.perf_counter()
+    for (address, response) in responses:
+        current, _ = apply(current, address, response)
+    restart_rate = len(responses) / (time.perf_counter() - start)
+
+    # Replay again, untimed, to count what each response changed.
+    counts = collections.Counter()
+    changed = no_primary = changed_servers = 0
+    current = topology
+    for (address, response) in responses:
+        new, events = apply(current, address, response)
+        changed += new is not current
+        counts.update(name for (name, _) in events)
+        no_primary += new.type == "ReplicaSetNoPrimary"
+        changed_servers += sum(1 for (a, s) in new.servers.items()
+                               if a not in current.servers or
+                               current.servers[a].key() != s.key())
+        current = new
+
+    print("%d-member replica set, %d restarts, %d responses" % (members, restarts, len(responses)))
+    print("  %-34s %10.0f" % ("steady heartbeats per second", steady_rate))
+    print("  %-34s %10.0f" % ("rolling restart responses per second", restart_rate))
+    print("  %-34s %10d (%.1f%%)" % ("responses that changed the topology", changed,
+                                      100.0 * changed / len(responses)))
+    print("  %-34s %10d" % ("snapshots with no primary", no_primary))
+    print("  %-34s %10.2f" % ("changed descriptions per response",
+                              float(changed_servers) / len(responses)))
+    for (name, count) in sorted(counts.items()):
+        print("  %-34s %10d" % (name, count))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--tests", default=TESTS_DIR,
+                        help="directory of SDAM tests (default: tests)")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="time rolling restarts instead of running the tests")
+    parser.add_argument("--members", type=int, default=50,
+                        help="replica set size for --benchmark (default: 50)")
+    parser.add_argument("--restarts", type=int, default=50,
+                        help="members restarted for --benchmark (default: 50, "
+                        "a full rolling restart)")
+    parser.add_argument("--steady-rounds", type=int, default=200,
+                        help="heartbeat rounds with no change for --benchmark (default: 200)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.benchmark:
+        benchmark(args.members, args.restarts, args.steady_rounds)
+        return
+    sys.exit(0 if run_tests(args.tests) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""An array-backed RTT tracker, checked against tests/rtt.
+
+The Server Selection spec averages each server's heartbeat round trip times
+with an exponentially-weighted moving average, alpha 0.2; a server's first
+RTT becomes its average. RTTTracker keeps the averages of every server in one
+NumPy array, NaN for a server with no RTT yet. tick() applies a sample per
+server, NaN where a server had none, and update() applies samples for a
+subset of servers, each with a few array operations instead of a loop over
+server objects.
+
+    python rtt_tracker.py
+    python rtt_tracker.py --benchmark --sizes 100,1000,10000,100000
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+TESTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tests", "rtt")
+
+ALPHA = 0.2
+
+
+class RTTTracker(object):
+    """Average RTTs, in milliseconds, for servers numbered 0 to size - 1."""
+
+    def __init__(self, size=0, alpha=ALPHA):
+        self.alpha = alpha
+        self.avg = np.full(size, np.nan)
+
+    def __len__(self):
+        return len(self.avg)
+
+    def add(self, count=1):
+        """Add count servers with no RTT yet and return their numbers."""
+        start = len(self.avg)
+        self.avg = np.concatenate([self.avg, np.full(count, np.nan)])
+        return np.arange(start, start + count)
+
+    def reset(self, servers):
+        """Forget the averages of servers, e.g. when they're marked Unknown."""
+        self.avg[servers] = np.nan
+
+    def tick(self, rtts):
+        """Apply one monitoring tick: rtts has an entry per server, NaN for
+        a server with no sample this tick. Returns the averages."""
+        rtts = np.asarray(rtts, dtype=np.float64)
+        avg = self.avg
+        # NaN where the server has no average yet or no sample.
+        new = rtts - avg
+        new *= self.alpha
+        new += avg
+        np.copyto(new, rtts, where=np.isnan(avg))
+        np.copyto(avg, new, where=~np.isnan(rtts))
+        return avg
+
+    def update(self, servers, rtts):
+        """Apply one RTT sample per entry of servers and return the new
+        averages of servers.
+
+        A server may appear more than once; its samples are applied in
+        order, as if the heartbeats had arrived one by one.
+        """
+        servers = np.asarray(servers, dtype=np.intp)
+        rtts = np.asarray(rtts, dtype=np.float64)
+        if len(servers) and np.bincount(servers).max() > 1:
+            # Apply the first sample for each server, then the second, ...
+            order = np.argsort(servers, kind="stable")
+            sorted_servers = servers[order]
+            starts = np.flatnonzero(np.r_[True, sorted_servers[1:] != sorted_servers[:-1]])
+            rank = np.arange(len(servers)) - np.repeat(starts, np.diff(np.r_[starts, len(servers)]))
+            for r in range(rank.max() + 1):
+                batch = order[rank == r]
+                self._apply(servers[batch], rtts[batch])
+        else:
+            self._apply(servers, rtts)
+        return self.avg[servers]
+
+    def _apply(self, servers, rtts):
+        old = self.avg[servers]
+        new = old + self.alpha * (rtts - old)
+        self.avg[servers] = np.where(np.isnan(old), rtts, new)
+
+
+def python_update(averages, servers, rtts, alpha=ALPHA):
+    """The spec's rule one server at a time, over a list with None for no
+    RTT yet; the benchmark's baseline."""
+    for (server, rtt) in zip(servers, rtts):
+        old = averages[server]
+        averages[server] = rtt if old is None else alpha * rtt + (1 - alpha) * old
+
+
+def load_tests(tests_dir):
+    tests = []
+    for path in sorted(glob.glob(os.path.join(tests_dir, "*.json"))):
+        with open(path) as f:
+            tests.append((os.path.basename(path), json.load(f)))
+    return tests
+
+
+def run_tests(tests_dir):
+    tests = load_tests(tests_dir)
+    failed = 0
+
+    def check(name, got, expected):
+        if not np.isclose(got, expected):
+            print("FAIL %s: expected %r, got %r" % (name, expected, got))
+            return 1
+        return 0
+
+    # One tracker per file, then every file as one batch of a shared tracker.
+    for (name, test) in tests:
+        tracker = RTTTracker(1)
+        if test["avg_rtt_ms"] != "NULL":
+            tracker.update([0], [test["avg_rtt_ms"]])
+        failed += check(name, tracker.update([0], [test["new_rtt_ms"]])[0], test["new_avg_rtt"])
+
+    tracker = RTTTracker(len(tests))
+    known = [i for (i, (_, test)) in enumerate(tests) if test["avg_rtt_ms"] != "NULL"]
+    tracker.update(known, [tests[i][1]["avg_rtt_ms"] for i in known])
+    averages = tracker.update(np.arange(len(tests)), [test["new_rtt_ms"] for (_, test) in tests])
+    for ((name, test), got) in zip(tests, averages):
+        failed += check("%s (batch)" % name, got, test["new_avg_rtt"])
+
+    # And as two ticks, with no sample in the first for the NULL averages.
+    tracker = RTTTracker(len(tests))
+    tracker.tick([np.nan if test["avg_rtt_ms"] == "NULL" else test["avg_rtt_ms"]
+                  for (_, test) in tests])
+    averages = tracker.tick([test["new_rtt_ms"] for (_, test) in tests])
+    for ((name, test), got) in zip(tests, averages):
+        failed += check("%s (tick)" % name, got, test["new_avg_rtt"])
+
+    print("%d files, %d failures" % (len(tests), failed))
+    return failed == 0
+
+
+def benchmark(sizes, ticks, seed):
+    """Time a monitoring tick at each size: tick() with a sample for every
+    server, update() with samples for a random tenth of them, and the
+    per-server Python loop with a sample for every server."""
+    rng = np.random.default_rng(seed)
+    print("%8s %14s %16s %16s %10s" % (
+        "servers", "tick (us)", "update 10% (us)", "python (us)", "speedup"))
+    for n in sizes:
+        samples = rng.uniform(1, 100, size=(ticks, n))
+        partial = [rng.choice(n, size=max(1, n // 10), replace=False) for _ in range(ticks)]
+
+        tracker = RTTTracker(n)
+        tracker.tick(samples[0])
+        start = time.perf_counter()
+        for tick in samples:
+            tracker.tick(tick)
+        tick_time = (time.perf_counter() - start) / ticks
+
+        averages = [None] * n
+        python_update(averages, range(n), samples[0].tolist())
+        rows = samples.tolist()
+        server_list = list(range(n))
+        start = time.perf_counter()
+        for tick in rows:
+            python_update(averages, server_list, tick)
+        python_time = (time.perf_counter() - start) / ticks
+
+        if not np.allclose(tracker.avg, averages):
+            sys.exit("array and python averages differ for %d servers" % n)
+
+        start = time.perf_counter()
+        for (tick, servers) in zip(samples, partial):
+            tracker.update(servers, tick[servers])
+        update_time = (time.perf_counter() - start) / ticks
+
+        print("%8d %14.1f %16.1f %16.1f %9.1fx" % (
+            n, tick_time * 1e6, update_time * 1e6, python_time * 1e6, python_time / tick_time))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--tests", default=TESTS_DIR,
+                        help="directory of RTT tests (default: tests/rtt)")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="time monitoring ticks instead of running the tests")
+    parser.add_argument("--sizes", default="100,1000,10000,100000",
+                        help="comma-separated server counts for --benchmark "
+                        "(default: 100,1000,10000,100000)")
+    parser.add_argument("--ticks", type=int, default=50,
+                        help="ticks per size for --benchmark (default: 50)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed for the RTT samples (default: 0)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.benchmark:
+        benchmark([int(n) for n in args.sizes.split(",")], args.ticks, args.seed)
+        return
+    sys.exit(0 if run_tests(args.tests) else 1)
+
+
+if __name__ == "__main__":
+    main()
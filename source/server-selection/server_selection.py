@@ -0,0 +1,359 @@
+"""A table-driven server selection engine, checked against tests/server_selection.
+
+A Topology is an immutable snapshot of a deployment. When it's built it sorts
+its servers by average RTT and indexes them by type and by tag, so a
+selection doesn't filter the whole member list:
+
+- RULES says, for each topology type, operation and mode, which pools of
+  servers to try in order ("primary", "secondary", "nearest", "mongos" or
+  "any") and whether tag_sets apply to them.
+- Each pool is a tuple of server indexes sorted by RTT. A tag set's matches
+  come from intersecting the posting sets of its (key, value) pairs, and the
+  RTT-sorted suitable servers for a pool and tag_sets are computed once per
+  snapshot and cached.
+- The latency window is then a prefix of the suitable servers, found by
+  bisecting their RTTs, and select() picks a random index below its end.
+
+So a selection on a warm snapshot costs a dict lookup and a bisection,
+whatever the number of members. naive_suitable() transcribes the spec's
+filtering directly, for checking and as the benchmark's baseline.
+
+    python server_selection.py
+    python server_selection.py --benchmark --sizes 1,10,100,1000
+"""
+
+import argparse
+import bisect
+import glob
+import json
+import os
+import random
+import sys
+import time
+
+TESTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         "tests", "server_selection")
+
+LOCAL_THRESHOLD_MS = 15
+
+MODES = ("primary", "primarypreferred", "secondary", "secondarypreferred", "nearest")
+
+_RS_READ = {
+    "primary": (("primary", False),),
+    "primarypreferred": (("primary", False), ("secondary", True)),
+    "secondary": (("secondary", True),),
+    "secondarypreferred": (("secondary", True), ("primary", False)),
+    "nearest": (("nearest", True),),
+}
+_RS_WRITE = dict((mode, (("primary", False),)) for mode in MODES)
+_ALL_MONGOS = dict((mode, (("mongos", False),)) for mode in MODES)
+_ANY = dict((mode, (("any", False),)) for mode in MODES)
+_NONE = dict((mode, ()) for mode in MODES)
+
+# Topology type -> operation -> mode -> ((pool, apply tag_sets), ...): the
+# pools to try in order; the first with a suitable server wins.
+RULES = {
+    "Unknown": {"read": _NONE, "write": _NONE},
+    "Single": {"read": _ANY, "write": _ANY},
+    "ReplicaSetWithPrimary": {"read": _RS_READ, "write": _RS_WRITE},
+    "ReplicaSetNoPrimary": {"read": _RS_READ, "write": _RS_WRITE},
+    "Sharded": {"read": _ALL_MONGOS, "write": _ALL_MONGOS},
+}
+
+# Server type -> pools it belongs to. Other types (RSArbiter, RSOther,
+# RSGhost, PossiblePrimary, Unknown) are never suitable.
+POOLS = {
+    "RSPrimary": ("primary", "nearest", "any"),
+    "RSSecondary": ("secondary", "nearest", "any"),
+    "Mongos": ("mongos", "any"),
+    "Standalone": ("any",),
+}
+
+
+class SelectionError(ValueError):
+    """An invalid read preference."""
+
+
+def read_preference_key(read_preference):
+    """Return (mode, tag_sets) for a read preference document, with the
+    mode lowercased and each tag set a frozenset of (key, value) pairs."""
+    read_preference = read_preference or {}
+    mode = read_preference.get("mode", "primary").lower()
+    if mode not in MODES:
+        raise SelectionError("unknown read preference mode %r" % read_preference.get("mode"))
+    tag_sets = read_preference.get("tag_sets")
+    if tag_sets is None:
+        tag_sets = [{}]
+    tag_sets = tuple(frozenset(t.items()) for t in tag_sets)
+    if mode == "primary" and any(tag_sets):
+        raise SelectionError("a non-empty tag set is not allowed with mode primary")
+    return mode, tag_sets
+
+
+class Topology(object):
+    """An immutable topology snapshot that answers server selection.
+
+    servers are dicts as in the test files: "address", "type", "avg_rtt_ms"
+    and optionally "tags".
+    """
+
+    def __init__(self, topology_type, servers, local_threshold_ms=LOCAL_THRESHOLD_MS):
+        if topology_type not in RULES:
+            raise ValueError("unknown topology type %r" % topology_type)
+        self.type = topology_type
+        self.local_threshold_ms = local_threshold_ms
+        self.servers = tuple(sorted(servers, key=lambda s: s.get("avg_rtt_ms", 0)))
+        self.rtts = [s.get("avg_rtt_ms", 0) for s in self.servers]
+
+        # Pool name -> RTT-sorted tuple of server indexes.
+        pools = dict((name, []) for name in ("primary", "secondary", "nearest", "mongos", "any"))
+        # (tag key, value) -> set of server indexes.
+        self.postings = {}
+        for (i, server) in enumerate(self.servers):
+            for name in POOLS.get(server.get("type"), ()):
+                pools[name].append(i)
+            for pair in (server.get("tags") or {}).items():
+                self.postings.setdefault(pair, set()).add(i)
+        self.pools = dict((name, tuple(indexes)) for (name, indexes) in pools.items())
+
+        self._tag_matches = {}
+        self._suitable = {}
+
+    def matching(self, tag_set):
+        """Return the set of indexes of servers matching a tag set, or None
+        for the empty tag set, which matches every server."""
+        if not tag_set:
+            return None
+        if tag_set not in self._tag_matches:
+            postings = sorted((self.postings.get(pair, set()) for pair in tag_set), key=len)
+            self._tag_matches[tag_set] = set.intersection(*postings) if postings[0] else set()
+        return self._tag_matches[tag_set]
+
+    def eligible(self, pool, tag_sets):
+        """Return the RTT-sorted indexes in pool matching the first of
+        tag_sets that matches any of them."""
+        if not tag_sets:
+            return pool
+        for tag_set in tag_sets:
+            matches = self.matching(tag_set)
+            if matches is None:
+                return pool
+            found = tuple(i for i in pool if i in matches) if matches else ()
+            if found:
+                return found
+        return ()
+
+    def _plan(self, operation, mode, tag_sets):
+        """Compute the RTT-sorted suitable indexes and the end of their
+        latency window."""
+        for (pool_name, tagged) in RULES[self.type][operation][mode]:
+            pool = self.pools[pool_name]
+            found = self.eligible(pool, tag_sets) if tagged else pool
+            if found:
+                rtts = [self.rtts[i] for i in found]
+                window = bisect.bisect_right(rtts, rtts[0] + self.local_threshold_ms)
+                return found, window
+        return (), 0
+
+    def plan(self, operation, read_preference):
+        """Return (suitable indexes sorted by RTT, end of latency window)."""
+        mode, tag_sets = read_preference_key(read_preference)
+        key = (operation, mode, tag_sets)
+        plan = self._suitable.get(key)
+        if plan is None:
+            plan = self._suitable[key] = self._plan(operation, mode, tag_sets)
+        return plan
+
+    def suitable(self, operation, read_preference):
+        found, _ = self.plan(operation, read_preference)
+        return [self.servers[i] for i in found]
+
+    def in_latency_window(self, operation, read_preference):
+        found, window = self.plan(operation, read_preference)
+        return [self.servers[i] for i in found[:window]]
+
+    def select(self, operation, read_preference, rng=random):
+        """Return a random server in the latency window, or None."""
+        found, window = self.plan(operation, read_preference)
+        if not window:
+            return None
+        return self.servers[found[int(rng.random() * window)]]
+
+
+def tags_match(tag_set, tags):
+    return all(tags.get(k) == v for (k, v) in tag_set.items())
+
+
+def naive_suitable(topology_type, servers, operation, read_preference,
+                   local_threshold_ms=LOCAL_THRESHOLD_MS):
+    """The spec's filtering over the full member list, one step at a time.
+    Returns (suitable servers, servers in the latency window)."""
+    read_preference = read_preference or {}
+    mode = read_preference.get("mode", "primary").lower()
+    tag_sets = read_preference.get("tag_sets", [{}])
+    primaries = [s for s in servers if s["type"] == "RSPrimary"]
+    secondaries = [s for s in servers if s["type"] == "RSSecondary"]
+
+    def by_tags(candidates):
+        if not tag_sets:
+            return candidates
+        for tag_set in tag_sets:
+            found = [s for s in candidates if tags_match(tag_set, s.get("tags") or {})]
+            if found:
+                return found
+        return []
+
+    if topology_type == "Unknown":
+        suitable = []
+    elif topology_type == "Single":
+        suitable = [s for s in servers if s["type"] in POOLS]
+    elif topology_type == "Sharded":
+        suitable = [s for s in servers if s["type"] == "Mongos"]
+    elif operation == "write" or mode == "primary":
+        suitable = primaries
+    elif mode == "secondary":
+        suitable = by_tags(secondaries)
+    elif mode == "nearest":
+        suitable = by_tags(primaries + secondaries)
+    elif mode == "primarypreferred":
+        suitable = primaries or by_tags(secondaries)
+    else:
+        suitable = by_tags(secondaries) or primaries
+
+    if not suitable:
+        return [], []
+    low = min(s["avg_rtt_ms"] for s in suitable)
+    window = [s for s in suitable if s["avg_rtt_ms"] <= low + local_threshold_ms]
+    return suitable, window
+
+
+def addresses(servers):
+    return sorted(s["address"] for s in servers)
+
+
+def check_file(path):
+    """Return a list of failure messages for one test file."""
+    with open(path) as f:
+        test = json.load(f)
+    description = test["topology_description"]
+    operation = test["operation"]
+    read_preference = test["read_preference"]
+    expected = (addresses(test["suitable_servers"]), addresses(test["in_latency_window"]))
+
+    topology = Topology(description["type"], description["servers"])
+    actual = (addresses(topology.suitable(operation, read_preference)),
+              addresses(topology.in_latency_window(operation, read_preference)))
+    naive = naive_suitable(description["type"], description["servers"], operation,
+                           read_preference)
+    naive = (addresses(naive[0]), addresses(naive[1]))
+
+    failures = []
+    for (name, got) in (("engine", actual), ("naive", naive)):
+        if got[0] != expected[0]:
+            failures.append("%s suitable_servers: expected %s, got %s" % (name, expected[0], got[0]))
+        if got[1] != expected[1]:
+            failures.append("%s in_latency_window: expected %s, got %s" % (name, expected[1], got[1]))
+    selected = topology.select(operation, read_preference)
+    if (selected and selected["address"]) not in (expected[1] or [None]):
+        failures.append("select() returned %s" % (selected and selected["address"]))
+    return failures
+
+
+def run_tests(tests_dir):
+    paths = sorted(glob.glob(os.path.join(tests_dir, "*", "*", "*.json")))
+    failed = 0
+    for path in paths:
+        name = os.path.relpath(path, tests_dir)
+        for failure in check_file(path):
+            print("FAIL %s: %s" % (name, failure))
+            failed += 1
+    print("%d files, %d failures" % (len(paths), failed))
+    return failed == 0
+
+
+def make_servers(topology_type, n, rng):
+    """Return n servers for a synthetic topology: a primary and secondaries
+    for a replica set, or mongoses, with RTTs of 1-100ms and two tags."""
+    servers = []
+    for i in range(n):
+        if topology_type == "Sharded":
+            server_type = "Mongos"
+        else:
+            server_type = "RSPrimary" if i == 0 else "RSSecondary"
+        servers.append({
+            "address": "host%d:27017" % i,
+            "type": server_type,
+            "avg_rtt_ms": rng.uniform(1, 100),
+            "tags": {"dc": "dc%d" % rng.randrange(5), "rack": "rack%d" % rng.randrange(20)},
+        })
+    return servers
+
+
+BENCHMARK_READ_PREFERENCES = [
+    {"mode": "primary"},
+    {"mode": "secondary", "tag_sets": [{"dc": "dc1", "rack": "rack3"}, {"dc": "dc1"}, {}]},
+    {"mode": "secondaryPreferred", "tag_sets": [{"dc": "dc2"}]},
+    {"mode": "nearest"},
+    {"mode": "primaryPreferred", "tag_sets": [{"dc": "dc9"}]},
+]
+
+
+def benchmark(sizes, selections, seed):
+    rng = random.Random(seed)
+    print("%-22s %6s %12s %14s %14s %8s" % (
+        "topology", "size", "build (us)", "engine sel/s", "naive sel/s", "speedup"))
+    for topology_type in ("ReplicaSetWithPrimary", "Sharded"):
+        for n in sizes:
+            servers = make_servers(topology_type, n, rng)
+            ops = [("read", rp) for rp in BENCHMARK_READ_PREFERENCES] + [("write", {})]
+            requests = [ops[i % len(ops)] for i in range(selections)]
+
+            start = time.perf_counter()
+            topology = Topology(topology_type, servers)
+            build = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for (operation, read_preference) in requests:
+                topology.select(operation, read_preference, rng)
+            engine = time.perf_counter() - start
+
+            # The naive filter is slow on large topologies; time fewer calls.
+            naive_requests = requests[:max(len(ops), selections // max(1, n // 10))]
+            start = time.perf_counter()
+            for (operation, read_preference) in naive_requests:
+                _, window = naive_suitable(topology_type, servers, operation, read_preference)
+                if window:
+                    rng.choice(window)
+            naive = time.perf_counter() - start
+
+            engine_rate = len(requests) / engine
+            naive_rate = len(naive_requests) / naive
+            print("%-22s %6d %12.1f %14.0f %14.0f %7.1fx" % (
+                topology_type, n, build * 1e6, engine_rate, naive_rate, engine_rate / naive_rate))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--tests", default=TESTS_DIR,
+                        help="directory of server selection tests (default: tests/server_selection)")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="time selections on synthetic topologies instead of running the tests")
+    parser.add_argument("--sizes", default="1,10,100,1000",
+                        help="comma-separated topology sizes for --benchmark (default: 1,10,100,1000)")
+    parser.add_argument("--selections", type=int, default=100000,
+                        help="selections per topology for --benchmark (default: 100000)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed for the synthetic topologies (default: 0)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.benchmark:
+        benchmark([int(n) for n in args.sizes.split(",")], args.selections, args.seed)
+        return
+    sys.exit(0 if run_tests(args.tests) else 1)
+
+
+if __name__ == "__main__":
+    main()